@@ -0,0 +1,193 @@
+import os
+import json
+import wave
+import struct
+import argparse
+import subprocess
+
+import numpy as np
+
+# ========= CONFIGURATION =========
+MASTER_RATE = 44100
+MASTER_CHANNELS = 2
+WAV_HEADER_BYTES = 44
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Assemble all clips into one continuous PCM master track.")
+    parser.add_argument("--data", default="/data", help="Base project folder containing audio/images.")
+    parser.add_argument("--output", default=None, help="Master WAV (default: <data>/timeline/master.wav)")
+    parser.add_argument("--offsets", default=None, help="Offsets JSON (default: next to the master WAV)")
+    parser.add_argument("--gap", type=float, default=float(os.getenv("MASTER_GAP", "0")),
+                        help="Silence inserted after every clip, in seconds (env MASTER_GAP)")
+    return parser.parse_args(argv)
+
+
+# ========= LOG =========
+def log(msg): print(f"[DEBUG] {msg}")
+
+
+# ========= DECODING =========
+def read_wav(path):
+    """(float32 samples [n, channels], rate) for 16-bit PCM WAVs, else None."""
+    try:
+        with wave.open(path, "rb") as w:
+            if w.getsampwidth() != 2:
+                return None
+            channels, rate = w.getnchannels(), w.getframerate()
+            frames = w.readframes(w.getnframes())
+    except (wave.Error, EOFError):
+        return None
+    pcm = np.frombuffer(frames, dtype="<i2").reshape(-1, channels)
+    return pcm.astype(np.float32) / 32768.0, rate
+
+
+def decode_with_ffmpeg(path, rate=MASTER_RATE, channels=MASTER_CHANNELS):
+    """Decode any format (answer.mp3, 24-bit WAVs, ...) to float32 at the master format."""
+    result = subprocess.run(
+        ["ffmpeg", "-v", "error", "-i", path, "-vn", "-f", "f32le", "-ac", str(channels), "-ar", str(rate), "-"],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if result.returncode != 0:
+        raise RuntimeError(f"Could not decode {path}: {result.stderr.decode(errors='ignore').strip()}")
+    return np.frombuffer(result.stdout, dtype="<f4").reshape(-1, channels), rate
+
+
+def wav_frames(path):
+    """(frames, rate) from a 16-bit WAV header without reading samples, else None."""
+    try:
+        with wave.open(path, "rb") as w:
+            if w.getsampwidth() != 2:
+                return None
+            return w.getnframes(), w.getframerate()
+    except (wave.Error, EOFError):
+        return None
+
+
+# ========= DSP =========
+def resample(x, src_rate, dst_rate):
+    """Linear-interpolation resampling of [n, channels] audio, vectorized per channel."""
+    if src_rate == dst_rate or len(x) == 0:
+        return x
+    n_out = resampled_length(len(x), src_rate, dst_rate)
+    positions = np.arange(n_out, dtype=np.float64) * (src_rate / dst_rate)
+    grid = np.arange(len(x), dtype=np.float64)
+    return np.stack([np.interp(positions, grid, x[:, c]) for c in range(x.shape[1])], axis=1).astype(np.float32)
+
+
+def resampled_length(n, src_rate, dst_rate):
+    return int(round(n * dst_rate / src_rate))
+
+
+def match_channels(x, channels):
+    """Upmix mono by duplication, downmix by averaging."""
+    if x.shape[1] == channels:
+        return x
+    if x.shape[1] == 1:
+        return np.repeat(x, channels, axis=1)
+    return np.repeat(x.mean(axis=1, keepdims=True), channels, axis=1)
+
+
+# ========= MASTER TRACK =========
+class ClipSource:
+    """Decodes each distinct non-WAV clip once and serves every clip at the master format."""
+
+    def __init__(self, rate=MASTER_RATE, channels=MASTER_CHANNELS):
+        self.rate = rate
+        self.channels = channels
+        self.decoded = {}
+
+    def length(self, path):
+        """Clip length in master samples, from the WAV header when possible."""
+        header = wav_frames(path)
+        if header:
+            frames, rate = header
+            return resampled_length(frames, rate, self.rate)
+        return len(self.load(path))
+
+    def load(self, path):
+        if path in self.decoded:
+            return self.decoded[path]
+        wav = read_wav(path)
+        if wav is None:
+            # Non-WAV sources (answer.mp3) repeat across the bank: keep them decoded
+            samples, _ = decode_with_ffmpeg(path, self.rate, self.channels)
+            self.decoded[path] = samples
+            return samples
+        samples, rate = wav
+        return match_channels(resample(samples, rate, self.rate), self.channels)
+
+
+def write_wav_header(f, frames, rate=MASTER_RATE, channels=MASTER_CHANNELS):
+    data_bytes = frames * channels * 2
+    f.write(b"RIFF" + struct.pack("<I", 36 + data_bytes) + b"WAVE")
+    f.write(b"fmt " + struct.pack("<IHHIIHH", 16, 1, channels, rate, rate * channels * 2, channels * 2, 16))
+    f.write(b"data" + struct.pack("<I", data_bytes))
+
+
+def build_master(pairs, output_wav, offsets_json=None, gap=0.0, rate=MASTER_RATE, channels=MASTER_CHANNELS,
+                 gains=None):
+    """Write all clips of pairs [(image, audio, ...)] into one 16-bit PCM master WAV.
+
+    Offsets are planned from the WAV headers first, then each clip is written
+    straight into a memory-mapped view of the output file, scaled by its
+    gains[audio] dB if given. Returns (and optionally writes as JSON) the
+    sample-accurate offset of every clip.
+    """
+    source = ClipSource(rate, channels)
+    gains = gains or {}
+    gap_frames = int(round(gap * rate))
+
+    offsets, cursor = [], 0
+    for pair in pairs:
+        image, audio = pair[0], pair[1]
+        length = source.length(audio)
+        offsets.append({
+            "image": image, "audio": audio,
+            "start_sample": cursor, "samples": length,
+            "start": cursor / rate, "duration": length / rate,
+        })
+        cursor += length + gap_frames
+    total = cursor
+
+    os.makedirs(os.path.dirname(output_wav) or ".", exist_ok=True)
+    with open(output_wav, "wb") as f:
+        write_wav_header(f, total, rate, channels)
+        f.truncate(WAV_HEADER_BYTES + total * channels * 2)  # zero-filled, so gaps are silence
+
+    if total:
+        master = np.memmap(output_wav, dtype="<i2", mode="r+", offset=WAV_HEADER_BYTES, shape=(total, channels))
+        for entry in offsets:
+            samples = source.load(entry["audio"])[:entry["samples"]]
+            gain = gains.get(entry["audio"])
+            if gain:
+                samples = samples * np.float32(10 ** (gain / 20))
+            start = entry["start_sample"]
+            master[start:start + len(samples)] = np.clip(samples * 32767.0, -32768, 32767).astype("<i2")
+        master.flush()
+        del master
+
+    log(f"Master track: {len(offsets)} clips, {total / rate:.2f}s -> {output_wav}")
+    if offsets_json:
+        with open(offsets_json, "w", encoding="utf-8") as f:
+            json.dump({"sample_rate": rate, "channels": channels, "gap": gap, "total_samples": total,
+                       "clips": offsets}, f, indent=2)
+    return offsets
+
+
+# ========= MAIN =========
+def main(argv=None):
+    from generate_video_segments_and_merge import match_images_and_audios
+
+    args = parse_args(argv)
+    output = args.output or os.path.join(args.data, "timeline", "master.wav")
+    offsets_json = args.offsets or os.path.splitext(output)[0] + "_offsets.json"
+    pairs = match_images_and_audios(args.data)
+    if not pairs:
+        log("No valid image/audio pairs found. Check filenames.")
+        exit(1)
+    build_master(pairs, output, offsets_json, args.gap)
+    log(f"Offsets written: {offsets_json}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,394 @@
+import os
+import json
+import time
+import random
+import shutil
+import argparse
+import platform
+import resource
+import statistics
+import subprocess
+import multiprocessing
+from dataclasses import dataclass, asdict
+from concurrent.futures import ProcessPoolExecutor
+
+# ========= CONFIGURATION =========
+BENCH_VERSION = 1  # bump when a benchmark changes what it measures; compare() refuses mismatches
+DEFAULT_WORKDIR = os.getenv("BENCH_DIR", "/tmp/knm-bench")
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# scripts, questions per script, narration words per script
+PRESETS = {
+    "smoke": (2, 3, 40),
+    "medium": (10, 10, 80),
+    "full": (50, 10, 120),  # ~500 questions, the size of the banks we render
+}
+
+VOCABULARY = (
+    "de het een en in op van met voor naar bij over onder tussen niet ook maar dan "
+    "ik jij hij zij wij jullie ze u werk huis school gemeente dokter winkel trein bus fiets "
+    "stad dorp straat buurt kind kinderen ouders familie vriend collega buurman afspraak "
+    "brief formulier vergunning verzekering huur belasting uitkering cursus taal examen "
+    "maandag dinsdag woensdag donderdag vrijdag zaterdag zondag morgen middag avond week "
+    "gaat komt werkt woont leert betaalt belt vraagt zegt helpt wacht koopt maakt heeft is "
+    "nieuwe oude grote kleine goede snelle rustige drukke belangrijke eerste laatste"
+).split()
+
+
+# ========= LOG =========
+def log(msg): print(f"[DEBUG] {msg}")
+
+
+# ========= SYNTHETIC BANKS =========
+@dataclass
+class BankSpec:
+    scripts: int
+    questions: int           # per script
+    words: int               # narration words per script
+    question_words: int = 12
+    option_d: float = 0.5    # share of questions with a fourth option
+    seed: int = 0
+
+    @property
+    def total_questions(self):
+        return self.scripts * self.questions
+
+
+def sentence(rng, words):
+    text = " ".join(rng.choice(VOCABULARY) for _ in range(max(1, words)))
+    return text[0].upper() + text[1:]
+
+
+def synthetic_bank(spec):
+    """input.txt text for spec; the same spec always produces the same bank."""
+    rng = random.Random(spec.seed)
+    lines = []
+    for sid in range(1, spec.scripts + 1):
+        lines.append(f"### AUDIO_SCRIPT_{sid} ###")
+        remaining = spec.words
+        while remaining > 0:
+            n = min(remaining, rng.randint(6, 14))
+            lines.append(sentence(rng, n) + ".")
+            remaining -= n
+        lines.append(f"### QUESTIONS_{sid} ###")
+        for qid in range(1, spec.questions + 1):
+            lines.append(f"Q{qid}: {sentence(rng, rng.randint(spec.question_words // 2, spec.question_words))}?")
+            letters = "ABCD" if rng.random() < spec.option_d else "ABC"
+            for letter in letters:
+                lines.append(f"{letter}. {sentence(rng, rng.randint(1, max(1, spec.question_words // 2)))}")
+            lines.append(f"ANSWER: {rng.choice(letters)}")
+    return "\n".join(lines) + "\n"
+
+
+def placeholder_scene(path, seed):
+    """A 1100x600 scene with a few shapes, so it compresses like a drawing rather than a flat fill."""
+    from PIL import Image, ImageDraw
+
+    rng = random.Random(seed)
+    img = Image.new("RGB", (1100, 600), tuple(rng.randint(150, 255) for _ in range(3)))
+    draw = ImageDraw.Draw(img)
+    for _ in range(12):
+        x, y = rng.randint(0, 1000), rng.randint(0, 500)
+        draw.ellipse((x, y, x + rng.randint(40, 300), y + rng.randint(40, 200)),
+                     fill=tuple(rng.randint(0, 255) for _ in range(3)))
+    img.save(path)
+
+
+def write_bank(spec, base):
+    """input.txt, intro.txt, placeholder scenes and the answer sound under base (a fresh /data layout)."""
+    if os.path.isdir(base):
+        shutil.rmtree(base)
+    scenes, sounds = os.path.join(base, "scenes"), os.path.join(base, "sounds")
+    for folder in (scenes, sounds):
+        os.makedirs(folder, exist_ok=True)
+    with open(os.path.join(base, "input.txt"), "w", encoding="utf-8") as f:
+        f.write(synthetic_bank(spec))
+    with open(os.path.join(base, "intro.txt"), "w", encoding="utf-8") as f:
+        f.write(sentence(random.Random(spec.seed), 60) + ".\n")
+    placeholder_scene(os.path.join(scenes, "intro.png"), spec.seed)
+    for sid in range(1, spec.scripts + 1):
+        placeholder_scene(os.path.join(scenes, f"scene_{sid:02d}.png"), spec.seed * 1000 + sid)
+    shutil.copy(os.path.join(REPO_DIR, "sounds", "answer.mp3"), sounds)
+    return base
+
+
+# ========= BENCHMARKS =========
+# Each benchmark runs in a fresh process against <workdir>/bank and returns
+# (seconds, items, unit). Setup is done before the clock starts.
+def bench_parse(base, options):
+    from input_parser import parse_input_file
+
+    path = os.path.join(base, "input.txt")
+    start = time.perf_counter()
+    for _ in range(options["rounds"]):
+        sections = parse_input_file(path)
+    seconds = time.perf_counter() - start
+    return seconds, options["rounds"] * sum(len(sec.questions) for sec in sections), "questions"
+
+
+def bench_wrap(base, options):
+    from input_parser import parse_input_file
+    from text_layout import TextLayout
+    from generate_question_images import get_renderer, QUESTION_BOX
+
+    renderer = get_renderer()
+    texts = []
+    for sec in parse_input_file(os.path.join(base, "input.txt")):
+        for q in sec.questions:
+            texts.append((renderer.font_q, q.text, QUESTION_BOX[2]))
+            texts += [(renderer.font_o, f"{letter}. {text}", 500) for letter, text in q.options]
+    start = time.perf_counter()
+    for _ in range(options["rounds"]):
+        layouts = {}  # cold memo each round, as in a fresh render worker
+        for font, text, width in texts:
+            layout = layouts.get(font) or layouts.setdefault(font, TextLayout(font))
+            layout.wrap(text, width)
+    seconds = time.perf_counter() - start
+    return seconds, options["rounds"] * len(texts), "texts"
+
+
+def bench_tts(base, options):
+    from pipeline import run_stage
+
+    audio = os.path.join(base, "output_audio")
+    start = time.perf_counter()
+    run_stage("audio", ["--input", os.path.join(base, "input.txt"), "--output", audio,
+                        "--tts-backend", "local", "--no-cache", "--force"])
+    seconds = time.perf_counter() - start
+    return seconds, count_files(audio, ".wav"), "clips"
+
+
+def bench_cards(base, options):
+    from pipeline import run_stage
+
+    images = os.path.join(base, "output_images")
+    start = time.perf_counter()
+    run_stage("images", ["--input", os.path.join(base, "input.txt"), "--output", images,
+                         "--scenes", os.path.join(base, "scenes"), "--workers", str(options["workers"]), "--force"])
+    seconds = time.perf_counter() - start
+    return seconds, count_files(images, ".png"), "cards"
+
+
+def bench_segments(base, options):
+    from pipeline import run_stage
+
+    start = time.perf_counter()
+    run_stage("segments", ["--data", base, "--force"])
+    seconds = time.perf_counter() - start
+    return seconds, count_files(os.path.join(base, "segments"), ".mp4"), "segments"
+
+
+def bench_merge(base, options):
+    from pipeline import run_merge
+
+    start = time.perf_counter()
+    run_merge(base)
+    seconds = time.perf_counter() - start
+    with open(os.path.join(base, "segments", "list.txt"), "r", encoding="utf-8") as f:
+        return seconds, sum(1 for line in f if line.strip()), "segments"
+
+
+def bench_pipeline(base, options):
+    # A cold build in its own project folder: nothing cached, nothing up to date
+    data = os.path.join(os.path.dirname(base), "pipeline")
+    if os.path.isdir(data):
+        shutil.rmtree(data)
+    os.makedirs(data)
+    for name in ("scenes", "sounds"):
+        shutil.copytree(os.path.join(base, name), os.path.join(data, name))
+    shutil.copy(os.path.join(base, "input.txt"), data)
+    os.environ["TTS_CACHE_DIR"] = os.path.join(data, ".tts_cache")
+    from pipeline import run_all
+
+    start = time.perf_counter()
+    run_all(["--data", data, "--mode", options["mode"], "--metrics", os.path.join(data, "metrics.json")])
+    seconds = time.perf_counter() - start
+    from input_parser import parse_input_file
+    return seconds, sum(len(sec.questions) for sec in parse_input_file(os.path.join(data, "input.txt"))), "questions"
+
+
+# name -> (function, benchmarks whose outputs it reads)
+BENCHMARKS = {
+    "parse": (bench_parse, ()),
+    "wrap": (bench_wrap, ()),
+    "tts": (bench_tts, ()),
+    "cards": (bench_cards, ()),
+    "segments": (bench_segments, ("tts", "cards")),
+    "merge": (bench_merge, ("segments",)),
+    "pipeline": (bench_pipeline, ()),
+}
+
+
+def count_files(folder, ext):
+    return sum(1 for name in os.listdir(folder) if name.endswith(ext)) if os.path.isdir(folder) else 0
+
+
+def run_isolated(name, base, options):
+    """One benchmark run; executed in a spawned process so peak RSS belongs to this run alone."""
+    import metrics
+
+    os.environ.update({"TTS_BACKEND": "local", "FORCE_REBUILD": "1"})
+    cpu, child_cpu = time.process_time(), metrics.children_cpu()
+    seconds, items, unit = BENCHMARKS[name][0](base, options)
+    self_usage = resource.getrusage(resource.RUSAGE_SELF)
+    child_usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return {
+        "seconds": round(seconds, 4),
+        "items": items,
+        "unit": unit,
+        "throughput": round(items / seconds, 3) if seconds > 0 else None,
+        "cpu": round(time.process_time() - cpu, 4),
+        "children_cpu": round(metrics.children_cpu() - child_cpu, 4),
+        "peak_rss_mb": round(self_usage.ru_maxrss / 1024, 1),             # ru_maxrss is in KiB on Linux
+        "peak_child_rss_mb": round(child_usage.ru_maxrss / 1024, 1),      # largest ffmpeg / render worker
+        "metrics": metrics.METRICS.summary(),
+    }
+
+
+def run_benchmark(name, base, options):
+    context = multiprocessing.get_context("spawn")
+    with ProcessPoolExecutor(max_workers=1, mp_context=context) as pool:
+        return pool.submit(run_isolated, name, base, options).result()
+
+
+def aggregate(runs):
+    """Median time/throughput over the repeats (robust to one noisy run), worst-case memory."""
+    seconds = [run["seconds"] for run in runs]
+    best = min(runs, key=lambda run: abs(run["seconds"] - statistics.median(seconds)))
+    return {
+        **{k: v for k, v in best.items() if k != "seconds"},
+        "seconds": round(statistics.median(seconds), 4),
+        "seconds_min": min(seconds),
+        "seconds_max": max(seconds),
+        "throughput": round(best["items"] / statistics.median(seconds), 3) if statistics.median(seconds) > 0 else None,
+        "peak_rss_mb": max(run["peak_rss_mb"] for run in runs),
+        "peak_child_rss_mb": max(run["peak_child_rss_mb"] for run in runs),
+        "repeats": len(runs),
+    }
+
+
+# ========= ENVIRONMENT =========
+def command_output(cmd, cwd=None):
+    try:
+        return subprocess.run(cmd, capture_output=True, text=True, cwd=cwd, check=True).stdout.splitlines()[0]
+    except (OSError, subprocess.CalledProcessError, IndexError):
+        return None
+
+
+def environment():
+    """What a result depends on besides the code: interpreter, machine, ffmpeg build and commit."""
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "cpu_count": os.cpu_count(),
+        "ffmpeg": command_output(["ffmpeg", "-version"]),
+        "commit": command_output(["git", "rev-parse", "--short", "HEAD"], cwd=REPO_DIR),
+    }
+
+
+# ========= REPORT =========
+def print_table(results, previous=None):
+    log(f"{'benchmark':<10} {'seconds':>9} {'throughput':>24} {'peak MB':>8} {'child MB':>9}"
+        + ("  vs previous" if previous else ""))
+    for name, r in results.items():
+        line = (f"{name:<10} {r['seconds']:>9.3f} {r['throughput'] or 0:>11.2f} {r['unit'] + '/s':<12}"
+                f" {r['peak_rss_mb']:>8.1f} {r['peak_child_rss_mb']:>9.1f}")
+        before = (previous or {}).get(name)
+        if before and before.get("throughput") and r["throughput"]:
+            line += f"  {100 * (r['throughput'] / before['throughput'] - 1):+6.1f}% throughput"
+            line += f", {r['peak_rss_mb'] - before['peak_rss_mb']:+.1f} MB"
+        log(line)
+
+
+def load_previous(path, report):
+    """Results of an earlier run, if it measured the same thing; None (with a warning) otherwise."""
+    with open(path, "r", encoding="utf-8") as f:
+        previous = json.load(f)
+    for field in ("version", "spec", "options"):
+        if previous.get(field) != report[field]:
+            log(f"WARNING: {path} differs in {field} ({previous.get(field)} vs {report[field]}); not comparable.")
+            return None
+    if previous.get("environment", {}).get("cpu_count") != report["environment"]["cpu_count"]:
+        log(f"WARNING: {path} was measured on a machine with a different CPU count.")
+    return previous["results"]
+
+
+# ========= MAIN =========
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Benchmark each stage and the full pipeline on synthetic question banks (offline TTS).")
+    parser.add_argument("benchmarks", nargs="*", metavar="BENCHMARK",
+                        help=f"Benchmarks to run (default: all of {', '.join(BENCHMARKS)})")
+    parser.add_argument("--preset", choices=PRESETS, default="medium",
+                        help="Bank size: " + ", ".join(f"{k}={s}x{q} questions" for k, (s, q, _) in PRESETS.items()))
+    parser.add_argument("--scripts", type=int, help="Audio scripts in the bank (overrides the preset)")
+    parser.add_argument("--questions", type=int, help="Questions per script (overrides the preset)")
+    parser.add_argument("--words", type=int, help="Narration words per script (overrides the preset)")
+    parser.add_argument("--question-words", type=int, default=12, help="Upper bound of words per question")
+    parser.add_argument("--option-d", type=float, default=0.5, help="Share of questions with an option D")
+    parser.add_argument("--seed", type=int, default=0, help="Bank generator seed")
+    parser.add_argument("--repeat", type=int, default=3, help="Runs per benchmark; the median is reported")
+    parser.add_argument("--rounds", type=int, default=20, help="Passes over the bank in the parse/wrap benchmarks")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Card render processes")
+    parser.add_argument("--mode", choices=("segments", "timeline", "stream"), default=os.getenv("RENDER_MODE", "segments"),
+                        help="Render mode of the full-pipeline benchmark (env RENDER_MODE)")
+    parser.add_argument("--workdir", default=DEFAULT_WORKDIR, help="Scratch folder for banks and outputs (env BENCH_DIR)")
+    parser.add_argument("--output", default=None, help="Results JSON (default: <workdir>/results/<timestamp>.json)")
+    parser.add_argument("--compare", default=None, help="Earlier results JSON to compare against")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    unknown = [name for name in args.benchmarks if name not in BENCHMARKS]
+    if unknown:
+        log(f"ERROR: unknown benchmark(s) {', '.join(unknown)}; choose from {', '.join(BENCHMARKS)}")
+        exit(2)
+    scripts, questions, words = PRESETS[args.preset]
+    spec = BankSpec(args.scripts or scripts, args.questions or questions, args.words or words,
+                    args.question_words, args.option_d, args.seed)
+    options = {"rounds": args.rounds, "workers": args.workers, "mode": args.mode}
+    selected = args.benchmarks or list(BENCHMARKS)
+
+    log(f"=== KNM Benchmarks: {spec.scripts} scripts x {spec.questions} questions, {spec.words} words ===")
+    base = write_bank(spec, os.path.join(args.workdir, "bank"))
+
+    report = {
+        "version": BENCH_VERSION,
+        "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "spec": asdict(spec),
+        "options": options,
+        "environment": environment(),
+        "results": {},
+    }
+    done = set()
+
+    def prepare(name):
+        for required in BENCHMARKS[name][1]:
+            if required not in done:
+                prepare(required)
+                log(f"Preparing {required} outputs for {name} (not timed)...")
+                run_benchmark(required, base, options)
+                done.add(required)
+
+    for name in selected:
+        prepare(name)
+        runs = []
+        for i in range(max(1, args.repeat)):
+            log(f"Benchmark {name} run {i + 1}/{max(1, args.repeat)}...")
+            runs.append(run_benchmark(name, base, options))
+        report["results"][name] = aggregate(runs)
+        done.add(name)
+
+    output = args.output or os.path.join(args.workdir, "results", time.strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(output) or ".", exist_ok=True)
+    with open(output, "w", encoding="utf-8") as f:
+        json.dump(report, f, indent=1)
+
+    previous = load_previous(args.compare, report) if args.compare else None
+    print_table(report["results"], previous)
+    log(f"Results written: {output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+import os
+import json
+import hashlib
+import threading
+
+# ========= CONFIGURATION =========
+STATE_VERSION = 1  # bump to invalidate every recorded artifact
+
+
+# ========= LOG =========
+def log(msg): print(f"[DEBUG] {msg}")
+
+
+# ========= DIGESTS =========
+def digest(*parts):
+    """Stable hash of JSON-serializable inputs (texts, records, settings, file digests)."""
+    payload = json.dumps([STATE_VERSION, *parts], sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def hash_file(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+# ========= STATE =========
+class BuildState:
+    """Input digests of one stage's artifacts, persisted as JSON.
+
+    An artifact is up to date when it exists and was last built from the same
+    input digest: stages check fresh() before building and record() after a
+    successful build. File contents are hashed once and memoized by
+    (size, mtime), so unchanged inputs are not re-read on later runs.
+    """
+
+    def __init__(self, path, force=False):
+        self.path = path
+        self.force = force
+        self.lock = threading.Lock()
+        self.artifacts, self.files = {}, {}
+        self.skipped = self.built = 0
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    data = json.load(f)
+                if data.get("version") == STATE_VERSION:
+                    self.artifacts, self.files = data["artifacts"], data["files"]
+            except (ValueError, KeyError, TypeError) as e:
+                log(f"Ignoring unreadable build state {path}: {e}")
+
+    def file_digest(self, path):
+        """Content hash of an input file, or None if it does not exist."""
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        key = os.path.abspath(path)
+        with self.lock:
+            cached = self.files.get(key)
+        if cached and cached[0] == st.st_size and cached[1] == st.st_mtime_ns:
+            return cached[2]
+        value = hash_file(path)
+        with self.lock:
+            self.files[key] = [st.st_size, st.st_mtime_ns, value]
+        return value
+
+    def fresh(self, artifact, key):
+        """True if artifact exists and was built from inputs with this digest."""
+        with self.lock:
+            ok = not self.force and os.path.exists(artifact) and self.artifacts.get(os.path.abspath(artifact)) == key
+            if ok:
+                self.skipped += 1
+        return ok
+
+    def record(self, artifact, key):
+        with self.lock:
+            self.artifacts[os.path.abspath(artifact)] = key
+            self.built += 1
+
+    def save(self):
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.{threading.get_ident()}.tmp"  # one per writer thread
+            with self.lock, open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"version": STATE_VERSION, "artifacts": self.artifacts, "files": self.files}, f, indent=1)
+            os.replace(tmp, self.path)
+        except OSError as e:
+            log(f"Could not write build state {self.path}: {e}")
+
+    def summary(self):
+        return f"Build state: {self.built} built, {self.skipped} up to date ({self.path})"
+
+
+def stage_state(stage, base, force=None, state_dir=None):
+    """BuildState for one pipeline stage, stored under <base>/.build (env BUILD_STATE_DIR).
+
+    An explicit state_dir wins over both, for runs that must keep their own
+    state (service jobs, drafts). force defaults to env FORCE_REBUILD=1 and
+    rebuilds every artifact.
+    """
+    state_dir = state_dir or os.getenv("BUILD_STATE_DIR") or os.path.join(base, ".build")
+    if force is None:
+        force = os.getenv("FORCE_REBUILD") == "1"
+    return BuildState(os.path.join(state_dir, f"{stage}.json"), force)
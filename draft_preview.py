@@ -0,0 +1,175 @@
+import os
+import time
+import shutil
+import argparse
+import dataclasses
+
+import generate_question_images as cards
+import streaming_pipeline
+import metrics
+from build_state import digest
+from input_parser import load_sections
+from streaming_pipeline import StreamingPipeline, render_video
+from generate_video_segments_and_merge import (
+    log, pairs_for_images, frame_digest, create_still_segment, STILL_FRAME_RATE,
+)
+
+# ========= CONFIGURATION =========
+# Proxy format: every draft segment is encoded like this, so sections and the
+# draft video are joined by stream copy.
+DRAFT_SIZE = (640, 360)
+DRAFT_VIDEO_ARGS = [
+    "-c:v", "libx264", "-preset", "ultrafast", "-crf", "30", "-tune", "stillimage", "-pix_fmt", "yuv420p", "-bf", "0",
+    "-r", str(STILL_FRAME_RATE), "-x264-params", "keyint=infinite:scenecut=0",
+]
+DRAFT_AUDIO_ARGS = ["-c:a", "aac", "-b:a", "64k", "-ar", "24000", "-ac", "1"]
+CARD_REDUCE = int(os.getenv("DRAFT_CARD_REDUCE", "2"))  # cards are drawn, then shrunk by this factor
+
+
+def parse_args(argv=None):
+    """Draft options; anything else is passed on to the streaming pipeline (e.g. --voice-male, --render-workers)."""
+    parser = argparse.ArgumentParser(
+        description="Fast low-resolution preview of selected sections, for reviewing wording and layout.",
+        epilog="Other options are those of streaming_pipeline.py.")
+    parser.add_argument("--input", default="/data/input.txt", help="Input file with audio scripts/questions")
+    parser.add_argument("--data", default="/data", help="Base project folder (scenes/, sounds/)")
+    parser.add_argument("--scenes", default=None, help="Scenes folder (default: <data>/scenes)")
+    parser.add_argument("--select", default=os.getenv("DRAFT_SELECT", ""),
+                        help="Sections to render: script ids and script:question pairs, e.g. '3,5:2,5:4' "
+                             "(default: all; env DRAFT_SELECT)")
+    parser.add_argument("--draft-dir", default=os.getenv("DRAFT_DIR"),
+                        help="Working folder of the preview, kept apart from the real outputs (default: <data>/draft)")
+    parser.add_argument("--reduce", type=int, default=CARD_REDUCE,
+                        help="Card shrink factor (env DRAFT_CARD_REDUCE)")
+    return parser.parse_known_args(argv)
+
+
+# ========= SELECTION =========
+def parse_selection(text):
+    """'3,5:2' -> {3: None, 5: {2}}: None selects the whole script, a set only those questions."""
+    selection = {}
+    for part in (p.strip() for p in text.split(",") if p.strip()):
+        script, _, question = part.partition(":")
+        try:
+            sid = int(script)
+            qid = int(question) if question else None
+        except ValueError:
+            raise ValueError(f"bad selection '{part}' (expected a script id or script:question, e.g. 5:2)")
+        if qid is None:
+            selection[sid] = None
+        elif selection.get(sid, set()) is not None:
+            selection.setdefault(sid, set()).add(qid)
+    return selection
+
+
+def select_sections(sections, selection):
+    """Selected sections, each with only its selected questions; fails on ids that are not in the input."""
+    if not selection:
+        return list(sections)
+    by_id = {section.script_id: section for section in sections}
+    missing = sorted(set(selection) - set(by_id))
+    if missing:
+        raise ValueError(f"script(s) {', '.join(map(str, missing))} not in the input (has {', '.join(map(str, by_id))})")
+    chosen = []
+    for sid in sorted(selection):
+        section, qids = by_id[sid], selection[sid]
+        if qids is not None:
+            unknown = sorted(qids - {q.id for q in section.questions})
+            if unknown:
+                raise ValueError(f"script {sid} has no question(s) {', '.join(map(str, unknown))}")
+            section = dataclasses.replace(section, questions=[q for q in section.questions if q.id in qids])
+        chosen.append(section)
+    return chosen
+
+
+# ========= PIPELINE =========
+class DraftPipeline(StreamingPipeline):
+    """The streaming pipeline with proxy settings.
+
+    TTS comes from the cache or the offline stand-in (draft backend), cards are
+    rendered as shrunk raw frames, every segment is one ultrafast low-resolution
+    encode and sections are joined by stream copy. There is no intro, loudness
+    pass or merge re-encode. A section picked by question only shows those
+    questions, without its narration.
+    """
+
+    def __init__(self, args, selection, reduce=CARD_REDUCE):
+        super().__init__(args)
+        self.selection = selection
+        self.reduce = max(1, reduce)
+
+    def items(self):
+        sections = select_sections(load_sections(self.args.input), self.selection)
+        return [streaming_pipeline.WorkItem(i, f"script {section.script_id:02d}", section)
+                for i, section in enumerate(sections, 1)]
+
+    def render(self, item):
+        tasks = cards.build_tasks([item.section], self.paths.images, self.scenes)
+        if self.selection.get(item.section.script_id) is not None:
+            tasks = [task for task in tasks if task[0] != "scene"]  # questions only: skip the narration slide
+        futures = [self.render_pool.submit(metrics.call_timed, cards.render_frames, task, False, self.reduce)
+                   for task in tasks]
+        item.frames = cards.collect_frames(tasks, futures)
+        item.pairs = pairs_for_images(list(item.frames), self.paths)
+
+    def encode(self, item):
+        state = self.states["segments"]
+        try:
+            for img, aud, out in item.pairs:
+                key = digest("draft", frame_digest(item.frames[img]), state.file_digest(aud),
+                             DRAFT_SIZE, DRAFT_VIDEO_ARGS, DRAFT_AUDIO_ARGS)
+                if not state.fresh(out, key):
+                    create_still_segment(img, aud, out, self.args.ffmpeg_threads, frame=item.frames[img],
+                                         size=DRAFT_SIZE, video_args=DRAFT_VIDEO_ARGS,
+                                         audio_codec_args=DRAFT_AUDIO_ARGS)
+                    state.record(out, key)
+        finally:
+            item.frames.release()
+            item.frames = None
+
+
+def draft_args(args, extra):
+    """Streaming-pipeline arguments of a draft run, working in the draft folder."""
+    draft_dir = args.draft_dir or os.path.join(args.data, "draft")
+    stream_args = streaming_pipeline.parse_args(
+        ["--input", args.input, "--data", draft_dir, "--scenes", args.scenes or os.path.join(args.data, "scenes"),
+         "--tts-backend", "draft", "--no-loudness", "--still", "--frames"] + extra)
+    stream_args.state_dir = os.path.join(draft_dir, ".build")  # never the real state, whatever BUILD_STATE_DIR says
+    stream_args.phrase_splice = False  # fragments belong to real renders
+    sounds = os.path.join(draft_dir, "sounds")
+    answer = os.path.join(args.data, "sounds", "answer.mp3")
+    if os.path.exists(answer) and not os.path.exists(os.path.join(sounds, "answer.mp3")):
+        os.makedirs(sounds, exist_ok=True)
+        shutil.copy(answer, sounds)
+    return stream_args
+
+
+# ========= MAIN =========
+def main(argv=None):
+    args, extra = parse_args(argv)
+    log("=== KNM Draft Preview ===")
+    try:
+        selection = parse_selection(args.select)
+        pipeline = DraftPipeline(draft_args(args, extra), selection, args.reduce)
+        started = time.time()
+        final, finished = render_video(pipeline)
+    except ValueError as e:
+        log(f"ERROR: {e}")
+        exit(1)
+
+    failed = [item for item in finished if item.error]
+    if failed:
+        log(f"{len(failed)} of {len(finished)} sections failed:")
+        for item in failed:
+            log(f"  {item.label}: {item.error}")
+    if not final:
+        log("No draft written: every section failed." if failed else "Nothing to preview. Check input.txt and --select.")
+        exit(1)
+    seconds = time.time() - started
+    log(f"Draft of {len(finished)} section(s) in {seconds:.1f}s ({seconds / max(1, len(finished)):.1f}s per section): {final}")
+    if failed:
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,52 +1,37 @@
 #!/bin/bash
 # ============================================================
 #  KNM Listening Practice – Automated Full Pipeline Entrypoint
-#  Generates audio, images, segments
-#   Normalizes & merges all clips automatically
+#  Runs every stage (intro, audio, images, render, merge) in one
+#  Python process: python -m pipeline all (see pipeline.py)
+#   RENDER_MODE=segments|timeline|stream|sharded selects the render path
+#   "service" and "draft" as first argument start the render service
+#   or a quick review proxy instead
 #   Saves final video to /data/final_video/
 # ============================================================
 
 set -euo pipefail
 
-echo "KNM Video Generation Pipeline Started"
-
-# ----  Check input mount ----
-if [ ! -d "/data" ]; then
-  echo " ERROR: /data directory not mounted."
-  echo "   Use: -v \$(pwd):/data"
-  exit 1
+# ---- Service mode: keep rendering job folders from the spool (see render_service.py) ----
+if [[ "${1:-}" == "service" ]]; then
+  shift
+  cd /app
+  exec python3 -m pipeline service "$@"
 fi
 
-if [ ! -f "/data/input.txt" ]; then
-  echo " ERROR: /data/input.txt not found."
-  echo "   Place your input.txt inside your mounted project folder."
-  exit 1
+# ---- Draft mode: quick proxy of selected sections for review (see draft_preview.py) ----
+if [[ "${1:-}" == "draft" ]]; then
+  shift
+  cd /app
+  exec python3 -m pipeline draft --data /data --input /data/input.txt "$@"
 fi
 
-# ----   Prepare directories ----
-mkdir -p /data/output_audio /data/output_images /data/segments /data/final_video /data/scenes /data/sounds
-echo " Output directories prepared."
-
-# ----  Run generation stages ----
-echo "  Step 1: Generating intro..."
-python3 /app/generate_intro.py --input /data/input.txt --output /data/output_audio
-
-echo " Step 2: Generating audio segments..."
-python3 /app/generate_audio_segments_multi_voice.py --input /data/input.txt --output /data/output_audio
-
-echo "  Step 3: Creating question images..."
-python3 /app/generate_question_images.py --input /data/input.txt --output /data/output_images
-
-echo "  Step 4: Creating video segments..."
-python3 /app/generate_video_segments_and_merge.py --data /data
+echo "KNM Video Generation Pipeline Started"
 
-# ----  Normalize & merge final video ----
-echo " Step 5: Normalizing and merging final video..."
-bash /app/normalize_segments_and_merge_final.sh
+cd /app
+python3 -m pipeline all --data /data --input /data/input.txt "$@"
 
 # ----  Completion message ----
 echo "------------------------------------------------------------"
 echo " All stages completed successfully!"
 echo " Final video available at: /data/final_video/final_video.mp4"
 echo "------------------------------------------------------------"
-
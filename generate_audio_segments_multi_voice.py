@@ -1,129 +1,251 @@
 import os, argparse
-import re
 import time
-import azure.cognitiveservices.speech as speechsdk
+from collections import namedtuple
+from concurrent.futures import ThreadPoolExecutor
+from input_parser import load_sections
+from build_state import digest, stage_state
+from tts_cache import TTSCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_MB
+from tts_backends import build_ssml, build_section_ssml, get_backend, add_backend_args
+from phrase_splice import splicer_from_args, DEFAULT_FRAGMENT_DIR, DEFAULT_PROSODY_SAMPLE
 
 # =============================
 # CONFIGURATION
 # =============================
-parser = argparse.ArgumentParser()
-parser.add_argument("--input", default="/data/input.txt", help="Path to input file")
-parser.add_argument("--output", default="/data/output_audio", help="Directory to save audio")
-args = parser.parse_args()
+def add_tts_args(parser):
+    """TTS cache, concurrency and backend options (shared with streaming_pipeline)."""
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="Directory for the content-addressed TTS cache")
+    parser.add_argument("--cache-max-mb", type=int, default=DEFAULT_MAX_MB, help="Size cap of the TTS cache (LRU eviction)")
+    parser.add_argument("--no-cache", action="store_true", help="Always call the TTS backend, bypassing the cache")
+    parser.add_argument("--concurrency", type=int, default=int(os.getenv("TTS_CONCURRENCY", "1")),
+                        help="Max in-flight TTS requests (1 = sequential)")
+    parser.add_argument("--rps", type=float, default=float(os.getenv("AZURE_TTS_RPS", "3")),
+                        help="Requests-per-second quota for concurrent mode (token bucket)")
+    parser.add_argument("--batched", action="store_true", default=os.getenv("TTS_BATCHED") == "1",
+                        help="One bookmarked SSML request per section, split into the per-file WAVs (env TTS_BATCHED=1)")
+    parser.add_argument("--voice-male", default=VOICE_MALE, help="Narration voice (env VOICE_MALE)")
+    parser.add_argument("--voice-female", default=VOICE_FEMALE, help="Question voice (env VOICE_FEMALE)")
+    parser.add_argument("--speech-rate", default=SPEECH_RATE, help="SSML prosody rate, e.g. -10%% (env SPEECH_RATE)")
+    parser.add_argument("--phrase-splice", action="store_true", default=os.getenv("TTS_PHRASE_SPLICE") == "1",
+                        help="Synthesize question prompts as shared fragments (question, 'Optie A:', option texts) "
+                             "and splice the PCM (env TTS_PHRASE_SPLICE=1)")
+    parser.add_argument("--fragment-dir", default=DEFAULT_FRAGMENT_DIR,
+                        help="Store of synthesized fragments (default: .tts_fragments next to --cache-dir; env TTS_FRAGMENT_DIR)")
+    parser.add_argument("--prosody-sample", type=int, default=DEFAULT_PROSODY_SAMPLE,
+                        help="Prompts per voice also synthesized whole to check the splice's prosody (env PROSODY_SAMPLE)")
+    add_backend_args(parser)
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="/data/input.txt", help="Path to input file")
+    parser.add_argument("--output", default="/data/output_audio", help="Directory to save audio")
+    parser.add_argument("--force", action="store_true", default=None,
+                        help="Re-synthesize every file, even if its text, voice and rate are unchanged (env FORCE_REBUILD=1)")
+    add_tts_args(parser)
+    return parser.parse_args(argv)
+
+
+VOICE_MALE = os.getenv("VOICE_MALE", "nl-NL-MaartenNeural")      # Dutch male voice
+VOICE_FEMALE = os.getenv("VOICE_FEMALE", "nl-NL-ColetteNeural")  # Dutch female voice
+SPEECH_RATE = os.getenv("SPEECH_RATE", "0%")                     # can adjust to "-10%" if slower needed
+TARGET_SCRIPT_DURATION = 60           # seconds (optional target)
 
-INPUT_FILE = args.input
-OUTPUT_DIR = args.output
+# Voice configuration of one run; jobs sharing a process can each bring their own
+Voices = namedtuple("Voices", "male female rate")
+DEFAULT_VOICES = Voices(VOICE_MALE, VOICE_FEMALE, SPEECH_RATE)
 
-VOICE_MALE = "nl-NL-MaartenNeural"    # Dutch male voice
-VOICE_FEMALE = "nl-NL-ColetteNeural"  # Dutch female voice
-SPEECH_RATE = "0%"                    # can adjust to "-10%" if slower needed
-TARGET_SCRIPT_DURATION = 60           # seconds (optional target)
+
+def voices_from_args(args):
+    return Voices(args.voice_male, args.voice_female, args.speech_rate)
 
 # =============================
-# AZURE SETUP
+# TTS SYNTHESIS
 # =============================
 
-SPEECH_KEY = os.getenv("AZURE_SPEECH_KEY")
-SPEECH_REGION = os.getenv("AZURE_SPEECH_REGION")
-
-def get_speech_synthesizer(voice_name):
-    """Returns a speech config for the given voice."""
-    if not SPEECH_KEY or not SPEECH_REGION:
-        raise EnvironmentError("Please set Azure Speech credentials.")
-
-    speech_config = speechsdk.SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION)
-    speech_config.speech_synthesis_voice_name = voice_name
-    return speech_config
-
-
-def synthesize_text_to_file(text, output_path, voice_name):
-    """Generate audio file from text using Azure TTS with the selected voice."""
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    speech_config = get_speech_synthesizer(voice_name)
-    audio_config = speechsdk.audio.AudioOutputConfig(filename=output_path)
-    synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=audio_config)
-
-    # Build SSML string with rate and prosody
-    text_ssml = f"""
-    <speak version='1.0' xml:lang='nl-NL'>
-        <voice name='{voice_name}'>
-            <prosody rate='{SPEECH_RATE}'>{text}</prosody>
-        </voice>
-    </speak>
+def question_prompt(q):
+    """Spoken form of a question: the question followed by every option."""
+    return " ".join([q.text] + [f"Optie {letter}: {text}." for letter, text in q.options])
+
+
+def synthesize_text_to_file(text, output_path, voice_name, backend, cache=None, rate=SPEECH_RATE):
+    """Generate audio file from text with the selected voice on the given TTS backend.
+
+    When a TTSCache is given, identical SSML is served from disk instead of the backend.
     """
+    text_ssml = build_ssml(text, voice_name, rate)
+    return backend.synthesize_to_file(text_ssml, voice_name, output_path, cache)
 
-    print(f"Generating with {voice_name}: {output_path}")
-    result = synthesizer.speak_ssml_async(text_ssml).get()
 
-    if result.reason == speechsdk.ResultReason.SynthesizingAudioCompleted:
-        print(f"Audio saved: {output_path}")
-    else:
-        print(f"Error generating {output_path}: {result.reason}")
+def synthesize_job(job, backend, cache, rate, splicer=None, question=None):
+    """One (text, path, voice) job; question prompts go through the splicer when there is one."""
+    text, path, voice = job
+    if splicer is not None and question is not None:
+        return splicer.synthesize(text, question, path, voice, rate, backend, cache)
+    return synthesize_text_to_file(text, path, voice, backend, cache, rate)
+
+
+def synthesize_section_batched(section, backend, cache, output_dir, voices=DEFAULT_VOICES):
+    """Narration and all questions of one section in a single bookmarked request."""
+    parts = section_jobs(section, output_dir, voices)
+    marks = [f"part_{i:02d}" for i in range(len(parts))]
+    ssml = build_section_ssml(
+        [(mark, voice, text) for mark, (text, _, voice) in zip(marks, parts)], voices.rate)
+    return backend.synthesize_marked_to_files(ssml, voices.male, marks[1:], [path for _, path, _ in parts], cache)
 
 
 # =============================
-# PARSER LOGIC
+# AUDIO GENERATION
 # =============================
 
-def parse_input_file(filename):
-    """Parses input.txt and returns a structured dictionary."""
-    with open(filename, "r", encoding="utf-8") as f:
-        content = f.read()
-
-    audio_blocks = re.findall(r"### AUDIO_SCRIPT_(\d+) ###(.*?)### QUESTIONS_\1 ###", content, re.S)
-    data = []
-
-    for idx, (script_id, block) in enumerate(audio_blocks, 1):
-        questions_block_match = re.search(rf"### QUESTIONS_{script_id} ###(.*?)(?=(### AUDIO_SCRIPT_|$))", content, re.S)
-        questions_block = questions_block_match.group(1).strip() if questions_block_match else ""
-
-        question_matches = re.findall(
-            r"Q\d+:\s*(.*?)\nA\.\s*(.*?)\nB\.\s*(.*?)\nC\.\s*(.*?)\nANSWER:\s*([A-C])",
-            questions_block, re.S
-        )
-
-        questions = []
-        for i, q in enumerate(question_matches, 1):
-            questions.append({
-                "id": i,
-                "q": q[0].strip(),
-                "A": q[1].strip(),
-                "B": q[2].strip(),
-                "C": q[3].strip(),
-                "answer": q[4].strip(),
-            })
-
-        data.append({
-            "script_id": int(script_id),
-            "audio_text": block.strip(),
-            "questions": questions
-        })
-    return data
+def section_jobs(section, output_dir, voices=DEFAULT_VOICES):
+    """Ordered (text, output_path, voice) jobs of one section: narration, then questions."""
+    sid = section.script_id
+    jobs = [(section.audio_text, os.path.join(output_dir, f"script_{sid:02d}.wav"), voices.male)]
+    for q in section.questions:
+        jobs.append((question_prompt(q), question_path(output_dir, sid, q), voices.female))
+    return jobs
+
+
+def question_path(output_dir, sid, q):
+    return os.path.join(output_dir, f"script_{sid:02d}_q{q.id:02d}.wav")
+
+
+def questions_by_path(sections, output_dir):
+    """{prompt WAV path: Question}, so a job can be spliced from its question's fragments."""
+    return {question_path(output_dir, s.script_id, q): q for s in sections for q in s.questions}
+
+
+def build_jobs(sections, output_dir, voices=DEFAULT_VOICES):
+    """Flatten sections into ordered (text, output_path, voice) synthesis jobs."""
+    return [job for section in sections for job in section_jobs(section, output_dir, voices)]
 
 
 # =============================
-# AUDIO GENERATION
+# INCREMENTAL BUILDS
 # =============================
 
-def main():
-    sections = parse_input_file(INPUT_FILE)
-    os.makedirs(OUTPUT_DIR, exist_ok=True)
+def job_key(text, voice, backend, batched=False, rate=SPEECH_RATE, spliced=False):
+    """Input digest of one WAV: its SSML (text, voice, rate), the engine and the request mode."""
+    mode = [batched, "spliced"] if spliced else [batched]
+    return digest("tts", build_ssml(text, voice, rate), backend.name, backend.output_format, *mode)
 
-    for section in sections:
-        sid = section["script_id"]
 
-        # === Audio Script (Male Voice) ===
-        script_path = os.path.join(OUTPUT_DIR, f"script_{sid:02d}.wav")
-        synthesize_text_to_file(section["audio_text"], script_path, VOICE_MALE)
+def stale_jobs(jobs, backend, state, batched=False, rate=SPEECH_RATE, spliced=()):
+    """(job, key) pairs whose WAV is missing or was built from different inputs.
 
-        # === Questions (Female Voice) ===
-        for q in section["questions"]:
-            q_text = f"{q['q']} Optie A: {q['A']}. Optie B: {q['B']}. Optie C: {q['C']}."
-            q_path = os.path.join(OUTPUT_DIR, f"script_{sid:02d}_q{q['id']:02d}.wav")
-            synthesize_text_to_file(q_text, q_path, VOICE_FEMALE)
+    spliced holds the output paths that go through the phrase splicer (question prompts).
+    """
+    keyed = [(job, job_key(job[0], job[2], backend, batched, rate, job[1] in spliced)) for job in jobs]
+    return [(job, key) for job, key in keyed if not state.fresh(job[1], key)]
 
-        print(f"Finished Script {sid}\n{'-'*60}")
-        time.sleep(2)  # small delay to avoid API rate limits
+
+def record_job(state, backend, path, key):
+    """Record a synthesized WAV; a stand-in (a draft's tone) gets a key no run expects, so it is redone."""
+    state.record(path, digest(key, "stand-in") if backend.is_stand_in(path) else key)
+
+
+def synthesize_section(section, backend, cache, state, output_dir, batched=False, voices=DEFAULT_VOICES,
+                       splicer=None):
+    """Synthesize the stale files of one section and record them; returns False on failure.
+
+    In batched mode the section is one request, so any stale file re-synthesizes the whole section.
+    """
+    jobs = section_jobs(section, output_dir, voices)
+    questions = questions_by_path([section], output_dir) if splicer is not None else {}
+    stale = stale_jobs(jobs, backend, state, batched, voices.rate, questions)
+    if not stale:
+        return True
+    if batched:
+        if not synthesize_section_batched(section, backend, cache, output_dir, voices):
+            return False
+        for job in jobs:
+            record_job(state, backend, job[1], job_key(job[0], job[2], backend, batched, voices.rate))
+        return True
+    ok = True
+    for job, key in stale:
+        if synthesize_job(job, backend, cache, voices.rate, splicer, questions.get(job[1])):
+            record_job(state, backend, job[1], key)
+        else:
+            ok = False
+    return ok
+
+
+def run_concurrent(sections, backend, cache, state, args, splicer=None):
+    """Synthesize all stale jobs with bounded concurrency (the backend pools synthesizers and rate-limits)."""
+    voices = voices_from_args(args)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as executor:
+        if args.batched:
+            print(f"Concurrent batched TTS: {len(sections)} sections, {args.concurrency} in flight, {args.rps} req/s")
+            futures = [
+                executor.submit(synthesize_section, section, backend, cache, state, args.output, True, voices)
+                for section in sections
+            ]
+            labels = [f"script {section.script_id}" for section in sections]
+        else:
+            questions = questions_by_path(sections, args.output) if splicer is not None else {}
+            stale = stale_jobs(build_jobs(sections, args.output, voices), backend, state,
+                               rate=voices.rate, spliced=questions)
+            print(f"Concurrent TTS: {len(stale)} utterances, {args.concurrency} in flight, {args.rps} req/s")
+
+            def synthesize(job, key):
+                ok = synthesize_job(job, backend, cache, voices.rate, splicer, questions.get(job[1]))
+                if ok:
+                    record_job(state, backend, job[1], key)
+                return ok
+
+            futures = [executor.submit(synthesize, job, key) for job, key in stale]
+            labels = [job[1] for job, _ in stale]
+        failed = [label for label, fut in zip(labels, futures) if not fut.result()]
+
+    if failed:
+        print(f"{len(failed)} TTS requests failed: {', '.join(failed)}")
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    sections = load_sections(args.input)
+    os.makedirs(args.output, exist_ok=True)
+    cache = None if args.no_cache else TTSCache(args.cache_dir, args.cache_max_mb)
+    state = stage_state("audio", os.path.dirname(os.path.abspath(args.output)), args.force)
+    splicer = splicer_from_args(args)
+
+    if args.concurrency > 1:
+        backend = get_backend(args.tts_backend, args.concurrency, args.rps)
+        try:
+            run_concurrent(sections, backend, cache, state, args, splicer)
+        finally:
+            state.save()
+        print(state.summary())
+        if cache is not None:
+            print(cache.summary())
+        if splicer is not None:
+            print(splicer.summary())
+        return
+
+    backend = get_backend(args.tts_backend)
+    try:
+        for section in sections:
+            sid = section.script_id
+            misses_before = cache.misses if cache else None
+            built_before = state.built
+
+            # Narration (male voice) and questions (female voice), stale files only
+            ok = synthesize_section(section, backend, cache, state, args.output, args.batched, voices_from_args(args),
+                                    splicer)
+            if ok and state.built == built_before:
+                print(f"Script {sid} up to date")
+                continue
+            print(f"Finished Script {sid}\n{'-'*60}")
+            if backend.remote and (cache is None or cache.misses != misses_before):
+                time.sleep(2)  # small delay to avoid API rate limits
+    finally:
+        state.save()
+
+    print(state.summary())
+    if cache is not None:
+        print(cache.summary())
+    if splicer is not None:
+        print(splicer.summary())
 
 
 if __name__ == "__main__":
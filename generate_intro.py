@@ -1,30 +1,28 @@
 import os
 import argparse
-from PIL import Image, ImageDraw, ImageFont
-import azure.cognitiveservices.speech as speechsdk
+from PIL import Image, ImageDraw
+from tts_backends import build_ssml, get_backend, add_backend_args
+from build_state import digest, stage_state
+from text_layout import load_font
 
 # ========= CLI ARGUMENTS =========
-parser = argparse.ArgumentParser(description="Generate intro image and audio for KNM video.")
-parser.add_argument("--input", default="/data/intro.txt", help="Path to intro text file")
-parser.add_argument("--output", default="/data/output_audio", help="Output directory for audio")
-parser.add_argument("--scenes", default="/data/scenes", help="Path to scenes folder")
-parser.add_argument("--voice", default="en-GB-SoniaNeural", help="Voice for TTS")
-args = parser.parse_args()
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate intro image and audio for KNM video.")
+    parser.add_argument("--input", default="/data/intro.txt", help="Path to intro text file")
+    parser.add_argument("--output", default="/data/output_audio", help="Output directory for audio")
+    parser.add_argument("--images", default="/data/output_images", help="Output directory for the intro image")
+    parser.add_argument("--scenes", default="/data/scenes", help="Path to scenes folder")
+    parser.add_argument("--voice", default="en-GB-SoniaNeural", help="Voice for TTS")
+    parser.add_argument("--force", action="store_true", default=None,
+                        help="Regenerate the intro even if its inputs are unchanged (env FORCE_REBUILD=1)")
+    parser.add_argument("--state-dir", default=None,
+                        help="Build state folder (default: .build next to --output; env BUILD_STATE_DIR)")
+    add_backend_args(parser)
+    return parser.parse_args(argv)
 
 # ========= PATHS =========
-INTRO_FILE = args.input
-AUDIO_OUT_DIR = args.output
-IMAGE_OUT_DIR = "/data/output_images"
-SCENE_IMG_PATH = os.path.join(args.scenes, "intro.png")
 FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
 
-os.makedirs(AUDIO_OUT_DIR, exist_ok=True)
-os.makedirs(IMAGE_OUT_DIR, exist_ok=True)
-
-# ========= AZURE SPEECH CONFIG =========
-SPEECH_KEY = os.getenv("AZURE_SPEECH_KEY")
-SPEECH_REGION = os.getenv("AZURE_SPEECH_REGION", "westeurope")
-
 def log(msg): 
     print(f"[DEBUG] {msg}")
 
@@ -38,8 +36,8 @@ def generate_intro_image(intro_text, out_path, scene_path):
     log(f"Generating intro image: {out_path}")
     base = Image.new("RGB", (1100, 600), (255, 255, 255))
     draw = ImageDraw.Draw(base)
-    font_title = ImageFont.truetype(FONT_PATH, 48)
-    font_sub = ImageFont.truetype(FONT_PATH, 28)
+    font_title = load_font(FONT_PATH, 48)
+    font_sub = load_font(FONT_PATH, 28)
 
     # Title
     draw.text((60, 20), "Listening Practice", fill=(0,0,0), font=font_title)
@@ -64,32 +62,50 @@ def generate_intro_image(intro_text, out_path, scene_path):
     log("Intro image created successfully!")
 
 # ========= AUDIO GENERATION =========
-def generate_intro_audio(text, out_path, voice):
-    if not SPEECH_KEY or not SPEECH_REGION:
-        raise EnvironmentError("Missing AZURE_SPEECH_KEY or AZURE_SPEECH_REGION")
-
+def generate_intro_audio(text, out_path, voice, backend):
     log(f"Generating intro audio: {out_path}")
-    speech_config = speechsdk.SpeechConfig(subscription=SPEECH_KEY, region=SPEECH_REGION)
-    speech_config.speech_synthesis_voice_name = voice
-    audio_config = speechsdk.audio.AudioOutputConfig(filename=out_path)
-    synthesizer = speechsdk.SpeechSynthesizer(speech_config=speech_config, audio_config=audio_config)
-    synthesizer.speak_text_async(text).get()
-    log("Intro audio generated successfully!")
+    ok = backend.synthesize_to_file(build_ssml(text, voice), voice, out_path)
+    log("Intro audio generated successfully!" if ok else "Intro audio synthesis failed!")
+    return ok
 
 # ========= MAIN =========
-if __name__ == "__main__":
+def main(argv=None):
+    args = parse_args(argv)
     log("=== Intro Media Generator (Docker-Compatible) ===")
 
-    if not os.path.exists(INTRO_FILE):
-        raise FileNotFoundError(f"Intro file not found: {INTRO_FILE}")
+    if not os.path.exists(args.input):
+        raise FileNotFoundError(f"Intro file not found: {args.input}")
 
-    with open(INTRO_FILE, "r", encoding="utf-8") as f:
+    with open(args.input, "r", encoding="utf-8") as f:
         intro_text = f.read().strip()
 
-    intro_image_path = os.path.join(IMAGE_OUT_DIR, "intro.png")
-    intro_audio_path = os.path.join(AUDIO_OUT_DIR, "intro.wav")
+    os.makedirs(args.output, exist_ok=True)
+    os.makedirs(args.images, exist_ok=True)
+    intro_image_path = os.path.join(args.images, "intro.png")
+    intro_audio_path = os.path.join(args.output, "intro.wav")
+    scene_path = os.path.join(args.scenes, "intro.png")
+
+    state = stage_state("intro", os.path.dirname(os.path.abspath(args.output)), args.force, args.state_dir)
 
-    generate_intro_image(intro_text, intro_image_path, SCENE_IMG_PATH)
-    generate_intro_audio(intro_text, intro_audio_path, args.voice)
+    # The image depends on the scene and on this script's drawing code
+    image_key = digest("intro_image", state.file_digest(scene_path), state.file_digest(__file__), FONT_PATH)
+    if state.fresh(intro_image_path, image_key):
+        log("Intro image up to date")
+    else:
+        generate_intro_image(intro_text, intro_image_path, scene_path)
+        state.record(intro_image_path, image_key)
+
+    backend = get_backend(args.tts_backend)
+    audio_key = digest("tts", build_ssml(intro_text, args.voice), backend.name, backend.output_format)
+    if state.fresh(intro_audio_path, audio_key):
+        log("Intro audio up to date")
+    else:
+        if generate_intro_audio(intro_text, intro_audio_path, args.voice, backend):
+            state.record(intro_audio_path, audio_key)
+    state.save()
 
     log("All intro assets (image + audio) created successfully!")
+
+
+if __name__ == "__main__":
+    main()
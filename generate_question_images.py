@@ -1,16 +1,25 @@
-import os, re, argparse
-from PIL import Image, ImageDraw, ImageFont
+import os, argparse
+from dataclasses import asdict
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import resource_tracker, shared_memory
+from PIL import Image, ImageDraw
+import text_layout
+from input_parser import load_sections
+from text_layout import get_layout, load_font
+from build_state import digest, hash_file, stage_state
+import metrics
 
 # ========= CONFIG =========
-parser = argparse.ArgumentParser()
-parser.add_argument("--input", default="/data/input.txt", help="Input file with audio scripts/questions")
-parser.add_argument("--output", default="/data/output_images", help="Output directory for question images")
-parser.add_argument("--scenes", default="/data/scenes", help="Path to scenes folder")
-args = parser.parse_args()
-
-INPUT_FILE = args.input
-OUTPUT_DIR = args.output
-SCENES_DIR = args.scenes
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--input", default="/data/input.txt", help="Input file with audio scripts/questions")
+    parser.add_argument("--output", default="/data/output_images", help="Output directory for question images")
+    parser.add_argument("--scenes", default="/data/scenes", help="Path to scenes folder")
+    parser.add_argument("--workers", type=int, default=int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 1)),
+                        help="Render processes (1 = render serially in this process)")
+    parser.add_argument("--force", action="store_true", default=None,
+                        help="Re-render every card, even if its inputs are unchanged (env FORCE_REBUILD=1)")
+    return parser.parse_args(argv)
 
 # ========= FONT CONFIGURATION =========
 FONT_PATH = "/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf"
@@ -22,13 +31,13 @@ HIGHLIGHT_COLOR   = (0, 150, 0)
 ANSWER_TEXT_COLOR = (255, 255, 255)
 BOUND_COLOR       = (255, 165, 0)   # full-frame orange border
 
+TEMPLATE_CACHE_SIZE = 32  # scene templates kept per renderer (a long-running service sees many scenes)
+
 CANVAS_SIZE  = (1100, 600)
 IMAGE_SIZE   = (400, 220)
 QUESTION_BOX = (40, 260, 480, 300)
 OPTIONS_X, OPTIONS_Y, OPTION_GAP = 550, 80, 80
 
-os.makedirs(OUTPUT_DIR, exist_ok=True)
-
 
 # ========= LOG =========
 def log(msg): print(f"[DEBUG] {msg}")
@@ -36,14 +45,8 @@ def log(msg): print(f"[DEBUG] {msg}")
 
 # ========= TEXT HELPERS =========
 def wrap_text(draw, text, font, max_width):
-    words, lines, line = text.split(), [], ""
-    for word in words:
-        test_line = (line + " " + word).strip()
-        w = draw.textbbox((0,0), test_line, font=font)[2]
-        if w <= max_width: line = test_line
-        else: lines.append(line); line = word
-    if line: lines.append(line)
-    return lines
+    """Greedy word wrap; widths come from the memoized per-font TextLayout."""
+    return get_layout(font).wrap(text, max_width)
 
 def draw_wrapped_text(draw, text, x, y, font, fill, max_width, line_spacing=8):
     for line in wrap_text(draw, text, font, max_width):
@@ -52,34 +55,6 @@ def draw_wrapped_text(draw, text, x, y, font, fill, max_width, line_spacing=8):
     return y
 
 
-# ========= PARSER =========
-def parse_input_file(filename):
-    with open(filename, "r", encoding="utf-8") as f: content = f.read()
-    blocks = re.findall(r"### AUDIO_SCRIPT_(\d+) ###(.*?)### QUESTIONS_\1 ###", content, re.S)
-    data=[]
-    for (sid, block) in blocks:
-        qblock = re.search(rf"### QUESTIONS_{sid} ###(.*?)(?=(### AUDIO_SCRIPT_|$))", content, re.S)
-        qblock = qblock.group(1).strip() if qblock else ""
-        qmatch = re.findall(
-            r"Q\d+:\s*(.*?)\nA\.\s*(.*?)\nB\.\s*(.*?)\nC\.\s*(.*?)\n(?:D\.\s*(.*?)\n)?ANSWER:\s*([A-D])",
-            qblock, re.S)
-        qlist=[]
-        for i,q in enumerate(qmatch,1):
-            qlist.append({
-                "id":i,
-                "q":q[0].strip(),
-                "A":q[1].strip(),"B":q[2].strip(),"C":q[3].strip(),
-                "D":q[4].strip() if q[4] else "",
-                "answer":q[5].strip()
-            })
-        data.append({
-            "script_id":int(sid),
-            "audio_text":block.strip(),
-            "questions":qlist
-        })
-    return data
-
-
 # ========= DRAW HELPERS =========
 def draw_scene_image(base, scene_img_path):
     """Paste top-left small image."""
@@ -108,75 +83,305 @@ def draw_full_border(draw):
     draw.rectangle([(0,0),(CANVAS_SIZE[0]-1,CANVAS_SIZE[1]-1)], outline=BOUND_COLOR, width=5)
 
 
+# ========= CARD RENDERER =========
+class CardRenderer:
+    """Renders cards from one cached base template per scene.
+
+    Fonts are loaded once; each template holds the white canvas, the resized
+    scene and the border, so a card only draws its own question/option layer.
+    Answer cards are derived from the rendered question card by repainting the
+    answer rows. Templates are keyed by the scene's content, so jobs with their
+    own copy of a scene still share its template, and the least recently used
+    ones are dropped beyond TEMPLATE_CACHE_SIZE.
+    """
+
+    def __init__(self):
+        self.font_q = load_font(FONT_PATH, 26)
+        self.font_o = load_font(FONT_PATH, 24)
+        self.templates = {}
+        self.scene_digests = {}
+
+    def scene_key(self, scene_img_path):
+        """Content digest of a scene file (None if missing), re-hashed only when size or mtime change."""
+        try:
+            st = os.stat(scene_img_path)
+        except OSError:
+            return None
+        stamp = (st.st_size, st.st_mtime_ns)
+        cached = self.scene_digests.get(scene_img_path)
+        if cached is None or cached[0] != stamp:
+            cached = self.scene_digests[scene_img_path] = (stamp, hash_file(scene_img_path))
+        return cached[1]
+
+    def template(self, scene_img_path):
+        """Canvas + scene + border for a scene, rebuilt only if the scene's content is new."""
+        key = self.scene_key(scene_img_path)
+        base = self.templates.pop(key, None)
+        if base is None:
+            base = Image.new("RGB", CANVAS_SIZE, (255,255,255))
+            draw_scene_image(base, scene_img_path)
+            draw_full_border(ImageDraw.Draw(base))
+        self.templates[key] = base  # most recently used last
+        while len(self.templates) > TEMPLATE_CACHE_SIZE:
+            del self.templates[next(iter(self.templates))]
+        return base
+
+    def question_card(self, scene_img_path, q):
+        """Returns (card, answer_rows); answer_rows are (y, line, width, height) of the answer option."""
+        base = self.template(scene_img_path).copy()
+        draw = ImageDraw.Draw(base)
+        fO = self.font_o
+
+        # Question text
+        qx,qy,w,_ = QUESTION_BOX
+        bottom = draw_wrapped_text(draw, q.text, qx, qy, self.font_q, TEXT_COLOR, w)
+
+        # Options
+        oy, answer_rows, layout = OPTIONS_Y, [], get_layout(fO)
+        for opt, text in q.options:
+            opt_text=f"{opt}. {text}"
+            for ln in wrap_text(draw,opt_text,fO,500):
+                draw.text((OPTIONS_X,oy),ln,fill=TEXT_COLOR,font=fO)
+                if opt==q.answer:
+                    tw, th = layout.line_box(ln)
+                    answer_rows.append((oy, ln, tw, th))
+                oy += fO.size + 8
+            oy += 15
+
+        if max(bottom, oy) > CANVAS_SIZE[1] - 5:
+            draw_full_border(draw)  # text ran into the frame
+        return base, answer_rows
+
+    def answer_card(self, question_card, answer_rows):
+        """Question card with the answer rows highlighted."""
+        base = question_card.copy()
+        draw = ImageDraw.Draw(base)
+        for oy, ln, tw, th in answer_rows:
+            draw.rectangle([(OPTIONS_X-10,oy-4),(OPTIONS_X+tw+10,oy+th+4)],
+                           fill=HIGHLIGHT_COLOR)
+            draw.text((OPTIONS_X,oy),ln,fill=ANSWER_TEXT_COLOR,font=self.font_o)
+        if answer_rows and answer_rows[-1][0] + answer_rows[-1][3] + 4 > CANVAS_SIZE[1] - 5:
+            draw_full_border(draw)
+        return base
+
+    def audio_scene(self, scene_img_path):
+        base = self.template(scene_img_path).copy()
+        draw_playing_icon(ImageDraw.Draw(base), 900, 120)
+        return base
+
+
+_renderer = None
+
+def get_renderer():
+    """Process-wide renderer, created on first use."""
+    global _renderer
+    if _renderer is None:
+        _renderer = CardRenderer()
+    return _renderer
+
+
 # ========= QUESTION IMAGE =========
 def create_question_card(scene_img_path, q, output_path, highlight_answer=False):
     log(f"Creating {output_path}")
-    base = Image.new("RGB", CANVAS_SIZE, (255,255,255))
-    draw = ImageDraw.Draw(base)
-    fQ = ImageFont.truetype(FONT_PATH, 26)
-    fO = ImageFont.truetype(FONT_PATH, 24)
-
-    draw_scene_image(base, scene_img_path)
-
-    # Question text
-    qx,qy,w,_ = QUESTION_BOX
-    draw_wrapped_text(draw, q["q"], qx, qy, fQ, TEXT_COLOR, w)
-
-    # Options
-    oy = OPTIONS_Y
-    for opt in ['A','B','C','D']:
-        if not q[opt]: continue
-        opt_text=f"{opt}. {q[opt]}"
-        for ln in wrap_text(draw,opt_text,fO,500):
-            if highlight_answer and opt==q['answer']:
-                tw = draw.textbbox((0,0),ln,font=fO)[2]
-                th = draw.textbbox((0,0),ln,font=fO)[3]
-                draw.rectangle([(OPTIONS_X-10,oy-4),(OPTIONS_X+tw+10,oy+th+4)],
-                               fill=HIGHLIGHT_COLOR)
-                draw.text((OPTIONS_X,oy),ln,fill=ANSWER_TEXT_COLOR,font=fO)
-            else:
-                draw.text((OPTIONS_X,oy),ln,fill=TEXT_COLOR,font=fO)
-            oy += fO.size + 8
-        oy += 15
-
-    draw_full_border(draw)
+    renderer = get_renderer()
+    base, answer_rows = renderer.question_card(scene_img_path, q)
+    if highlight_answer:
+        base = renderer.answer_card(base, answer_rows)
     base.save(output_path)
     log(f" Saved {output_path}")
 
 
+def create_question_cards(scene_img_path, q, output_path, answer_path):
+    """Question card and its answer card from a single render."""
+    log(f"Creating {output_path} + answer")
+    renderer = get_renderer()
+    base, answer_rows = renderer.question_card(scene_img_path, q)
+    base.save(output_path)
+    renderer.answer_card(base, answer_rows).save(answer_path)
+    log(f" Saved {output_path}, {answer_path}")
+
+
 # ========= AUDIO SCENE IMAGE =========
 def create_audio_scene_image(scene_img_path, sid, output_path_play):
     """Create one clean audio-playing image per scene."""
     log(f"Creating audio-playing scene: {output_path_play}")
-    base = Image.new("RGB", CANVAS_SIZE, (255,255,255))
-    draw = ImageDraw.Draw(base)
-
-    # Scene image + icon + border
-    draw_scene_image(base, scene_img_path)
-    draw_playing_icon(draw, 900, 120)
-    draw_full_border(draw)
-
-    base.save(output_path_play)
+    get_renderer().audio_scene(scene_img_path).save(output_path_play)
     log(f" Saved {output_path_play}")
 
 
-# ========= MAIN =========
-if __name__=="__main__":
-    log("=== KNM Exam Image Generator (Final v5: Single Playing Scene) ===")
-    data = parse_input_file(INPUT_FILE)
+# ========= PARALLEL RENDERING =========
+def build_tasks(data, output_dir, scenes_dir):
+    """One task per narration image and per question/answer pair, in scene order."""
+    tasks = []
     for sec in data:
-        sid = sec["script_id"]
-        scene = os.path.join(SCENES_DIR, f"scene_{sid:02d}.png")
+        sid = sec.script_id
+        scene = os.path.join(scenes_dir, f"scene_{sid:02d}.png")
 
         # Single narration image (playing state only)
-        audio_play = os.path.join(OUTPUT_DIR, f"script_{sid:02d}.png")
-        create_audio_scene_image(scene, sid, audio_play)
+        audio_play = os.path.join(output_dir, f"script_{sid:02d}.png")
+        tasks.append(("scene", scene, sid, audio_play))
 
         # Question & Answer images
-        for q in sec["questions"]:
-            qid=q["id"]
-            q_img = os.path.join(OUTPUT_DIR, f"script_{sid:02d}_q{qid:02d}.png")
-            a_img = os.path.join(OUTPUT_DIR, f"script_{sid:02d}_q{qid:02d}_answer.png")
-            create_question_card(scene,q,q_img,False)
-            create_question_card(scene,q,a_img,True)
+        for q in sec.questions:
+            qid=q.id
+            q_img = os.path.join(output_dir, f"script_{sid:02d}_q{qid:02d}.png")
+            a_img = os.path.join(output_dir, f"script_{sid:02d}_q{qid:02d}_answer.png")
+            tasks.append(("question", scene, q, q_img, a_img))
+    return tasks
+
+
+def layout_signature(state):
+    """Digest of everything that shapes a card besides its question: layout constants, font and renderer code."""
+    return digest(
+        CANVAS_SIZE, IMAGE_SIZE, QUESTION_BOX, OPTIONS_X, OPTIONS_Y, OPTION_GAP,
+        TEXT_COLOR, HIGHLIGHT_COLOR, ANSWER_TEXT_COLOR, BOUND_COLOR,
+        FONT_PATH, state.file_digest(FONT_PATH), state.file_digest(__file__), state.file_digest(text_layout.__file__),
+    )
+
+
+def task_key(task, state, layout):
+    """Input digest of a task: its scene file, its question record (if any) and the layout."""
+    kind, scene, *rest = task
+    if kind == "scene":
+        return digest("scene", state.file_digest(scene), layout)
+    return digest("question", asdict(rest[0]), state.file_digest(scene), layout)
+
+
+def task_outputs(task):
+    return [task[3]] if task[0] == "scene" else list(task[3:5])
+
+
+def stale_tasks(tasks, state, layout):
+    """(task, key) pairs with a missing output or changed inputs."""
+    keyed = [(task, task_key(task, state, layout)) for task in tasks]
+    return [(task, key) for task, key in keyed if not all(state.fresh(out, key) for out in task_outputs(task))]
+
+
+def render_frames(task, save=False, reduce=1):
+    """A task's cards as raw rgb24 frames in one shared memory block: (block name, [(png_path, (width, height))]).
+
+    Raw frames are what the pipe-fed segment encoder reads from stdin, so the
+    PNG encode/decode round trip is skipped unless the images are wanted
+    (save). Only the block's name travels back through the process pool;
+    SharedFrames maps the frames, which lie back to back in the block.
+    reduce > 1 shrinks each card by that factor (draft previews).
+    """
+    kind, scene, *rest = task
+    renderer = get_renderer()
+    if kind == "scene":
+        images = [(rest[1], renderer.audio_scene(scene))]
+    else:
+        q, q_path, a_path = rest
+        card, answer_rows = renderer.question_card(scene, q)
+        images = [(q_path, card), (a_path, renderer.answer_card(card, answer_rows))]
+    if reduce > 1:
+        images = [(path, img.reduce(reduce)) for path, img in images]
+    block = shared_memory.SharedMemory(create=True, size=sum(img.width * img.height * 3 for _, img in images))
+    resource_tracker.unregister(block._name, "shared_memory")  # the process that maps it frees it
+    offset = 0
+    for path, img in images:
+        if save:
+            img.save(path)
+        size = img.width * img.height * 3
+        block.buf[offset:offset + size] = img.tobytes()
+        offset += size
+    block.close()
+    return block.name, [(path, img.size) for path, img in images]
+
+
+class SharedFrames(dict):
+    """image path -> ((width, height), rgb24 memoryview) over the blocks render_frames() filled.
+
+    The views are handed to ffmpeg's stdin as they are, without a copy;
+    release() frees the blocks once the frames are encoded.
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.blocks = []
+
+    def attach(self, name, frames):
+        block = shared_memory.SharedMemory(name=name)
+        self.blocks.append(block)
+        offset = 0
+        for path, (w, h) in frames:
+            self[path] = ((w, h), block.buf[offset:offset + w * h * 3])
+            offset += w * h * 3
+
+    def release(self):
+        for _, view in self.values():
+            view.release()
+        self.clear()
+        for block in self.blocks:
+            block.close()
+            block.unlink()
+        self.blocks = []
+
+
+def collect_frames(tasks, futures):
+    """SharedFrames of submitted render_frames() tasks, in task order; if one failed, frees the rest and raises."""
+    frames, error = SharedFrames(), None
+    for task, future in zip(tasks, futures):
+        try:
+            rendered, seconds = future.result()
+        except Exception as e:
+            error = error or e
+            continue
+        record_render(task, seconds)
+        frames.attach(*rendered)
+    if error is not None:
+        frames.release()
+        raise error
+    return frames
+
+
+def run_task(task):
+    kind, scene, *rest = task
+    if kind == "scene":
+        create_audio_scene_image(scene, *rest)
+    else:
+        create_question_cards(scene, *rest)
+
+
+def record_render(task, seconds):
+    metrics.record("image", output=task[3], task=task[0], seconds=seconds)
+
+
+def render_all(tasks, workers):
+    """Render tasks serially or across a process pool (one warm renderer per worker)."""
+    if workers <= 1 or len(tasks) <= 1:
+        for task in tasks:
+            _, seconds = metrics.call_timed(run_task, task)
+            record_render(task, seconds)
+        return
+    # Contiguous chunks keep each worker on the same scenes, so templates get reused
+    chunksize = max(1, len(tasks) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=get_renderer) as pool:
+        timed = pool.map(metrics.call_timed, [run_task] * len(tasks), tasks, chunksize=chunksize)
+        for task, (_, seconds) in zip(tasks, timed):
+            record_render(task, seconds)
+
+
+# ========= MAIN =========
+def main(argv=None):
+    args = parse_args(argv)
+    os.makedirs(args.output, exist_ok=True)
+    log("=== KNM Exam Image Generator (Final v5: Single Playing Scene) ===")
+    data = load_sections(args.input)
+    tasks = build_tasks(data, args.output, args.scenes)
+
+    state = stage_state("images", os.path.dirname(os.path.abspath(args.output)), args.force)
+    stale = stale_tasks(tasks, state, layout_signature(state))
+
+    log(f"Rendering {len(stale)} of {len(tasks)} image tasks with {max(1, args.workers)} worker(s)")
+    render_all([task for task, _ in stale], args.workers)
+    for task, key in stale:
+        for out in task_outputs(task):
+            state.record(out, key)
+    state.save()
+    log(state.summary())
     log("All narration, question, and answer images generated successfully!")
+
+
+if __name__=="__main__":
+    main()
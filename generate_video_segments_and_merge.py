@@ -1,148 +1,439 @@
 import os
 import re
+import math
+import hashlib
+import argparse
 import subprocess
 from glob import glob
+from types import SimpleNamespace
+from concurrent.futures import ThreadPoolExecutor
+from wav_utils import wav_duration
+from build_state import digest, stage_state
+import metrics
 
 # ========= CONFIGURATION =========
-import argparse
-parser = argparse.ArgumentParser(description="Generate video segments and merge them for KNM pipeline.")
-parser.add_argument("--data", default="/data", help="Base project folder containing audio/images.")
-args = parser.parse_args()
+DEFAULT_FFMPEG_THREADS = int(os.getenv("FFMPEG_THREADS", "2"))
+
+# Final delivery format. Segments are encoded once with exactly these
+# parameters so the merge stage can stream-copy them (see
+# normalize_segments_and_merge_final.sh, which refuses mismatched inputs).
+# VIDEO_SIZE=1920x1080 gives renditions.py a 1080p rung without upscaling.
+VIDEO_SIZE = tuple(int(v) for v in os.getenv("VIDEO_SIZE", "1280x720").lower().split("x"))
+FRAME_RATE = 25
+GOP_SIZE = FRAME_RATE * 2
+VIDEO_CODEC_ARGS = [
+    "-c:v", "libx264", "-preset", "veryfast", "-crf", "20", "-tune", "stillimage",
+    "-profile:v", "high", "-pix_fmt", "yuv420p",
+    "-r", str(FRAME_RATE), "-g", str(GOP_SIZE), "-keyint_min", str(GOP_SIZE), "-sc_threshold", "0",
+]
+AUDIO_CODEC_ARGS = ["-c:a", "aac", "-b:a", "192k", "-ar", "44100", "-ac", "2"]
+
+# Still-image mode: a slide never changes, so encode a handful of frames per
+# second with a single IDR and let x264 emit skip frames for the rest.
+STILL_FRAME_RATE = int(os.getenv("STILL_FRAME_RATE", "5"))
+STILL_VIDEO_CODEC_ARGS = [
+    "-c:v", "libx264", "-preset", "veryfast", "-crf", "20", "-tune", "stillimage",
+    "-profile:v", "high", "-pix_fmt", "yuv420p", "-bf", "0",
+    "-r", str(STILL_FRAME_RATE), "-x264-params", "keyint=infinite:scenecut=0",
+]
+
+
+def default_jobs(ffmpeg_threads=DEFAULT_FFMPEG_THREADS):
+    """Concurrent encodes that fill the machine without oversubscribing it."""
+    return max(1, (os.cpu_count() or 1) // max(1, ffmpeg_threads))
 
-BASE = args.data
-AUDIO_DIR = os.path.join(BASE, "output_audio")
-IMAGE_DIR = os.path.join(BASE, "output_images")
-SOUNDS_DIR = os.path.join(BASE, "sounds")
-SEGMENTS_DIR = os.path.join(BASE, "segments")
-FINAL_DIR = os.path.join(BASE, "final_video")
 
-os.makedirs(SEGMENTS_DIR, exist_ok=True)
-os.makedirs(FINAL_DIR, exist_ok=True)
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Generate video segments and merge them for KNM pipeline.")
+    parser.add_argument("--data", default="/data", help="Base project folder containing audio/images.")
+    parser.add_argument("--ffmpeg-threads", type=int, default=DEFAULT_FFMPEG_THREADS,
+                        help="-threads passed to each ffmpeg encode (env FFMPEG_THREADS)")
+    parser.add_argument("--jobs", type=int, default=int(os.getenv("SEGMENT_JOBS", "0")),
+                        help="Concurrent ffmpeg encodes (default: CPU count / --ffmpeg-threads)")
+    parser.add_argument("--still", action="store_true", default=os.getenv("STILL_IMAGE") == "1",
+                        help="Still-image encoding: low frame rate, one keyframe, shared answer audio (env STILL_IMAGE=1)")
+    parser.add_argument("--loudness", dest="no_loudness", action="store_false",
+                        default=os.getenv("LOUDNESS_NORMALIZE", "0") != "1",
+                        help="Normalize the clips to EBU R128 loudness (env LOUDNESS_NORMALIZE=1)")
+    parser.add_argument("--no-loudness", dest="no_loudness", action="store_true",
+                        help="Keep the clips' own levels, even with LOUDNESS_NORMALIZE=1")
+    parser.add_argument("--force", action="store_true", default=None,
+                        help="Re-encode every segment, even if its inputs are unchanged (env FORCE_REBUILD=1)")
+    return parser.parse_args(argv)
 
-ANSWER_SOUND = os.path.join(SOUNDS_DIR, "answer.mp3")
-SILENT_FALLBACK = os.path.join(SOUNDS_DIR, "silent.wav")
+
+def data_paths(base):
+    """Folder layout under the data mount."""
+    sounds = os.path.join(base, "sounds")
+    return SimpleNamespace(
+        audio=os.path.join(base, "output_audio"),
+        images=os.path.join(base, "output_images"),
+        sounds=sounds,
+        segments=os.path.join(base, "segments"),
+        final=os.path.join(base, "final_video"),
+        answer_sound=os.path.join(sounds, "answer.mp3"),
+        silent=os.path.join(sounds, "silent.wav"),
+    )
 
 # ========= HELPERS =========
 def log(msg):
     print(f"[DEBUG] {msg}")
 
-def run_ffmpeg(cmd):
-    result = subprocess.run(cmd, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+def run_ffmpeg(cmd, stdin_data=None):
+    """Run an ffmpeg argument list, optionally feeding stdin_data; returns (ok, stderr text).
+
+    Progress is read from stdout (-progress pipe:1), so every call records its
+    duration, encode speed, encoded media time and output size as a metric.
+    """
+    output = cmd[-1]
+    with metrics.timed("ffmpeg", output=output) as event:
+        result = subprocess.run([cmd[0], "-progress", "pipe:1", "-nostats", *cmd[1:]],
+                                input=stdin_data, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        progress = ffmpeg_progress(result.stdout.decode(errors='ignore'))
+        event["ok"] = result.returncode == 0
+        event["speed"] = progress.get("speed")
+        event["out_seconds"] = progress.get("out_seconds")
+        if event["ok"] and os.path.isfile(output):
+            event["bytes"] = os.path.getsize(output)
+    stderr = result.stderr.decode(errors='ignore')
     if result.returncode != 0:
-        log(f"FFmpeg Error:\n{result.stderr.decode(errors='ignore')}")
-    return result.returncode == 0
+        log(f"FFmpeg Error:\n{stderr}")
+    return result.returncode == 0, stderr
+
+def ffmpeg_progress(text):
+    """Final speed (x realtime) and encoded seconds from -progress key=value output."""
+    values = dict(line.split("=", 1) for line in text.splitlines() if "=" in line)
+    progress = {}
+    try:
+        progress["speed"] = float(values.get("speed", "").strip().rstrip("x"))
+    except ValueError:
+        pass
+    try:
+        progress["out_seconds"] = int(values.get("out_time_us", "")) / 1e6
+    except ValueError:
+        pass
+    return progress
+
+def ffmpeg_error(stderr):
+    return stderr.strip().splitlines()[-1] if stderr.strip() else "ffmpeg failed"
 
-def create_video_segment(image_path, audio_path, output_path):
-    """Combine one image + one audio into a short mp4 segment."""
+def media_duration(path):
+    """Duration in seconds: WAV header when possible, ffprobe otherwise."""
+    if path.lower().endswith(".wav"):
+        return wav_duration(path)
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "csv=p=0", path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return float(result.stdout.decode().strip())
+
+def still_duration(audio_seconds, fps=STILL_FRAME_RATE):
+    """Audio length rounded up to a whole number of still frames."""
+    return math.ceil(audio_seconds * fps - 1e-6) / fps
+
+def audio_filters(gain_db=0.0, *filters):
+    """-af arguments: loudness gain first (if any), then the given filters."""
+    chain = ([f"volume={gain_db:.2f}dB"] if gain_db else []) + list(filters)
+    return ["-af", ",".join(chain)] if chain else []
+
+def image_input(image_path, fps, frame=None):
+    """(input args, filter prefix, stdin data) for a slide.
+
+    Without a frame the PNG is looped; with frame=((width, height), rgb24 buffer)
+    the single raw frame is read from stdin and cloned by tpad instead.
+    """
+    if frame is None:
+        return ["-loop", "1", "-framerate", str(fps), "-i", image_path], "", None
+    (w, h), data = frame
+    args = ["-f", "rawvideo", "-pix_fmt", "rgb24", "-video_size", f"{w}x{h}", "-framerate", str(fps), "-i", "pipe:0"]
+    return args, "tpad=stop=-1:stop_mode=clone,", memoryview(data)
+
+def frame_digest(frame):
+    (w, h), data = frame
+    sha = hashlib.sha256(f"{w}x{h}".encode("ascii"))
+    sha.update(data)  # a view into shared memory; hashed in place
+    return sha.hexdigest()
+
+def create_video_segment(image_path, audio_path, output_path, threads=DEFAULT_FFMPEG_THREADS, gain_db=0.0,
+                         frame=None):
+    """Combine one image + one audio into a short mp4 segment. Raises RuntimeError on failure."""
     log(f"Creating segment: {output_path}")
-    cmd = (
-        f'ffmpeg -y -loop 1 -i "{image_path}" -i "{audio_path}" '
-        f'-c:v libx264 -tune stillimage -pix_fmt yuv420p '
-        f'-shortest -vf "scale=1280:720" "{output_path}"'
-    )
-    run_ffmpeg(cmd)
+    width, height = VIDEO_SIZE
+    video_input, pad, stdin_data = image_input(image_path, FRAME_RATE, frame)
+    # -shortest overshoots by a few frames on a cloned pipe frame, so cap it at the audio length
+    duration_args = ["-t", f"{media_duration(audio_path):.6f}"] if frame else []
+    cmd = [
+        "ffmpeg", "-y", *video_input, "-i", audio_path,
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-vf", f"{pad}scale={width}:{height},setsar=1",
+        *audio_filters(gain_db),
+        *VIDEO_CODEC_ARGS, *AUDIO_CODEC_ARGS,
+        "-threads", str(threads),
+        *duration_args, "-shortest", output_path,
+    ]
+    ok, stderr = run_ffmpeg(cmd, stdin_data)
+    if not ok:
+        raise RuntimeError(ffmpeg_error(stderr))
     return output_path
 
-# ========= MATCHING LOGIC =========
-def match_images_and_audios():
-    """Find matching image/audio pairs and define segment order."""
-    pairs = []
 
-    #  Intro section
-    intro_img = os.path.join(IMAGE_DIR, "intro.png")
-    intro_aud = os.path.join(AUDIO_DIR, "intro.wav")
-    if os.path.exists(intro_img) and os.path.exists(intro_aud):
-        pairs.append((intro_img, intro_aud, os.path.join(SEGMENTS_DIR, "00_intro.mp4")))
+def create_still_segment(image_path, audio_path, output_path, threads=DEFAULT_FFMPEG_THREADS, encoded_audio=None,
+                         gain_db=0.0, frame=None, size=VIDEO_SIZE, video_args=STILL_VIDEO_CODEC_ARGS,
+                         audio_codec_args=AUDIO_CODEC_ARGS):
+    """Still-image segment: STILL_FRAME_RATE fps, one IDR, audio padded to the last frame.
+
+    encoded_audio=(path, seconds) reuses an already AAC-encoded, frame-padded
+    track (the shared answer sound) by stream copy instead of re-encoding it.
+    frame feeds the slide as raw RGB over stdin (see image_input). size,
+    video_args and audio_codec_args override the delivery format (drafts).
+    """
+    log(f"Creating still segment: {output_path}")
+    width, height = size
+    if encoded_audio:
+        audio_path, duration = encoded_audio
+        audio_args = ["-c:a", "copy"]
     else:
-        log("Intro image or audio missing, skipping intro section.")
+        duration = still_duration(media_duration(audio_path))
+        audio_args = [*audio_filters(gain_db, f"apad=whole_dur={duration:.6f}"), *audio_codec_args]
+    video_input, pad, stdin_data = image_input(image_path, STILL_FRAME_RATE, frame)
+    cmd = [
+        "ffmpeg", "-y", *video_input, "-i", audio_path,
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-vf", f"{pad}scale={width}:{height},setsar=1",
+        *video_args, *audio_args,
+        "-threads", str(threads),
+        "-t", f"{duration:.6f}", output_path,
+    ]
+    ok, stderr = run_ffmpeg(cmd, stdin_data)
+    if not ok:
+        raise RuntimeError(ffmpeg_error(stderr))
+    return output_path
 
-    # Other segments
-    image_files = sorted(glob(os.path.join(IMAGE_DIR, "*.png")))
-    log(f"[DEBUG] Found {len(image_files)} images, {len(os.listdir(AUDIO_DIR))} audios.")
 
+def encode_shared_audio(audio_path, segments_dir, gain_db=0.0):
+    """AAC-encode a recurring clip (answer sound) once, padded to whole still frames.
+
+    Returns (encoded_path, seconds); the file is reused while it is newer than its source.
+    """
+    name = os.path.splitext(os.path.basename(audio_path))[0]
+    suffix = f"_{gain_db:+.2f}dB" if gain_db else ""
+    encoded = os.path.join(segments_dir, f".shared_{name}_{STILL_FRAME_RATE}fps{suffix}.m4a")
+    duration = still_duration(media_duration(audio_path))
+    if not os.path.exists(encoded) or os.path.getmtime(encoded) < os.path.getmtime(audio_path):
+        log(f"Encoding shared audio track once: {encoded}")
+        ok, stderr = run_ffmpeg([
+            "ffmpeg", "-y", "-i", audio_path, "-vn",
+            *audio_filters(gain_db, f"apad=whole_dur={duration:.6f}"), *AUDIO_CODEC_ARGS, "-t", f"{duration:.6f}", encoded,
+        ])
+        if not ok:
+            raise RuntimeError(ffmpeg_error(stderr))
+    return encoded, duration
+
+
+def encode_segments(pairs, jobs, threads=DEFAULT_FFMPEG_THREADS, still=False, shared_audio=None, gains=None,
+                    frames=None):
+    """Encode all pairs with at most `jobs` concurrent ffmpeg processes.
+
+    In still mode, shared_audio maps a source audio path to its pre-encoded
+    (path, seconds) track. gains maps an audio path to its loudness gain in dB,
+    applied in the same encode. frames maps an image path to its raw frame,
+    piped to ffmpeg instead of reading the PNG. Returns (segment_paths,
+    failures): successful segments in input order and (output_path, error) for
+    every segment that failed.
+    """
+    shared_audio = shared_audio or {}
+    gains = gains or {}
+    frames = frames or {}
+
+    def encode(pair):
+        img, aud, outpath = pair
+        try:
+            if still:
+                return create_still_segment(img, aud, outpath, threads, shared_audio.get(aud), gains.get(aud, 0.0),
+                                            frames.get(img)), None
+            return create_video_segment(img, aud, outpath, threads, gains.get(aud, 0.0), frames.get(img)), None
+        except Exception as e:
+            log(f"Error creating segment {outpath}: {e}")
+            return None, str(e)
+
+    log(f"Encoding {len(pairs)} segments, {jobs} at a time ({threads} ffmpeg threads each)")
+    with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+        results = [future.result() for future in [pool.submit(metrics.in_scope(encode), pair) for pair in pairs]]
+
+    segment_paths = [path for path, err in results if path]
+    failures = [(outpath, err) for (_, _, outpath), (path, err) in zip(pairs, results) if err]
+    return segment_paths, failures
+
+def segment_key(state, image_path, audio_path, still=False, gain_db=0.0, image_digest=None):
+    """Input digest of a segment: image and audio contents plus every encode setting."""
+    if still:
+        settings = (STILL_FRAME_RATE, STILL_VIDEO_CODEC_ARGS)
+    else:
+        settings = (FRAME_RATE, VIDEO_CODEC_ARGS)
+    return digest("segment", image_digest or state.file_digest(image_path), state.file_digest(audio_path),
+                  VIDEO_SIZE, still, settings, AUDIO_CODEC_ARGS, gain_db)
+
+
+def encode_stale_segments(pairs, state, jobs, threads=DEFAULT_FFMPEG_THREADS, still=False, shared_audio=None, gains=None,
+                          frames=None):
+    """encode_segments() for the pairs whose image, audio or encode settings changed.
+
+    With frames (image path -> raw frame) a slide is identified by its pixels
+    rather than its PNG. Returns (segment_paths, failures) like
+    encode_segments, with segment_paths covering every usable segment of pairs
+    (rebuilt or up to date) in order.
+    """
+    gains, frames = gains or {}, frames or {}
+    keys = {
+        out: segment_key(state, img, aud, still, gains.get(aud, 0.0), frames.get(img) and frame_digest(frames[img]))
+        for img, aud, out in pairs
+    }
+    stale = [pair for pair in pairs if not state.fresh(pair[2], keys[pair[2]])]
+    log(f"{len(pairs) - len(stale)} of {len(pairs)} segments up to date")
+
+    built, failures = encode_segments(stale, jobs, threads, still, shared_audio, gains, frames) if stale else ([], [])
+    for path in built:
+        state.record(path, keys[path])
+
+    failed = {outpath for outpath, _ in failures}
+    return [out for _, _, out in pairs if out not in failed], failures
+
+# ========= MATCHING LOGIC =========
+def intro_pair(paths):
+    """(image, audio, segment) of the intro, or None if either file is missing."""
+    intro_img = os.path.join(paths.images, "intro.png")
+    intro_aud = os.path.join(paths.audio, "intro.wav")
+    if os.path.exists(intro_img) and os.path.exists(intro_aud):
+        return (intro_img, intro_aud, os.path.join(paths.segments, "00_intro.mp4"))
+    return None
+
+def audio_for_image(img, paths):
+    """Audio clip that plays under a slide, by filename; None for unrecognized names."""
+    base = os.path.splitext(os.path.basename(img))[0]
+
+    # Case 1: main narration (script_XX)
+    if re.match(r"script_\d{2}$", base):
+        return os.path.join(paths.audio, f"{base}.wav")
+
+    # Case 2: question slides (script_XX_qYY)
+    if re.match(r"script_\d{2}_q\d{2}$", base):
+        return os.path.join(paths.audio, f"{base}.wav")
+
+    # Case 3: scene narration (legacy _audio)
+    if "_audio" in base:
+        return os.path.join(paths.audio, f"{base}.wav")
+
+    # Case 4: answer slides → use global sound or silent fallback
+    if "answer" in base:
+        answer_audio = paths.answer_sound
+        if os.path.exists(answer_audio):
+            log(f"[DEBUG] Using global answer sound for {img}")
+            return answer_audio
+        log(f"Global answer sound missing for {img}, generating silent fallback...")
+        os.makedirs(paths.sounds, exist_ok=True)
+        if not os.path.exists(paths.silent):
+            subprocess.run(
+                ["ffmpeg", "-f", "lavfi", "-i", "anullsrc=r=44100:cl=stereo", "-t", "1", paths.silent, "-y"],
+                check=True
+            )
+        return paths.silent
+
+    # Skip unrecognized filenames
+    return None
+
+def pairs_for_images(image_files, paths):
+    """(image, audio, segment) for each recognized slide whose audio exists."""
+    pairs = []
     for img in image_files:
-        name = os.path.basename(img)
-        base = os.path.splitext(name)[0]
-        audio_path = None
-
-        # Case 1: main narration (script_XX)
-        if re.match(r"script_\d{2}$", base):
-            audio_path = os.path.join(AUDIO_DIR, f"{base}.wav")
-
-        # Case 2: question slides (script_XX_qYY)
-        elif re.match(r"script_\d{2}_q\d{2}$", base):
-            audio_path = os.path.join(AUDIO_DIR, f"{base}.wav")
-
-        # Case 3: scene narration (legacy _audio)
-        elif "_audio" in base:
-            audio_path = os.path.join(AUDIO_DIR, f"{base}.wav")
-
-        # Case 4: answer slides → use global sound or silent fallback
-        elif "answer" in base:
-            answer_audio = ANSWER_SOUND
-            if os.path.exists(answer_audio):
-                log(f"[DEBUG] Using global answer sound for {img}")
-                audio_path = answer_audio
-            else:
-                log(f"Global answer sound missing for {img}, generating silent fallback...")
-                os.makedirs(SOUNDS_DIR, exist_ok=True)
-                if not os.path.exists(SILENT_FALLBACK):
-                    subprocess.run(
-                        f'ffmpeg -f lavfi -i anullsrc=r=44100:cl=stereo -t 1 "{SILENT_FALLBACK}" -y',
-                        shell=True,
-                        check=True
-                    )
-                audio_path = SILENT_FALLBACK
-
-        # Skip unrecognized filenames
-        else:
+        audio_path = audio_for_image(img, paths)
+        if audio_path is None:
             continue
-
-        if audio_path and os.path.exists(audio_path):
-            seg_out = os.path.join(SEGMENTS_DIR, f"{base}.mp4")
-            pairs.append((img, audio_path, seg_out))
+        if os.path.exists(audio_path):
+            base = os.path.splitext(os.path.basename(img))[0]
+            pairs.append((img, audio_path, os.path.join(paths.segments, f"{base}.mp4")))
         else:
             log(f"Missing audio for {img} → expected {audio_path}")
+    return pairs
 
+def match_images_and_audios(base="/data"):
+    """Find matching image/audio pairs and define segment order."""
+    paths = data_paths(base)
+    pairs = []
+
+    #  Intro section
+    intro = intro_pair(paths)
+    if intro:
+        pairs.append(intro)
+    else:
+        log("Intro image or audio missing, skipping intro section.")
+
+    # Other segments
+    image_files = sorted(glob(os.path.join(paths.images, "*.png")))
+    log(f"[DEBUG] Found {len(image_files)} images, {len(os.listdir(paths.audio))} audios.")
+    pairs += pairs_for_images(image_files, paths)
     return pairs
 
 # ========= CONCATENATION =========
-def concatenate_segments(segment_list, final_output):
+def write_concat_list(segment_list, segments_dir):
+    """segments/list.txt in play order; the merge script reads it."""
+    concat_file = os.path.join(segments_dir, "list.txt")
+    with open(concat_file, "w", encoding="utf-8") as f:
+        for seg in segment_list:
+            f.write(f"file '{os.path.abspath(seg)}'\n")
+    return concat_file
+
+def concatenate_segments(segment_list, final_output, segments_dir):
     """Join all segments into one final video."""
     if not segment_list:
         log(" No video segments to concatenate.")
         return
 
     log("Concatenating all segments...")
-    concat_file = os.path.join(SEGMENTS_DIR, "list.txt")
-    with open(concat_file, "w", encoding="utf-8") as f:
-        for seg in segment_list:
-            f.write(f"file '{os.path.abspath(seg)}'\n")
-
-    cmd = (
-        f'ffmpeg -y -f concat -safe 0 -i "{concat_file}" '
-        f'-c copy "{final_output}"'
-    )
+    concat_file = write_concat_list(segment_list, segments_dir)
+    cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_file, "-c", "copy", final_output]
     run_ffmpeg(cmd)
     log(f"Final video created: {final_output}")
 
 # ========= MAIN =========
-if __name__ == "__main__":
+def main(argv=None):
+    args = parse_args(argv)
+    paths = data_paths(args.data)
+    os.makedirs(paths.segments, exist_ok=True)
+    os.makedirs(paths.final, exist_ok=True)
     log("=== KNM Video Segment Generator & Merger (Final Docker Version) ===")
 
-    pairs = match_images_and_audios()
+    pairs = match_images_and_audios(args.data)
     if not pairs:
         log("No valid image/audio pairs found. Check filenames.")
         exit(1)
 
-    segment_paths = []
-    for img, aud, outpath in pairs:
-        try:
-            segment_paths.append(create_video_segment(img, aud, outpath))
-        except Exception as e:
-            log(f"Error creating segment {outpath}: {e}")
+    gains = {}
+    if not args.no_loudness:
+        from loudness import clip_gains, default_cache_path
+        gains = clip_gains([aud for _, aud, _ in pairs], default_cache_path(args.data))
+
+    shared_audio = {}
+    if args.still:
+        # Every *_answer slide plays the same sound: encode its audio track once
+        for aud in {aud for _, aud, out in pairs if out.endswith("_answer.mp4")}:
+            shared_audio[aud] = encode_shared_audio(aud, paths.segments, gains.get(aud, 0.0))
 
-    final_path = os.path.join(FINAL_DIR, "final_video_temp.mp4")
-    concatenate_segments(segment_paths, final_path)
+    # Only segments whose image, audio or encode settings changed are re-encoded
+    state = stage_state("segments", args.data, args.force)
+    jobs = args.jobs or default_jobs(args.ffmpeg_threads)
+    segment_paths, failures = encode_stale_segments(
+        pairs, state, jobs, args.ffmpeg_threads, args.still, shared_audio, gains)
+    state.save()
 
+    final_path = os.path.join(paths.final, "final_video_temp.mp4")
+    concatenate_segments(segment_paths, final_path, paths.segments)
+
+    if failures:
+        log(f"{len(failures)} of {len(pairs)} segments failed:")
+        for outpath, err in failures:
+            log(f"  {outpath}: {err}")
+        exit(1)
     log("All segments processed successfully! Proceed to normalization + final merge.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import os
+import io
+import re
+import json
+import hashlib
+from dataclasses import dataclass, field, asdict
+
+# ========= CONFIGURATION =========
+PARSER_VERSION = 2  # bump when parsing rules change so old manifests are ignored
+OPTION_LETTERS = ("A", "B", "C", "D")
+
+HEADER_RE = re.compile(r"^\s*### (AUDIO_SCRIPT|QUESTIONS)_(\d+) ###\s*$")
+INLINE_HEADER_RE = re.compile(r"### (?:AUDIO_SCRIPT|QUESTIONS)_\d+ ###")
+QUESTION_RE = re.compile(r"^Q\d+:\s*(.*)$")
+OPTION_RE = re.compile(r"^([A-D])\.\s*(.*)$")
+ANSWER_RE = re.compile(r"^ANSWER:\s*([A-D])")
+
+
+# ========= LOG =========
+def log(msg): print(f"[DEBUG] {msg}")
+
+
+# ========= RECORDS =========
+@dataclass(slots=True)
+class Question:
+    id: int
+    text: str
+    A: str
+    B: str
+    C: str
+    D: str
+    answer: str
+
+    @property
+    def options(self):
+        """Non-empty (letter, text) pairs in display order."""
+        return [(letter, getattr(self, letter)) for letter in OPTION_LETTERS if getattr(self, letter)]
+
+
+@dataclass(slots=True)
+class Section:
+    script_id: int
+    audio_text: str
+    questions: list = field(default_factory=list)
+
+
+# ========= PARSER =========
+def _finish_question(fields, questions):
+    """Append the question being built if it is complete (A-C and an answer)."""
+    if fields and all(fields.get(k) for k in ("text", "A", "B", "C", "answer")):
+        questions.append(Question(
+            id=len(questions) + 1,
+            text=fields["text"].strip(),
+            A=fields["A"].strip(), B=fields["B"].strip(), C=fields["C"].strip(),
+            D=fields.get("D", "").strip(),
+            answer=fields["answer"],
+        ))
+
+
+def _split_headers(lines):
+    """Lines without line endings, every header on a line of its own.
+
+    Headers may share a line with text (### AUDIO_SCRIPT_1 ### Hello ...), as
+    the original whole-file regex parser allowed; the text before and after
+    a header becomes a line of its own.
+    """
+    for raw in lines:
+        line = raw.rstrip("\r\n")
+        pos = 0
+        for m in INLINE_HEADER_RE.finditer(line):
+            if line[pos:m.start()].strip():
+                yield line[pos:m.start()]
+            yield m.group(0)
+            pos = m.end()
+        if not pos:
+            yield line
+        elif line[pos:].strip():
+            yield line[pos:]
+
+
+def parse_lines(lines):
+    """Single streaming pass over input.txt lines, yielding Section records in file order.
+
+    ### AUDIO_SCRIPT_n ### opens a narration block, ### QUESTIONS_n ### closes it
+    and opens that section's questions, which run until the next AUDIO_SCRIPT
+    header or end of file. A narration without its QUESTIONS header is dropped.
+    """
+    sid, audio, questions, fields, key, in_questions = None, [], [], None, None, False
+
+    def flush():
+        if sid is not None and in_questions:
+            _finish_question(fields, questions)
+            return Section(script_id=sid, audio_text="\n".join(audio).strip(), questions=questions)
+
+    for line in _split_headers(lines):
+        header = HEADER_RE.match(line)
+        if header:
+            kind, num = header.group(1), int(header.group(2))
+            if kind == "AUDIO_SCRIPT":
+                section = flush()
+                if section:
+                    yield section
+                sid, audio, questions, fields, key, in_questions = num, [], [], None, None, False
+            elif sid == num and not in_questions:
+                in_questions = True
+            continue
+
+        if sid is None:
+            continue
+        if not in_questions:
+            audio.append(line)
+            continue
+
+        stripped = line.strip()
+        if m := QUESTION_RE.match(stripped):
+            _finish_question(fields, questions)
+            fields, key = {"text": m.group(1)}, "text"
+        elif fields is None:
+            continue
+        elif m := ANSWER_RE.match(stripped):
+            fields["answer"] = m.group(1)
+            _finish_question(fields, questions)
+            fields, key = None, None
+        elif (m := OPTION_RE.match(stripped)) and m.group(1) not in fields:
+            key = m.group(1)
+            fields[key] = m.group(2)
+        elif key:
+            fields[key] += "\n" + line
+
+    section = flush()
+    if section:
+        yield section
+
+
+def parse_input_file(filename):
+    """Parses input.txt and returns a list of Section records."""
+    with open(filename, "r", encoding="utf-8") as f:
+        return list(parse_lines(f))
+
+
+# ========= MANIFEST =========
+_loaded = {}  # input hash -> sections, shared by stages running in one process
+LOADED_MAX = 16  # a long-running service parses many inputs; keep only the recent ones
+
+
+def _remember(digest, sections):
+    _loaded[digest] = sections
+    while len(_loaded) > LOADED_MAX:
+        _loaded.pop(next(iter(_loaded)), None)
+    return sections
+
+def input_hash(content):
+    return hashlib.sha256(f"v{PARSER_VERSION}\n".encode("utf-8") + content).hexdigest()
+
+
+def manifest_path(filename, manifest_dir=None, digest=None):
+    manifest_dir = manifest_dir or os.path.join(os.path.dirname(os.path.abspath(filename)), ".manifest")
+    return os.path.join(manifest_dir, f"{digest}.json")
+
+
+def sections_from_manifest(data):
+    return [
+        Section(script_id=s["script_id"], audio_text=s["audio_text"],
+                questions=[Question(**q) for q in s["questions"]])
+        for s in data["sections"]
+    ]
+
+
+def load_sections(filename, manifest_dir=None):
+    """Parsed sections of filename, reusing the JSON manifest written by an earlier stage.
+
+    Manifests are keyed by the hash of the input bytes, so an edited input.txt
+    is always re-parsed.
+    """
+    with open(filename, "rb") as f:
+        content = f.read()
+    digest = input_hash(content)
+    sections = _loaded.get(digest)
+    if sections is not None:
+        return sections
+    path = manifest_path(filename, manifest_dir or os.getenv("MANIFEST_DIR"), digest)
+
+    if os.path.exists(path):
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                sections = sections_from_manifest(json.load(f))
+            log(f"Loaded parsed manifest: {path}")
+            return _remember(digest, sections)
+        except (ValueError, KeyError, TypeError) as e:
+            log(f"Ignoring unreadable manifest {path}: {e}")
+
+    sections = list(parse_lines(io.StringIO(content.decode("utf-8"))))
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump({"input_hash": digest, "sections": [asdict(s) for s in sections]}, f, ensure_ascii=False)
+        os.replace(tmp, path)
+        log(f"Wrote parsed manifest: {path}")
+    except OSError as e:
+        log(f"Could not write manifest {path}: {e}")
+    return _remember(digest, sections)
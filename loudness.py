@@ -0,0 +1,253 @@
+import os
+import json
+import math
+import hashlib
+import argparse
+import threading
+
+import numpy as np
+
+from audio_master import read_wav, decode_with_ffmpeg
+
+# ========= CONFIGURATION =========
+LOUDNESS_VERSION = 2  # bump when the measurement changes so cached values are ignored
+DEFAULT_TARGET = float(os.getenv("LOUDNESS_TARGET", "-16"))
+DEFAULT_MAX_TRUE_PEAK = float(os.getenv("LOUDNESS_MAX_TRUE_PEAK", "-1"))
+
+BLOCK_SECONDS = 0.4     # BS.1770 gating block
+HOP_SECONDS = 0.1       # 75% block overlap
+ABSOLUTE_GATE = -70.0   # LUFS
+RELATIVE_GATE = -10.0   # LU below the ungated loudness
+OVERSAMPLE = 4          # true-peak oversampling factor
+CHUNK_SECONDS = 5.0     # clips are filtered and oversampled this much at a time
+PEAK_CONTEXT = 64       # neighbouring samples on each side of an interpolated chunk
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Measure EBU R128 loudness of every clip and report the gains.")
+    parser.add_argument("--data", default="/data", help="Base project folder containing audio/images.")
+    parser.add_argument("--cache", default=None, help="Measurement cache (default: <data>/.loudness/measurements.json)")
+    parser.add_argument("--target", type=float, default=DEFAULT_TARGET, help="Integrated loudness target in LUFS (env LOUDNESS_TARGET)")
+    parser.add_argument("--max-true-peak", type=float, default=DEFAULT_MAX_TRUE_PEAK,
+                        help="True-peak ceiling in dBTP (env LOUDNESS_MAX_TRUE_PEAK)")
+    return parser.parse_args(argv)
+
+
+# ========= LOG =========
+def log(msg): print(f"[DEBUG] {msg}")
+
+
+# ========= MEASUREMENT =========
+def k_weighting_filters(rate):
+    """(b, a) biquads of the BS.1770 pre-filter (high shelf) and RLB high-pass at any sample rate."""
+    f0, gain, q = 1681.974450955533, 3.999843853973347, 0.7071752369554196
+    k = math.tan(math.pi * f0 / rate)
+    vh = 10 ** (gain / 20)
+    vb = vh ** 0.4996667741545416
+    a0 = 1 + k / q + k * k
+    shelf = ([(vh + vb * k / q + k * k) / a0, 2 * (k * k - vh) / a0, (vh - vb * k / q + k * k) / a0],
+             [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+
+    f0, q = 38.13547087602444, 0.5003270373238773
+    k = math.tan(math.pi * f0 / rate)
+    a0 = 1 + k / q + k * k
+    highpass = ([1.0, -2.0, 1.0], [1.0, 2 * (k * k - 1) / a0, (1 - k / q + k * k) / a0])
+    return shelf, highpass
+
+
+def k_weighting_impulse(rate):
+    """Impulse response of the K-weighting filters, cut off after half a second (they have decayed by then).
+
+    The biquads' complex response is evaluated on an rFFT grid twice as long,
+    so the response does not wrap around.
+    """
+    length = rate // 2
+    n_fft = 1 << (2 * length - 1).bit_length()
+    z = np.exp(-1j * np.linspace(0, np.pi, n_fft // 2 + 1))
+    response = np.ones_like(z)
+    for b, a in k_weighting_filters(rate):
+        response *= np.polyval(b[::-1], z) / np.polyval(a[::-1], z)
+    return np.fft.irfft(response, n=n_fft)[:length]
+
+
+def k_weighted_chunks(x, rate, chunk):
+    """K-weighted float64 pieces of [n, channels] audio, `chunk` samples each (overlap-add FFT convolution)."""
+    h = k_weighting_impulse(rate)
+    n_fft = 1 << (chunk + len(h) - 2).bit_length()
+    response = np.fft.rfft(h, n=n_fft)[:, None]
+    tail = np.zeros((len(h) - 1, x.shape[1]))
+    for start in range(0, len(x), chunk):
+        piece = x[start:start + chunk].astype(np.float64)
+        y = np.fft.irfft(np.fft.rfft(piece, n=n_fft, axis=0) * response, n=n_fft, axis=0)[:len(piece) + len(h) - 1]
+        y[:len(tail)] += tail
+        tail = y[len(piece):]
+        yield y[:len(piece)]
+
+
+def integrated_loudness(x, rate):
+    """Gated integrated loudness (LUFS) of [n, channels] float audio; -inf for silence.
+
+    Blocks are BLOCK_SECONDS / HOP_SECONDS hops long, so each block's energy
+    is a sum of per-hop energies and the filtered clip is never held whole.
+    """
+    if len(x) == 0:
+        return float("-inf")
+    hop = int(round(HOP_SECONDS * rate))
+    hops_per_block = int(round(BLOCK_SECONDS / HOP_SECONDS))
+    block = hop * hops_per_block
+
+    # Energy (summed over channels) of every whole hop, plus the partial hop at the end
+    energies, rest = [], 0.0
+    for y in k_weighted_chunks(x, rate, hop * max(1, int(CHUNK_SECONDS / HOP_SECONDS))):
+        squares = (y * y).sum(axis=1)
+        whole = len(squares) // hop * hop
+        energies.append(squares[:whole].reshape(-1, hop).sum(axis=1))
+        rest = float(squares[whole:].sum())
+    hop_energy = np.concatenate(energies)
+    if len(x) < block:
+        power = np.array([(hop_energy.sum() + rest) / len(x)])
+    else:
+        cumulative = np.concatenate([[0.0], np.cumsum(hop_energy)])
+        starts = np.arange((len(x) - block) // hop + 1)
+        power = (cumulative[starts + hops_per_block] - cumulative[starts]) / block
+
+    with np.errstate(divide="ignore"):
+        levels = -0.691 + 10 * np.log10(power)
+    gated = levels > ABSOLUTE_GATE
+    if not gated.any():
+        return float("-inf")
+    relative = -0.691 + 10 * np.log10(power[gated].mean()) + RELATIVE_GATE
+    gated &= levels > relative
+    return float(-0.691 + 10 * np.log10(power[gated].mean()))
+
+
+def true_peak(x, rate, oversample=OVERSAMPLE):
+    """True peak (dBTP) from FFT interpolation at `oversample` times the sample rate.
+
+    The clip is interpolated CHUNK_SECONDS at a time. Each chunk gets
+    PEAK_CONTEXT neighbouring samples on both sides, faded out towards the
+    window's ends (zeros at the clip's edges), so the interpolation's
+    periodic edges stay away from it; only the chunk itself is measured,
+    plus the ringing past the clip's first and last sample.
+    """
+    if len(x) == 0:
+        return float("-inf")
+    peak = float(np.abs(x).max())
+    chunk, pad = max(1, int(CHUNK_SECONDS * rate)), PEAK_CONTEXT
+    fade = np.sin(np.linspace(0, np.pi / 2, pad, endpoint=False))[:, None] ** 2
+    for start in range(0, len(x), chunk):
+        piece = min(chunk, len(x) - start)
+        lo, hi = max(0, start - pad), min(len(x), start + piece + pad)
+        window = np.zeros((piece + 2 * pad, x.shape[1]))
+        window[lo - start + pad:hi - start + pad] = x[lo:hi]
+        window[:pad] *= fade
+        window[-pad:] *= fade[::-1]
+        upsampled = np.fft.irfft(np.fft.rfft(window, axis=0), n=len(window) * oversample, axis=0) * oversample
+        first = 0 if start == 0 else pad * oversample
+        last = len(upsampled) if start + piece == len(x) else (pad + piece) * oversample
+        peak = max(peak, float(np.abs(upsampled[first:last]).max()))
+    return 20 * math.log10(peak) if peak > 0 else float("-inf")
+
+
+def decode(path):
+    """(float32 samples [n, channels], rate) of any clip."""
+    return read_wav(path) or decode_with_ffmpeg(path)
+
+
+def measure_file(path):
+    samples, rate = decode(path)
+    return {"integrated": integrated_loudness(samples, rate), "true_peak": true_peak(samples, rate)}
+
+
+def gain_for(measurement, target=DEFAULT_TARGET, max_true_peak=DEFAULT_MAX_TRUE_PEAK):
+    """Gain in dB that brings a clip to target without pushing its true peak over the ceiling."""
+    if not math.isfinite(measurement["integrated"]):
+        return 0.0
+    gain = target - measurement["integrated"]
+    if math.isfinite(measurement["true_peak"]):
+        gain = min(gain, max_true_peak - measurement["true_peak"])
+    return round(gain, 2)
+
+
+# ========= CACHE =========
+def file_hash(path):
+    digest = hashlib.sha256(f"v{LOUDNESS_VERSION}\n".encode("utf-8"))
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class LoudnessCache:
+    """Per-clip measurements in one JSON file, keyed by the clip's content hash."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.entries = {}
+        self.dirty = False
+        if os.path.exists(path):
+            try:
+                with open(path, "r", encoding="utf-8") as f:
+                    self.entries = json.load(f)
+            except ValueError as e:
+                log(f"Ignoring unreadable loudness cache {path}: {e}")
+
+    def measure(self, path):
+        key = file_hash(path)
+        with self.lock:
+            cached = self.entries.get(key)
+        if cached:
+            return cached
+        measurement = measure_file(path)
+        log(f"Loudness {path}: {measurement['integrated']:.1f} LUFS, {measurement['true_peak']:.1f} dBTP")
+        with self.lock:
+            self.entries[key] = measurement
+            self.dirty = True
+        return measurement
+
+    def save(self):
+        if not self.dirty:
+            return
+        try:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            tmp = f"{self.path}.{os.getpid()}.tmp"
+            with self.lock, open(tmp, "w", encoding="utf-8") as f:
+                json.dump(self.entries, f, indent=1)
+            os.replace(tmp, self.path)
+            self.dirty = False
+        except OSError as e:
+            log(f"Could not write loudness cache {self.path}: {e}")
+
+
+def default_cache_path(base):
+    return os.getenv("LOUDNESS_CACHE") or os.path.join(base, ".loudness", "measurements.json")
+
+
+def clip_gains(audio_paths, cache_path, target=DEFAULT_TARGET, max_true_peak=DEFAULT_MAX_TRUE_PEAK):
+    """{audio path: gain dB} for every distinct clip, measuring each file at most once."""
+    cache = LoudnessCache(cache_path)
+    gains = {}
+    for path in dict.fromkeys(audio_paths):
+        gains[path] = gain_for(cache.measure(path), target, max_true_peak)
+    cache.save()
+    return gains
+
+
+# ========= MAIN =========
+def main(argv=None):
+    from generate_video_segments_and_merge import match_images_and_audios
+
+    args = parse_args(argv)
+    pairs = match_images_and_audios(args.data)
+    if not pairs:
+        log("No valid image/audio pairs found. Check filenames.")
+        exit(1)
+    gains = clip_gains([aud for _, aud, _ in pairs], args.cache or default_cache_path(args.data),
+                       args.target, args.max_true_peak)
+    for path, gain in gains.items():
+        log(f"{gain:+6.2f} dB  {path}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,178 @@
+import os
+import json
+import time
+import cProfile
+import resource
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# ========= CONFIGURATION =========
+REPORT_VERSION = 1
+DEFAULT_REPORT = os.getenv("METRICS_REPORT")   # default: <data>/final_video/metrics.json
+DEFAULT_PROFILE = os.getenv("PROFILE_OUTPUT")  # cProfile dump, off unless set
+
+
+# ========= LOG =========
+def log(msg): print(f"[DEBUG] {msg}")
+
+
+def children_cpu():
+    """CPU seconds of finished child processes (ffmpeg, render workers)."""
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return usage.ru_utime + usage.ru_stime
+
+
+# ========= COLLECTOR =========
+_scope = contextvars.ContextVar("metrics_scope", default=None)
+
+
+class Metrics:
+    """Process-wide timing events and per-stage wall/CPU totals.
+
+    Events are flat dicts with a `kind` (tts, image, ffmpeg, ...) and a
+    `seconds` field; summary() aggregates them per kind for the report.
+    Inside scoped() they go to the scope's own collector instead, so one
+    job of a long-running process gets its own report and the process-wide
+    lists do not grow with every job.
+    """
+
+    def __init__(self, process=True):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.process = process  # report process CPU totals (meaningless for one of several concurrent scopes)
+        self.events = []
+        self.stages = []
+
+    def target(self):
+        return _scope.get() or self
+
+    def record(self, kind, **fields):
+        target = self.target()
+        with target.lock:
+            target.events.append({"kind": kind, **fields})
+
+    @contextmanager
+    def stage(self, name):
+        """Wall time, own CPU time and child-process CPU time of a block."""
+        wall, cpu, child = time.perf_counter(), time.process_time(), children_cpu()
+        try:
+            yield
+        finally:
+            entry = {
+                "stage": name,
+                "wall": round(time.perf_counter() - wall, 4),
+                "cpu": round(time.process_time() - cpu, 4),
+                "children_cpu": round(children_cpu() - child, 4),
+            }
+            target = self.target()
+            with target.lock:
+                target.stages.append(entry)
+
+    @contextmanager
+    def timed(self, kind, **fields):
+        """Record one event with its duration; the yielded dict can take extra fields."""
+        start = time.perf_counter()
+        event = dict(fields)
+        try:
+            yield event
+        finally:
+            event["seconds"] = round(time.perf_counter() - start, 4)
+            self.record(kind, **event)
+
+    def summary(self):
+        """Per kind: count, latency distribution and totals of the numeric fields."""
+        with self.lock:
+            events = list(self.events)
+        kinds = {}
+        for event in events:
+            kinds.setdefault(event["kind"], []).append(event)
+        summary = {}
+        for kind, items in kinds.items():
+            seconds = sorted(e["seconds"] for e in items if "seconds" in e)
+            entry = {"count": len(items)}
+            if seconds:
+                entry.update({
+                    "seconds_total": round(sum(seconds), 4),
+                    "seconds_mean": round(sum(seconds) / len(seconds), 4),
+                    "seconds_p50": seconds[len(seconds) // 2],
+                    "seconds_p95": seconds[min(len(seconds) - 1, int(len(seconds) * 0.95))],
+                    "seconds_max": seconds[-1],
+                })
+            for field in ("chars", "bytes", "out_seconds"):
+                values = [e[field] for e in items if isinstance(e.get(field), (int, float))]
+                if values:
+                    entry[f"{field}_total"] = round(sum(values), 4)
+            summary[kind] = entry
+        return summary
+
+    def report(self):
+        with self.lock:
+            stages, events = list(self.stages), list(self.events)
+        report = {
+            "version": REPORT_VERSION,
+            "started": time.strftime("%Y-%m-%dT%H:%M:%S", time.localtime(self.started)),
+            "wall": round(time.time() - self.started, 4),
+        }
+        if self.process:
+            report.update(cpu=round(time.process_time(), 4), children_cpu=round(children_cpu(), 4))
+        report.update(stages=stages, summary=self.summary(), events=events)
+        return report
+
+    def write(self, path):
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        tmp = f"{path}.{os.getpid()}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(self.report(), f, indent=1)
+        os.replace(tmp, path)
+        log(f"Metrics report written: {path}")
+
+
+METRICS = Metrics()
+record = METRICS.record
+stage = METRICS.stage
+timed = METRICS.timed
+
+
+@contextmanager
+def scoped():
+    """Collect the events of the calling thread (and of threads started via in_scope) in a fresh Metrics."""
+    collector = Metrics(process=False)
+    token = _scope.set(collector)
+    try:
+        yield collector
+    finally:
+        _scope.reset(token)
+
+
+def in_scope(func):
+    """func bound to the caller's metrics scope; threads and pool tasks do not inherit it.
+
+    Bind once per thread or task: a copied context can only run in one thread at a time.
+    """
+    context = contextvars.copy_context()
+    return lambda *args: context.run(func, *args)
+
+
+def call_timed(func, *args):
+    """(func(*args), seconds); picklable, so pool workers can time their own work."""
+    start = time.perf_counter()
+    result = func(*args)
+    return result, round(time.perf_counter() - start, 4)
+
+
+@contextmanager
+def profiled(path=None):
+    """cProfile the calling thread's block into path (pstats format); no-op without a path."""
+    if not path:
+        yield
+        return
+    profiler = cProfile.Profile()
+    profiler.enable()
+    try:
+        yield
+    finally:
+        profiler.disable()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        profiler.dump_stats(path)
+        log(f"Profile written: {path} (inspect with: python -m pstats {path})")
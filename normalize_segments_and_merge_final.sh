@@ -3,20 +3,28 @@
 #  KNM Listening Practice - Normalize (ordered) + Merge
 #  - Preserves order from /data/segments/list.txt
 #  - Adds *_answer.mp4 immediately after its base clip (once)
-#  - Normalizes all audio/video to 44.1 kHz stereo AAC
+#  - MERGE_MODE=copy (default): segments are already encoded in the
+#    final format, so they are only checked and stream-copied
+#  - MERGE_MODE=reencode: legacy path, normalizes every clip to
+#    44.1 kHz stereo AAC and re-encodes the merge
+#  - Skips the merge when the segments are unchanged since the last
+#    run (FORCE_REBUILD=1 merges anyway)
 #  - Outputs final video to /data/final_video/final_video.mp4
 # ============================================================
 
 set -euo pipefail
 
 # ---- Paths (Docker mount) ----
-PROJECT_DIR="/data"
+PROJECT_DIR="${PROJECT_DIR:-/data}"
 SEGMENTS_DIR="${PROJECT_DIR}/segments"
 NORMALIZED_DIR="${PROJECT_DIR}/segments_normalized"
 FINAL_DIR="${PROJECT_DIR}/final_video"
 LIST_FILE="${SEGMENTS_DIR}/list.txt"
 FINAL_LIST="${NORMALIZED_DIR}/list.txt"
 OUTPUT_FILE="${FINAL_DIR}/final_video.mp4"
+MERGE_MODE="${MERGE_MODE:-copy}"
+STATE_DIR="${BUILD_STATE_DIR:-${PROJECT_DIR}/.build}"
+MERGE_STAMP="${STATE_DIR}/merge.stamp"
 
 mkdir -p "${NORMALIZED_DIR}" "${FINAL_DIR}"
 
@@ -25,7 +33,38 @@ if [ ! -f "${LIST_FILE}" ]; then
   exit 1
 fi
 
-echo " Step 1: Normalizing all segments (video + audio) in listed order..."
+if [[ "${MERGE_MODE}" != "copy" && "${MERGE_MODE}" != "reencode" ]]; then
+  echo "ERROR: MERGE_MODE must be 'copy' or 'reencode' (got '${MERGE_MODE}')."
+  exit 1
+fi
+
+# ---- Incremental: skip when list, segments and mode match the last merge ----
+merge_stamp() {
+  {
+    echo "${MERGE_MODE}"
+    cat "${LIST_FILE}"
+    find "${SEGMENTS_DIR}" -maxdepth 1 -name '*.mp4' -printf '%f %s %T@\n' | sort
+  } | sha256sum | cut -d' ' -f1
+}
+
+CURRENT_STAMP="$(merge_stamp)"
+if [[ "${FORCE_REBUILD:-0}" != "1" && -f "${OUTPUT_FILE}" && -f "${MERGE_STAMP}" \
+      && "$(cat "${MERGE_STAMP}")" == "${CURRENT_STAMP}" ]]; then
+  echo " Segments unchanged since the last merge; ${OUTPUT_FILE} is up to date."
+  exit 0
+fi
+
+# Codec parameters that must be identical for a stream-copy concat
+stream_signature() {
+  ffprobe -v error \
+    -show_entries stream=codec_type,codec_name,profile,width,height,pix_fmt,sample_aspect_ratio,r_frame_rate,time_base,sample_rate,channels \
+    -of compact=p=0:nk=1 "$1" | tr '\n' ';'
+}
+
+REFERENCE_SIGNATURE=""
+REFERENCE_FILE=""
+
+echo " Step 1: Collecting segments in listed order (mode: ${MERGE_MODE})..."
 : > "${FINAL_LIST}"   # truncate/create
 
 # Track already-added basenames to avoid duplicates
@@ -46,11 +85,33 @@ normalize_and_add() {
   fi
   added_files["$base"]=1
 
-  echo " Normalizing: $base"
-  ffmpeg -y -i "$src" \
-    -c:v libx264 -preset veryfast -crf 20 \
-    -c:a aac -b:a 192k -ar 44100 -ac 2 \
-    -movflags +faststart "$out" < /dev/null
+  if [[ "${MERGE_MODE}" == "copy" ]]; then
+    local signature
+    signature="$(stream_signature "$src")"
+    if [[ -z "${REFERENCE_SIGNATURE}" ]]; then
+      REFERENCE_SIGNATURE="${signature}"
+      REFERENCE_FILE="${base}"
+    elif [[ "${signature}" != "${REFERENCE_SIGNATURE}" ]]; then
+      echo "ERROR: ${base} does not match the stream parameters of ${REFERENCE_FILE}; refusing to stream-copy."
+      echo "   ${REFERENCE_FILE}: ${REFERENCE_SIGNATURE}"
+      echo "   ${base}: ${signature}"
+      echo "   Re-run the segment stage, or set MERGE_MODE=reencode."
+      exit 1
+    fi
+    echo " Checked: $base"
+    echo "file '$(realpath "$src")'" >> "${FINAL_LIST}"
+    return
+  fi
+
+  if [[ -f "$out" && "$out" -nt "$src" ]]; then
+    echo " Up to date: $base"
+  else
+    echo " Normalizing: $base"
+    ffmpeg -y -i "$src" \
+      -c:v libx264 -preset veryfast -crf 20 \
+      -c:a aac -b:a 192k -ar 44100 -ac 2 \
+      -movflags +faststart "$out" < /dev/null
+  fi
 
   # Append absolute path to concat list
   echo "file '$(realpath "$out")'" >> "${FINAL_LIST}"
@@ -81,18 +142,26 @@ for extra in "${SEGMENTS_DIR}"/*_answer.mp4; do
   fi
 done
 
-echo " Normalization complete."
-echo " Normalized list written to: ${FINAL_LIST}"
+echo " Segment collection complete."
+echo " Merge list written to: ${FINAL_LIST}"
 echo "------------------------------------------------------------"
 
-echo " Step 2: Merging normalized clips..."
-ffmpeg -y -f concat -safe 0 -i "${FINAL_LIST}" \
-  -c:v libx264 -preset veryfast -crf 20 \
-  -c:a aac -b:a 192k -ar 44100 -ac 2 \
-  -movflags +faststart "${OUTPUT_FILE}"
+if [[ "${MERGE_MODE}" == "copy" ]]; then
+  echo " Step 2: Merging clips (stream copy)..."
+  ffmpeg -y -f concat -safe 0 -i "${FINAL_LIST}" \
+    -c copy -movflags +faststart "${OUTPUT_FILE}" < /dev/null
+else
+  echo " Step 2: Merging normalized clips..."
+  ffmpeg -y -f concat -safe 0 -i "${FINAL_LIST}" \
+    -c:v libx264 -preset veryfast -crf 20 \
+    -c:a aac -b:a 192k -ar 44100 -ac 2 \
+    -movflags +faststart "${OUTPUT_FILE}" < /dev/null
+fi
 
 echo "------------------------------------------------------------"
 if [ -f "${OUTPUT_FILE}" ]; then
+  mkdir -p "${STATE_DIR}"
+  echo "${CURRENT_STAMP}" > "${MERGE_STAMP}"
   echo "Merge complete!"
   echo "Final video: ${OUTPUT_FILE}"
 else
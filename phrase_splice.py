@@ -0,0 +1,299 @@
+import os
+import wave
+import threading
+
+import numpy as np
+
+import metrics
+from audio_master import read_wav
+from tts_backends import build_ssml, spoken_chars
+from tts_cache import cache_key, spliced_key
+
+# ========= CONFIGURATION =========
+DEFAULT_FRAGMENT_DIR = os.getenv("TTS_FRAGMENT_DIR")         # default: .tts_fragments next to the TTS cache
+DEFAULT_PROSODY_SAMPLE = int(os.getenv("PROSODY_SAMPLE", "3"))  # prompts per voice also synthesized whole
+
+PAUSE_AFTER_QUESTION = 0.45  # seconds of silence after each fragment kind
+PAUSE_AFTER_LABEL = 0.12     # "Optie A:" -> option text
+PAUSE_AFTER_OPTION = 0.35
+EDGE_FADE = 0.012            # fade at every fragment edge, so pauses cross-fade instead of clicking
+EDGE_MARGIN = 0.02           # speech kept beyond the trim threshold
+SILENCE_DBFS = -45.0         # fragment edges quieter than this are trimmed
+
+MAX_DURATION_RATIO = 1.25    # spliced vs monolithic prompt: duration,
+MAX_LEVEL_DIFF_DB = 3.0      # speech level
+MAX_PITCH_RATIO = 1.15       # and median pitch
+PITCH_RANGE = (70.0, 400.0)  # Hz searched by the pitch tracker
+
+
+# ========= LOG =========
+def log(msg): print(f"[DEBUG] {msg}")
+
+
+# ========= FRAGMENTS =========
+def prompt_fragments(q):
+    """(text, pause after) fragments of a question prompt; spoken together they read as question_prompt(q)."""
+    fragments = [(q.text, PAUSE_AFTER_QUESTION)]
+    for letter, text in q.options:
+        fragments += [(f"Optie {letter}:", PAUSE_AFTER_LABEL), (f"{text}.", PAUSE_AFTER_OPTION)]
+    fragments[-1] = (fragments[-1][0], 0.0)
+    return fragments
+
+
+# ========= PCM =========
+def trim(x, rate):
+    """x without leading/trailing silence (a small margin of it is kept)."""
+    loud = np.flatnonzero(np.abs(x).max(axis=1) > 10 ** (SILENCE_DBFS / 20))
+    if not len(loud):
+        return x[:0]
+    margin = int(EDGE_MARGIN * rate)
+    return x[max(0, loud[0] - margin):loud[-1] + margin + 1]
+
+
+def fade_edges(x, rate):
+    n = min(len(x) // 2, int(EDGE_FADE * rate))
+    if n:
+        ramp = (0.5 - 0.5 * np.cos(np.linspace(0, np.pi, n)))[:, None].astype(x.dtype)
+        x = x.copy()
+        x[:n] *= ramp
+        x[-n:] *= ramp[::-1]
+    return x
+
+
+def splice(pieces, rate, channels):
+    """One buffer from [(samples, pause seconds)]: trimmed, edge-faded fragments separated by silence."""
+    parts = []
+    for samples, pause in pieces:
+        parts.append(fade_edges(trim(samples, rate), rate))
+        if pause:
+            parts.append(np.zeros((int(pause * rate), channels), dtype=np.float32))
+    return np.concatenate(parts) if parts else np.zeros((0, channels), dtype=np.float32)
+
+
+def write_wav(path, x, rate):
+    if os.path.lexists(path):
+        os.remove(path)  # never write through a hard link into the TTS cache
+    pcm = (np.clip(x, -1.0, 1.0) * 32767).round().astype("<i2")
+    with wave.open(path, "wb") as w:
+        w.setnchannels(x.shape[1])
+        w.setsampwidth(2)
+        w.setframerate(rate)
+        w.writeframes(pcm.tobytes())
+
+
+# ========= PROSODY =========
+def prosody(x, rate):
+    """Speech duration (s), active speech level (dBFS) and median pitch (Hz, None if unvoiced) of a prompt."""
+    x = trim(x, rate).mean(axis=1)
+    frame = int(0.04 * rate)
+    if len(x) < frame:
+        return {"duration": len(x) / rate, "level": float("-inf"), "pitch": None}
+    hop = frame // 2
+    frames = np.lib.stride_tricks.sliding_window_view(x, frame)[::hop]
+    power = (frames ** 2).mean(axis=1)
+    active = frames[power > 10 ** (SILENCE_DBFS / 10)]
+    level = 10 * np.log10((active ** 2).mean()) if len(active) else float("-inf")
+
+    # Autocorrelation pitch of the active frames, all at once through the FFT
+    pitch = None
+    if len(active):
+        spectrum = np.fft.rfft(active - active.mean(axis=1, keepdims=True), n=2 * frame, axis=1)
+        acf = np.fft.irfft(np.abs(spectrum) ** 2, axis=1)[:, :frame]
+        lo, hi = int(rate / PITCH_RANGE[1]), min(frame - 1, int(rate / PITCH_RANGE[0]))
+        lags = lo + acf[:, lo:hi].argmax(axis=1)
+        strength = acf[np.arange(len(acf)), lags] / np.maximum(acf[:, 0], 1e-12)
+        voiced = lags[strength > 0.3]
+        if len(voiced):
+            pitch = float(rate / np.median(voiced))
+    return {"duration": len(x) / rate, "level": float(level), "pitch": pitch}
+
+
+def prosody_problems(spliced, mono):
+    """Ways the spliced prompt sounds unlike the monolithic one; empty if it passes."""
+    problems = []
+    ratio = spliced["duration"] / mono["duration"] if mono["duration"] else float("inf")
+    if not 1 / MAX_DURATION_RATIO <= ratio <= MAX_DURATION_RATIO:
+        problems.append(f"duration {spliced['duration']:.2f}s vs {mono['duration']:.2f}s")
+    if abs(spliced["level"] - mono["level"]) > MAX_LEVEL_DIFF_DB:
+        problems.append(f"level {spliced['level']:.1f} vs {mono['level']:.1f} dBFS")
+    if (spliced["pitch"] is None) != (mono["pitch"] is None) or (
+            mono["pitch"] and not 1 / MAX_PITCH_RATIO <= spliced["pitch"] / mono["pitch"] <= MAX_PITCH_RATIO):
+        problems.append(f"pitch {spliced['pitch'] or 0:.0f} vs {mono['pitch'] or 0:.0f} Hz")
+    return problems
+
+
+# ========= SPLICER =========
+class PhraseSplicer:
+    """Question prompts assembled from separately synthesized, shared fragments.
+
+    Every distinct (fragment, voice, rate) is synthesized once into
+    fragment_dir, keyed like the TTS cache, and reused by every prompt (and
+    every later run) that contains it. The first `sample` prompts of each voice
+    are also synthesized whole and their prosody compared with the splice;
+    until those checks are in, the voice's other prompts wait. A failed check
+    turns splicing off for that voice, which then falls back to whole prompts.
+    Safe to share between synthesis threads.
+    """
+
+    def __init__(self, fragment_dir, sample=DEFAULT_PROSODY_SAMPLE):
+        self.fragment_dir = fragment_dir
+        self.sample = max(0, sample)
+        self.lock = threading.Lock()
+        self.fragment_locks = {}
+        self.checks = {}    # voice -> [started, finished, Event set once the voice is checked]
+        self.disabled = {}  # voice -> reason
+        self.spliced = self.fragments_built = self.fragments_reused = 0
+        self.chars_prompts = self.chars_synthesized = 0
+        os.makedirs(fragment_dir, exist_ok=True)
+
+    def fragment(self, text, voice, rate, backend):
+        """Path of the fragment's WAV, synthesizing it on first use (None on failure)."""
+        ssml = build_ssml(text, voice, rate)
+        key = cache_key(ssml, backend.output_format)
+        path = os.path.join(self.fragment_dir, key[:2], f"{key}.wav")
+        with self.lock:
+            lock = self.fragment_locks.setdefault(key, threading.Lock())
+        with lock:  # concurrent prompts sharing a fragment synthesize it once
+            built = not os.path.exists(path)
+            if built:
+                tmp = f"{path}.{os.getpid()}.tmp"
+                if not backend.synthesize_to_file(ssml, voice, tmp):
+                    return None
+                os.replace(tmp, path)
+        with self.lock:
+            self.fragment_locks.pop(key, None)
+            if built:
+                self.fragments_built += 1
+                self.chars_synthesized += spoken_chars(ssml)
+            else:
+                self.fragments_reused += 1
+        return path
+
+    def claim_check(self, voice):
+        """True if this prompt is one of the voice's prosody samples; otherwise waits for the samples."""
+        with self.lock:
+            check = self.checks.setdefault(voice, [0, 0, threading.Event()])
+            if check[0] < self.sample:
+                check[0] += 1
+                return True
+            if not self.sample:
+                check[2].set()
+        check[2].wait()
+        return False
+
+    def finish_check(self, voice, problems=None):
+        with self.lock:
+            check = self.checks[voice]
+            check[1] += 1
+            if problems:
+                self.disabled.setdefault(voice, "; ".join(problems))
+            if problems or check[1] >= self.sample:
+                check[2].set()
+
+    def whole(self, text, output_path, voice, rate, backend, cache):
+        """The prompt synthesized in one request, as without splicing."""
+        ssml = build_ssml(text, voice, rate)
+        if cache is None or not cache.has(cache_key(ssml, backend.output_format)):
+            with self.lock:
+                self.chars_synthesized += spoken_chars(ssml)
+        return backend.synthesize_to_file(ssml, voice, output_path, cache)
+
+    def spliced_prompt(self, q, voice, rate, backend):
+        """(samples, sample rate) of the spliced prompt; None if a fragment failed, False if it is not 16-bit PCM."""
+        pieces = []
+        for fragment, pause in prompt_fragments(q):
+            path = self.fragment(fragment, voice, rate, backend)
+            if path is None:
+                return None
+            decoded = read_wav(path)
+            if decoded is None:
+                return False
+            pieces.append((decoded, pause))
+        rates = {sample_rate for (_, sample_rate), _ in pieces}
+        if len(rates) != 1:
+            return False
+        sample_rate = rates.pop()
+        channels = pieces[0][0][0].shape[1]
+        return splice([(samples, pause) for (samples, _), pause in pieces], sample_rate, channels), sample_rate
+
+    def synthesize(self, text, q, output_path, voice, rate, backend, cache=None):
+        """Write the prompt for q (spoken text `text`) to output_path; returns False on failure."""
+        ssml = build_ssml(text, voice, rate)
+        with self.lock:
+            self.chars_prompts += spoken_chars(ssml)
+        if cache is not None and cache.has(cache_key(ssml, backend.output_format)):
+            return self.whole(text, output_path, voice, rate, backend, cache)  # already paid for
+        if voice in self.disabled or not self.claim_check(voice):
+            return self.prompt(text, q, output_path, voice, rate, backend, cache)
+
+        # A prosody sample: the voice's waiting prompts are released however it ends
+        problems = ["prosody sample did not complete"]
+        try:
+            ok, problems = self.sample_prompt(text, q, output_path, voice, rate, backend, cache)
+            return ok
+        finally:
+            self.finish_check(voice, problems)
+
+    def sample_prompt(self, text, q, output_path, voice, rate, backend, cache):
+        """Synthesize a sample whole and compare its prosody with the splice; returns (ok, problems)."""
+        spliced = self.spliced_prompt(q, voice, rate, backend)
+        if not spliced:
+            self.note_unspliceable(voice, spliced)
+            return spliced is not None and self.whole(text, output_path, voice, rate, backend, cache), None
+        # The sample keeps its monolithic audio either way; it has been paid for
+        if not self.whole(text, output_path, voice, rate, backend, cache):
+            return False, None
+        mono = read_wav(output_path)
+        problems = (["monolithic prompt is not 16-bit PCM"] if mono is None
+                    else prosody_problems(prosody(*spliced), prosody(*mono)))
+        metrics.record("prosody_check", output=output_path, voice=voice, ok=not problems, problems=problems)
+        if problems:
+            log(f"Prosody check failed for {voice} ({output_path}): {'; '.join(problems)}. "
+                f"Synthesizing this voice's prompts whole.")
+        return True, problems
+
+    def note_unspliceable(self, voice, spliced):
+        if spliced is False:
+            with self.lock:
+                self.disabled.setdefault(voice, "fragments are not 16-bit PCM at one sample rate")
+
+    def prompt(self, text, q, output_path, voice, rate, backend, cache):
+        """A prompt after the checks: spliced, or whole if splicing is off for the voice or a fragment failed."""
+        if voice in self.disabled:
+            return self.whole(text, output_path, voice, rate, backend, cache)
+        spliced = self.spliced_prompt(q, voice, rate, backend)
+        if not spliced:
+            self.note_unspliceable(voice, spliced)
+            return spliced is not None and self.whole(text, output_path, voice, rate, backend, cache)
+        samples, sample_rate = spliced
+        write_wav(output_path, samples, sample_rate)
+        if cache is not None:  # for draft previews, which look prompts up by their whole text
+            cache.store(spliced_key(build_ssml(text, voice, rate), backend.output_format), output_path)
+        with self.lock:
+            self.spliced += 1
+        print(f"Spliced prompt ({voice}): {output_path}")
+        return True
+
+    def summary(self):
+        saved = 1 - self.chars_synthesized / self.chars_prompts if self.chars_prompts else 0.0
+        line = (f"Phrase splicing: {self.spliced} prompts spliced, {self.fragments_built} fragments synthesized, "
+                f"{self.fragments_reused} reused; {self.chars_synthesized} of {self.chars_prompts} prompt "
+                f"characters synthesized ({100 * saved:.0f}% saved)")
+        for voice, reason in self.disabled.items():
+            line += f"\n  splicing off for {voice}: {reason}"
+        return line
+
+
+def splicer_from_args(args):
+    """PhraseSplicer for --phrase-splice runs (None otherwise; batched requests are already one per section)."""
+    if not getattr(args, "phrase_splice", False):
+        return None
+    if args.batched:
+        log("--phrase-splice has no effect with --batched; synthesizing whole prompts.")
+        return None
+    return PhraseSplicer(args.fragment_dir or default_fragment_dir(args.cache_dir), args.prosody_sample)
+
+
+def default_fragment_dir(cache_dir):
+    """.tts_fragments next to the TTS cache: inside it, the cache's LRU eviction would delete fragments in use."""
+    return os.path.join(os.path.dirname(os.path.abspath(cache_dir)), ".tts_fragments")
@@ -0,0 +1,168 @@
+import os
+import sys
+import time
+import argparse
+import importlib
+import subprocess
+
+import metrics
+
+# ========= STAGES =========
+# Stage modules are imported only when their stage runs, so Pillow, numpy and
+# the Azure SDK (loaded by AzureBackend itself) are paid for only when used.
+STAGES = {
+    "intro": ("generate_intro", "Intro image and narration"),
+    "audio": ("generate_audio_segments_multi_voice", "TTS for every narration and question"),
+    "images": ("generate_question_images", "Narration, question and answer cards"),
+    "segments": ("generate_video_segments_and_merge", "Per-slide video segments"),
+    "loudness": ("loudness", "EBU R128 measurements and per-clip gains"),
+    "master": ("audio_master", "Native PCM master track"),
+    "timeline": ("timeline_render", "Single-pass render of the whole video"),
+    "stream": ("streaming_pipeline", "Streaming per-section render"),
+    "service": ("render_service", "Render service for job folders in a spool directory"),
+    "shard": ("sharded_render", "Segments rendered by workers on many hosts (plan/work/merge/local)"),
+    "renditions": ("renditions", "HLS rendition ladder encoded once from the segments"),
+    "draft": ("draft_preview", "Fast low-resolution preview of selected sections (--select 3,5:2)"),
+}
+MERGE_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "normalize_segments_and_merge_final.sh")
+RENDER_MODES = ("segments", "timeline", "stream", "sharded")
+
+
+# ========= LOG =========
+def log(msg): print(f"[DEBUG] {msg}")
+
+
+# ========= RUNNERS =========
+def run_stage(name, argv=None):
+    """Run one stage's main() in this process with its own CLI arguments."""
+    module = importlib.import_module(STAGES[name][0])
+    started = time.time()
+    with metrics.stage(name):
+        module.main(argv or [])
+    log(f"Stage {name} finished in {time.time() - started:.1f}s")
+
+
+def run_merge(data):
+    """Normalize + merge the segments (shell stage; ffmpeg does the work)."""
+    started = time.time()
+    with metrics.stage("merge"):
+        subprocess.run(["bash", MERGE_SCRIPT], check=True, env={**os.environ, "PROJECT_DIR": data})
+    log(f"Stage merge finished in {time.time() - started:.1f}s")
+
+
+def parse_all_args(argv=None):
+    parser = argparse.ArgumentParser(prog="python -m pipeline all",
+                                     description="Run every stage of the KNM pipeline in one process.")
+    parser.add_argument("--data", default="/data", help="Base project folder (mounted volume)")
+    parser.add_argument("--input", default=None, help="Input file (default: <data>/input.txt)")
+    parser.add_argument("--mode", choices=RENDER_MODES, default=os.getenv("RENDER_MODE", "segments"),
+                        help="segments: per-clip encode + merge, timeline: single ffmpeg pass, "
+                             "stream: overlapping per-section stages, "
+                             "sharded: segments claimed by local and remote workers via <data>/.shards (env RENDER_MODE)")
+    parser.add_argument("--renditions", action="store_true", default=os.getenv("RENDITIONS") == "1",
+                        help="Also encode the HLS ladder into <data>/final_video/hls (segments/sharded modes; env RENDITIONS=1)")
+    parser.add_argument("--metrics", default=metrics.DEFAULT_REPORT,
+                        help="JSON metrics report (default: <data>/final_video/metrics.json; env METRICS_REPORT)")
+    parser.add_argument("--profile", default=metrics.DEFAULT_PROFILE,
+                        help="Write a cProfile dump of the run to this path (env PROFILE_OUTPUT)")
+    args = parser.parse_args(argv)
+    if args.renditions and args.mode not in ("segments", "sharded"):
+        parser.error(f"--renditions needs per-slide segments (mode segments or sharded, not {args.mode})")
+    return args
+
+
+def run_all(argv=None):
+    """The full pipeline, as entrypoint.sh ran it, sharing parsed input, fonts and backends between stages."""
+    args = parse_all_args(argv)
+    data = args.data
+    input_file = args.input or os.path.join(data, "input.txt")
+    if not os.path.isdir(data):
+        log(f"ERROR: {data} directory not mounted. Use: -v $(pwd):/data")
+        sys.exit(1)
+    if not os.path.isfile(input_file):
+        log(f"ERROR: {input_file} not found. Place your input.txt inside your mounted project folder.")
+        sys.exit(1)
+
+    audio, images, scenes = (os.path.join(data, d) for d in ("output_audio", "output_images", "scenes"))
+    for folder in (audio, images, scenes, os.path.join(data, "segments"), os.path.join(data, "final_video"),
+                   os.path.join(data, "sounds")):
+        os.makedirs(folder, exist_ok=True)
+
+    report = args.metrics or os.path.join(data, "final_video", "metrics.json")
+    try:
+        with metrics.profiled(args.profile):
+            run_stages(args, data, input_file, audio, images, scenes)
+    finally:
+        final = os.path.join(data, "final_video", "final_video.mp4")
+        if os.path.isfile(final):
+            metrics.record("output", output=final, bytes=os.path.getsize(final))
+        metrics.METRICS.write(report)
+
+
+def run_stages(args, data, input_file, audio, images, scenes):
+    started = time.time()
+    log("Step 1: Generating intro...")
+    run_stage("intro", ["--input", input_file, "--output", audio, "--images", images, "--scenes", scenes])
+
+    if args.mode == "stream":
+        log("Steps 2-5: Streaming sections through TTS, images, segments and merge...")
+        run_stage("stream", ["--input", input_file, "--data", data, "--scenes", scenes])
+    else:
+        log("Step 2: Generating audio segments...")
+        run_stage("audio", ["--input", input_file, "--output", audio])
+        log("Step 3: Creating question images...")
+        run_stage("images", ["--input", input_file, "--output", images, "--scenes", scenes])
+        if args.mode == "timeline":
+            log("Step 4: Rendering final video in one pass (timeline mode)...")
+            run_stage("timeline", ["--data", data])
+        elif args.mode == "sharded":
+            log("Steps 4-5: Rendering segments with sharded workers, then merging...")
+            run_stage("shard", ["local", "--data", data])
+        else:
+            log("Step 4: Creating video segments...")
+            run_stage("segments", ["--data", data])
+            log("Step 5: Normalizing and merging final video...")
+            run_merge(data)
+        if args.renditions:
+            log("Step 6: Encoding the HLS rendition ladder...")
+            run_stage("renditions", ["--data", data])
+
+    log(f"All stages completed in {time.time() - started:.1f}s. "
+        f"Final video: {os.path.join(data, 'final_video', 'final_video.mp4')}")
+
+
+# ========= MAIN =========
+def usage():
+    lines = ["usage: python -m pipeline [all | merge | <stage>] [stage options]", "",
+             "  all        every stage in one process (default; see 'all --help')",
+             "  merge      normalize + merge segments (normalize_segments_and_merge_final.sh)"]
+    lines += [f"  {name:<10} {description} ({module}.py)" for name, (module, description) in STAGES.items()]
+    lines += ["", "Stage options are the same as the stage script's own (e.g. 'python -m pipeline audio --help')."]
+    return "\n".join(lines)
+
+
+def main(argv=None):
+    argv = list(sys.argv[1:] if argv is None else argv)
+    if argv[:1] in (["-h"], ["--help"]):
+        print(usage())
+        return
+    command = argv.pop(0) if argv and not argv[0].startswith("-") else "all"
+    if command == "all":
+        run_all(argv)
+    elif command == "merge":
+        run_merge(os.getenv("PROJECT_DIR", "/data"))
+    elif command in STAGES:
+        # Single stages report only when asked to (METRICS_REPORT / PROFILE_OUTPUT)
+        try:
+            with metrics.profiled(metrics.DEFAULT_PROFILE):
+                run_stage(command, argv)
+        finally:
+            if metrics.DEFAULT_REPORT:
+                metrics.METRICS.write(metrics.DEFAULT_REPORT)
+    else:
+        print(usage())
+        sys.exit(2)
+
+
+if __name__ == "__main__":
+    main()
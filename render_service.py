@@ -0,0 +1,296 @@
+import os
+import json
+import time
+import shutil
+import signal
+import socket
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+import metrics
+import generate_intro
+import streaming_pipeline
+import generate_question_images as cards
+from loudness import LoudnessCache
+from tts_cache import TTSCache, DEFAULT_CACHE_DIR, DEFAULT_MAX_MB
+from streaming_pipeline import StreamingPipeline, render_video
+from generate_video_segments_and_merge import log
+
+# ========= CONFIGURATION =========
+SPOOL_FOLDERS = ("incoming", "running", "done", "failed")
+STATUS_FILE = "status.json"
+OWNER_FILE = ".owner"  # in running/<job>: the claiming service, touched while it renders the job
+REPO_SOUNDS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "sounds")
+
+# job.json key -> option of the job's streaming pipeline (or intro, for intro_voice)
+JOB_OPTIONS = {
+    "voice_male": "--voice-male",
+    "voice_female": "--voice-female",
+    "speech_rate": "--speech-rate",
+    "tts_backend": "--tts-backend",
+    "intro_voice": "--voice",
+}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Render every job folder dropped into a spool directory, keeping TTS, fonts and caches warm.")
+    parser.add_argument("--spool", default=os.getenv("SPOOL_DIR", "/data/spool"),
+                        help="Spool directory with incoming/, running/, done/ and failed/ job folders (env SPOOL_DIR)")
+    parser.add_argument("--jobs", type=int, default=int(os.getenv("SERVICE_JOBS", "2")),
+                        help="Jobs rendered at once (env SERVICE_JOBS)")
+    parser.add_argument("--poll", type=float, default=float(os.getenv("SPOOL_POLL", "2")),
+                        help="Seconds between scans of incoming/ (env SPOOL_POLL)")
+    parser.add_argument("--lease-seconds", type=float, default=float(os.getenv("SPOOL_LEASE_SECONDS", "120")),
+                        help="A running job whose service stopped renewing it this long is requeued (env SPOOL_LEASE_SECONDS)")
+    parser.add_argument("--once", action="store_true",
+                        help="Render the jobs already waiting, then exit instead of watching")
+    parser.add_argument("--render-workers", type=int, default=int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 1)),
+                        help="Card render processes shared by all jobs")
+    parser.add_argument("--scenes", default=None,
+                        help="Scene library for jobs without their own scenes/ folder (default: <spool>/scenes)")
+    parser.add_argument("--sounds", default=REPO_SOUNDS, help="answer.mp3 for jobs without their own sounds/ folder")
+    parser.add_argument("--cache-dir", default=DEFAULT_CACHE_DIR, help="TTS cache shared by all jobs (env TTS_CACHE_DIR)")
+    parser.add_argument("--cache-max-mb", type=int, default=DEFAULT_MAX_MB, help="Size cap of the TTS cache")
+    parser.add_argument("--loudness-cache", default=os.getenv("LOUDNESS_CACHE"),
+                        help="Loudness measurements shared by all jobs (default: <spool>/.loudness/measurements.json)")
+    return parser.parse_args(argv)
+
+
+# ========= JOBS =========
+def write_status(job_dir, **status):
+    path = os.path.join(job_dir, STATUS_FILE)
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"job": os.path.basename(job_dir), **status}, f, indent=1)
+    os.replace(tmp, path)
+
+
+def read_job_config(job_dir):
+    """Options from the job's job.json (voices, speech rate, TTS backend); {} without one."""
+    path = os.path.join(job_dir, "job.json")
+    if not os.path.exists(path):
+        return {}
+    with open(path, "r", encoding="utf-8") as f:
+        config = json.load(f)
+    unknown = sorted(set(config) - set(JOB_OPTIONS))
+    if unknown:
+        raise ValueError(f"unknown job.json keys: {', '.join(unknown)} (expected: {', '.join(JOB_OPTIONS)})")
+    return config
+
+
+def job_options(config, keys):
+    # --opt=value, so values such as a "-10%" speech rate are not taken for options
+    return [f"{JOB_OPTIONS[key]}={config[key]}" for key in keys if config.get(key)]
+
+
+# ========= SERVICE =========
+class RenderService:
+    """Claims job folders from <spool>/incoming and renders each with the streaming pipeline.
+
+    A job folder holds input.txt and optionally intro.txt, scenes/, sounds/ and
+    job.json; it is the job's /data, so the final video lands in
+    <job>/final_video/final_video.mp4 next to status.json. Claiming is an
+    atomic rename into running/, so several services can share a spool: the
+    claiming service keeps running/<job>/.owner fresh, and a job is requeued
+    only once its owner has stopped renewing it. The render pool, TTS backend pools, TTS cache, loudness measurements,
+    fonts and scene templates live as long as the service, not the job.
+    """
+
+    def __init__(self, args):
+        self.args = args
+        self.folders = {name: os.path.join(args.spool, name) for name in SPOOL_FOLDERS}
+        for folder in self.folders.values():
+            os.makedirs(folder, exist_ok=True)
+        self.scenes = args.scenes or os.path.join(args.spool, "scenes")
+        self.stop = threading.Event()
+        self.owner = {"host": socket.gethostname(), "pid": os.getpid()}
+        self.owned, self.owned_lock = set(), threading.Lock()
+        self.render_pool = ProcessPoolExecutor(max_workers=max(1, args.render_workers), initializer=cards.get_renderer)
+        self.tts_cache = TTSCache(args.cache_dir, args.cache_max_mb)
+        self.loudness = LoudnessCache(args.loudness_cache or os.path.join(args.spool, ".loudness", "measurements.json"))
+        self.completed = self.failed = 0
+
+    def lease_age(self, job_dir):
+        """Seconds since the job's owner last renewed it (since the claim, before .owner is written)."""
+        try:
+            return time.time() - os.stat(os.path.join(job_dir, OWNER_FILE)).st_mtime
+        except FileNotFoundError:
+            return time.time() - os.stat(job_dir).st_ctime  # the claiming rename sets ctime
+
+    def recover(self):
+        """Requeue jobs in running/ whose service stopped mid-render; their build state makes the rerun incremental.
+
+        Jobs another live service is rendering keep a fresh .owner and are left alone.
+        """
+        for name in sorted(os.listdir(self.folders["running"])):
+            job_dir = os.path.join(self.folders["running"], name)
+            with self.owned_lock:
+                if job_dir in self.owned:
+                    continue
+            try:
+                age = self.lease_age(job_dir)
+                if age < self.args.lease_seconds:
+                    continue
+                os.rename(job_dir, os.path.join(self.folders["incoming"], name))
+            except OSError:
+                continue  # finished or requeued by another service in the meantime
+            log(f"Requeueing interrupted job {name} (owner silent for {age:.0f}s)")
+
+    def heartbeat(self):
+        """Renew the .owner file of every job this service is rendering."""
+        while not self.stop.wait(self.args.lease_seconds / 3):
+            with self.owned_lock:
+                jobs = list(self.owned)
+            for job_dir in jobs:
+                try:
+                    os.utime(os.path.join(job_dir, OWNER_FILE))
+                except FileNotFoundError:
+                    pass
+
+    def pending(self):
+        """Complete job folders in incoming/, oldest first (hidden names are still being copied in)."""
+        incoming = self.folders["incoming"]
+        jobs = [entry for entry in os.scandir(incoming)
+                if entry.is_dir() and not entry.name.startswith(".")
+                and os.path.isfile(os.path.join(entry.path, "input.txt"))]
+        return [entry.name for entry in sorted(jobs, key=lambda entry: entry.stat().st_mtime)]
+
+    def claim(self, name):
+        running = os.path.join(self.folders["running"], name)
+        try:
+            os.rename(os.path.join(self.folders["incoming"], name), running)
+        except OSError:
+            return None  # claimed by another service in the meantime
+        with open(os.path.join(running, OWNER_FILE), "w", encoding="utf-8") as f:
+            json.dump(self.owner, f)
+        with self.owned_lock:
+            self.owned.add(running)
+        return running
+
+    def finish(self, job_dir, status):
+        """Write the final status and move the job to done/ or failed/; returns its new folder."""
+        target = os.path.join(self.folders[status["state"]], os.path.basename(job_dir))
+        if status.get("output"):
+            status["output"] = os.path.join(target, os.path.relpath(status["output"], job_dir))
+        write_status(job_dir, **status)
+        if os.path.exists(target):
+            shutil.rmtree(target)  # a resubmitted job replaces its previous result
+        os.rename(job_dir, target)
+        with self.owned_lock:
+            self.owned.discard(job_dir)
+        try:
+            os.remove(os.path.join(target, OWNER_FILE))
+        except FileNotFoundError:
+            pass
+        return target
+
+    def run_job(self, job_dir):
+        # The job's own metrics go to <job>/final_video/metrics.json and are dropped from memory afterwards
+        with metrics.scoped() as job_metrics:
+            status = self.render_job(job_dir, job_metrics)
+        name = os.path.basename(job_dir)
+        target = self.finish(job_dir, status)
+        if status["state"] == "done":
+            self.completed += 1
+        else:
+            self.failed += 1
+        log(f"[{name}] Job {status['state']} in {status['seconds']:.1f}s: {target}")
+        return status
+
+    def render_job(self, job_dir, job_metrics):
+        """Render one claimed job; returns its final status."""
+        name = os.path.basename(job_dir)
+        started = time.time()
+        status = {"state": "running", "started": time.strftime("%Y-%m-%dT%H:%M:%S")}
+        write_status(job_dir, **status)
+        log(f"[{name}] Job started")
+        try:
+            config = read_job_config(job_dir)
+            sounds = os.path.join(job_dir, "sounds")
+            if not os.path.exists(os.path.join(sounds, "answer.mp3")):
+                os.makedirs(sounds, exist_ok=True)
+                shutil.copy(os.path.join(self.args.sounds, "answer.mp3"), sounds)
+            scenes = os.path.join(job_dir, "scenes")
+            if not os.path.isdir(scenes):
+                scenes = self.scenes
+            input_file = os.path.join(job_dir, "input.txt")
+            intro_file = os.path.join(job_dir, "intro.txt")
+            state_dir = os.path.join(job_dir, ".build")  # never BUILD_STATE_DIR: jobs run side by side
+
+            generate_intro.main(["--input", intro_file if os.path.exists(intro_file) else input_file,
+                                 "--output", os.path.join(job_dir, "output_audio"),
+                                 "--images", os.path.join(job_dir, "output_images"), "--scenes", scenes,
+                                 "--state-dir", state_dir]
+                                + job_options(config, ("intro_voice", "tts_backend")))
+            args = streaming_pipeline.parse_args(
+                ["--input", input_file, "--data", job_dir, "--scenes", scenes, "--state-dir", state_dir,
+                 "--cache-dir", self.args.cache_dir, "--render-workers", str(self.args.render_workers)]
+                + job_options(config, ("voice_male", "voice_female", "speech_rate", "tts_backend")))
+            pipeline = StreamingPipeline(args, self.render_pool, self.tts_cache, self.loudness)
+            final, finished = render_video(pipeline)
+
+            failed = [{"section": item.label, "error": item.error} for item in finished if item.error]
+            status.update(
+                state="failed" if failed or not final else "done",
+                output=final,
+                sections=len(finished),
+                failed_sections=failed,
+                first_section_seconds=round(pipeline.first_done, 2) if pipeline.first_done is not None else None,
+            )
+            if not final:
+                status["error"] = "nothing rendered; check input.txt"
+        except (Exception, SystemExit) as e:  # stages exit(1) on fatal errors; that ends the job, not the service
+            status.update(state="failed", error=f"{type(e).__name__}: {e}")
+        status.update(finished=time.strftime("%Y-%m-%dT%H:%M:%S"), seconds=round(time.time() - started, 2))
+        status["metrics"] = job_metrics.summary()
+        try:
+            job_metrics.write(os.path.join(job_dir, "final_video", "metrics.json"))
+        except OSError as e:
+            log(f"[{name}] Could not write the job's metrics: {e}")
+        return status
+
+    def serve(self):
+        self.recover()
+        log(f"Render service watching {self.folders['incoming']} ({self.args.jobs} concurrent job(s))")
+        running, recovered = set(), time.time()
+        threading.Thread(target=self.heartbeat, name="owner-heartbeat", daemon=True).start()
+        with ThreadPoolExecutor(max_workers=max(1, self.args.jobs), thread_name_prefix="job") as executor:
+            while not self.stop.is_set():
+                if time.time() - recovered > self.args.lease_seconds:
+                    self.recover()  # pick up the jobs of services that died since
+                    recovered = time.time()
+                for name in self.pending()[:max(1, self.args.jobs) - len(running)]:
+                    job_dir = self.claim(name)
+                    if job_dir:
+                        running.add(executor.submit(self.run_job, job_dir))
+                if self.args.once and not running:
+                    break
+                if running:
+                    finished, _ = wait(running, timeout=self.args.poll, return_when=FIRST_COMPLETED)
+                    running -= finished
+                else:
+                    self.stop.wait(self.args.poll)
+            if running:
+                log(f"Stopping: waiting for {len(running)} running job(s)...")
+        self.close()
+
+    def close(self):
+        self.render_pool.shutdown()
+        self.loudness.save()
+        log(f"Render service stopped: {self.completed} job(s) done, {self.failed} failed. {self.tts_cache.summary()}")
+
+
+# ========= MAIN =========
+def main(argv=None):
+    args = parse_args(argv)
+    log("=== KNM Render Service ===")
+    service = RenderService(args)
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        signal.signal(sig, lambda *_: service.stop.set())  # finish running jobs, claim no new ones
+    service.serve()
+
+
+if __name__ == "__main__":
+    main()
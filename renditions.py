@@ -0,0 +1,272 @@
+import os
+import re
+import shutil
+import argparse
+import subprocess
+
+from build_state import digest, stage_state
+from timeline_render import concat_entry
+from generate_video_segments_and_merge import (
+    log, run_ffmpeg, ffmpeg_error, media_duration, data_paths,
+)
+
+# ========= CONFIGURATION =========
+# name -> (height, max video bitrate); "audio" is the audio-only track for mobile
+RUNGS = {
+    "1080p": (1080, "5000k"),
+    "720p": (720, "2800k"),
+    "480p": (480, "1200k"),
+    "360p": (360, "700k"),
+    "audio": (None, None),
+}
+DEFAULT_LADDER = "1080p,720p,480p,audio"  # limited to the segments' height; RENDITION_LADDER replaces it
+VIDEO_ARGS = ["-c:v", "libx264", "-preset", "veryfast", "-crf", "21", "-tune", "stillimage",
+              "-profile:v", "high", "-pix_fmt", "yuv420p", "-sc_threshold", "0", "-g", "100000"]
+AUDIO_BITRATE = "128k"         # muxed into every video rendition
+AUDIO_ONLY_BITRATE = os.getenv("RENDITION_AUDIO_BITRATE", "96k")
+MAX_SEGMENT = float(os.getenv("HLS_MAX_SEGMENT", "6"))  # long narrations get an extra keyframe/segment this often
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Encode the merged segments once into an HLS (fMP4) rendition ladder with a segment per slide.")
+    parser.add_argument("--data", default="/data", help="Base project folder (segments/list.txt from the segment stage)")
+    parser.add_argument("--output", default=None, help="HLS output folder (default: <data>/final_video/hls)")
+    parser.add_argument("--ladder", default=os.getenv("RENDITION_LADDER") or None,
+                        help=f"Comma-separated renditions from {', '.join(RUNGS)} "
+                             f"(default: {DEFAULT_LADDER} up to the segments' height; env RENDITION_LADDER)")
+    parser.add_argument("--ffmpeg-threads", type=int, default=0,
+                        help="-threads for the ladder encode (default: all cores; it is one ffmpeg process)")
+    parser.add_argument("--force", action="store_true", default=None,
+                        help="Re-encode even if the segments and ladder are unchanged (env FORCE_REBUILD=1)")
+    return parser.parse_args(argv)
+
+
+# ========= SOURCE =========
+def ordered_segments(segments_dir):
+    """Segments in play order, as normalize_segments_and_merge_final.sh merges them.
+
+    list.txt order, each *_answer.mp4 right after its base clip, no duplicates.
+    """
+    list_file = os.path.join(segments_dir, "list.txt")
+    if not os.path.isfile(list_file):
+        raise FileNotFoundError(f"{list_file} not found. Run the segment stage first.")
+    ordered, seen = [], set()
+
+    def add(path):
+        if os.path.isfile(path) and os.path.basename(path) not in seen:
+            seen.add(os.path.basename(path))
+            ordered.append(path)
+
+    with open(list_file, "r", encoding="utf-8") as f:
+        for line in f:
+            match = re.match(r"file '(.+)'$", line.strip())
+            if match:
+                add(match.group(1))
+                add(f"{os.path.splitext(match.group(1))[0]}_answer.mp4")
+    return ordered
+
+
+def video_height(path):
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-select_streams", "v:0", "-show_entries", "stream=height", "-of", "csv=p=0", path],
+        stdout=subprocess.PIPE, stderr=subprocess.PIPE, check=True)
+    return int(result.stdout.decode().strip())
+
+
+def chapter_title(name):
+    match = re.match(r"script_(\d+)(?:_q(\d+))?$", name)
+    if not match:
+        return "Intro" if "intro" in name else name
+    script, question = match.groups()
+    return f"Script {int(script)}" + (f" - Question {int(question)}" if question else "")
+
+
+def chapters(segments):
+    """[(start, end, title)] with each answer slide folded into its question."""
+    result, start = [], 0.0
+    for path in segments:
+        end = start + media_duration(path)
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name.endswith("_answer") and result:
+            result[-1] = (result[-1][0], end, result[-1][2])
+        else:
+            result.append((start, end, chapter_title(name)))
+        start = end
+    return result
+
+
+def keyframe_times(chapter_list, max_segment=MAX_SEGMENT):
+    """Every chapter start, plus every max_segment seconds inside long chapters (never leaving a short tail)."""
+    times = []
+    for start, end, _ in chapter_list:
+        times.append(start)
+        t = start + max_segment
+        while t < end - max_segment / 2:
+            times.append(t)
+            t += max_segment
+    return times[1:]  # the first frame is a keyframe anyway
+
+
+def vtt_time(seconds):
+    ms = int(round(seconds * 1000))
+    return f"{ms // 3600000:02d}:{ms // 60000 % 60:02d}:{ms // 1000 % 60:02d}.{ms % 1000:03d}"
+
+
+def write_chapters(chapter_list, path):
+    """WebVTT chapters, so players can list and seek to every question."""
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("WEBVTT\n")
+        for i, (start, end, title) in enumerate(chapter_list, 1):
+            f.write(f"\n{i}\n{vtt_time(start)} --> {vtt_time(end)}\n{title}\n")
+
+
+# ========= LADDER =========
+def ladder_rungs(ladder, source_height):
+    """(name, height, bitrate) of the requested renditions, without upscaling past the source.
+
+    ladder None is DEFAULT_LADDER. Rungs taller than the source are dropped
+    with a note, so the ladder never lists a rendition it cannot produce.
+    """
+    ladder = ladder or DEFAULT_LADDER
+    rungs, dropped = [], []
+    for name in (n.strip() for n in ladder.split(",") if n.strip()):
+        if name not in RUNGS:
+            raise ValueError(f"unknown rendition '{name}' (expected: {', '.join(RUNGS)})")
+        height, bitrate = RUNGS[name]
+        if height and height > source_height:
+            dropped.append(name)
+            continue
+        rungs.append((name, height, bitrate))
+    if not rungs:
+        raise ValueError(f"no rendition of '{ladder}' fits {source_height}p segments")
+    if dropped:
+        log(f"Dropping {', '.join(dropped)} from the ladder: the segments are only {source_height}p "
+            f"(raise VIDEO_SIZE for taller renditions)")
+    return rungs
+
+
+def hls_args(out_dir, segment_seconds):
+    return ["-f", "hls", "-hls_time", str(segment_seconds), "-hls_playlist_type", "vod",
+            "-hls_segment_type", "fmp4", "-hls_flags", "independent_segments",
+            "-hls_fmp4_init_filename", "init.mp4", "-hls_segment_filename", os.path.join(out_dir, "%v", "seg_%05d.m4s")]
+
+
+def ladder_command(concat_file, rungs, keyframes, out_dir, threads=0):
+    """One ffmpeg run: decode the merged segments once, split the picture to every video rung.
+
+    Video renditions get keyframes only at the given times, and an HLS segment
+    starts at every keyframe, so each question starts a segment. The
+    audio-only rendition goes to a second HLS output with MAX_SEGMENT-second
+    segments (every audio frame is a keyframe).
+    """
+    video = [(name, height, bitrate) for name, height, bitrate in rungs if height]
+    cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", concat_file]
+    if threads:
+        cmd += ["-threads", str(threads)]
+    if video:
+        forced = ",".join(f"{max(0.0, t - 0.001):.3f}" for t in keyframes)
+        graph = [f"[0:v]split={len(video)}" + "".join(f"[s{i}]" for i in range(len(video)))]
+        graph += [f"[s{i}]scale=-2:{height},setsar=1[v{i}]" for i, (_, height, _) in enumerate(video)]
+        cmd += ["-filter_complex", ";".join(graph)]
+        for i, (_, _, bitrate) in enumerate(video):
+            cmd += ["-map", f"[v{i}]", "-map", "0:a"]
+            cmd += [f"-maxrate:v:{i}", bitrate, f"-bufsize:v:{i}", f"{2 * int(bitrate.rstrip('k'))}k",
+                    f"-force_key_frames:v:{i}", forced]  # per stream: without a specifier only the first one gets it
+        cmd += VIDEO_ARGS
+        cmd += ["-c:a", "aac", "-b:a", AUDIO_BITRATE, "-ar", "44100", "-ac", "2"]
+        cmd += hls_args(out_dir, 0.1) + [
+            "-master_pl_name", "master.m3u8",
+            "-var_stream_map", " ".join(f"v:{i},a:{i},name:{name}" for i, (name, _, _) in enumerate(video)),
+            os.path.join(out_dir, "%v", "index.m3u8"),
+        ]
+    if any(height is None for _, height, _ in rungs):
+        cmd += ["-map", "0:a", "-c:a", "aac", "-b:a", AUDIO_ONLY_BITRATE, "-ar", "44100", "-ac", "2"]
+        cmd += hls_args(out_dir, MAX_SEGMENT) + [
+            "-master_pl_name", "audio_master.m3u8", "-var_stream_map", "a:0,name:audio",
+            os.path.join(out_dir, "%v", "index.m3u8"),
+        ]
+    return cmd
+
+
+def combine_masters(out_dir):
+    """Add the audio-only variant to master.m3u8 (ffmpeg writes one master per HLS output)."""
+    master, audio_master = os.path.join(out_dir, "master.m3u8"), os.path.join(out_dir, "audio_master.m3u8")
+    if not os.path.exists(audio_master):
+        return
+    with open(audio_master, "r", encoding="utf-8") as f:
+        audio_lines = [line.rstrip("\n") for line in f]
+    os.remove(audio_master)
+    if not os.path.exists(master):
+        with open(master, "w", encoding="utf-8") as f:
+            f.write("\n".join(audio_lines) + "\n")
+        return
+    variant = [line for line in audio_lines if line.startswith("#EXT-X-STREAM-INF") or line.endswith(".m3u8")]
+    with open(master, "a", encoding="utf-8") as f:
+        f.write("\n".join(variant) + "\n")
+
+
+def render_ladder(data, out_dir=None, ladder=None, threads=0, force=None):
+    """Encode the HLS ladder into out_dir (swapped in complete); returns the master playlist path."""
+    paths = data_paths(data)
+    out_dir = out_dir or os.path.join(paths.final, "hls")
+    segments = ordered_segments(paths.segments)
+    if not segments:
+        raise FileNotFoundError(f"No segments listed in {paths.segments}/list.txt")
+    rungs = ladder_rungs(ladder, video_height(segments[0]))
+    master = os.path.join(out_dir, "master.m3u8")
+
+    state = stage_state("renditions", data, force)
+    key = digest("renditions", [state.file_digest(path) for path in segments], rungs, VIDEO_ARGS,
+                 AUDIO_BITRATE, AUDIO_ONLY_BITRATE, MAX_SEGMENT)
+    if state.fresh(master, key):
+        log(f"Segments and ladder unchanged; {master} is up to date.")
+        return master
+
+    chapter_list = chapters(segments)
+    tmp_dir = f"{out_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    os.makedirs(tmp_dir)
+    concat_file = os.path.join(tmp_dir, "segments.ffconcat")
+    with open(concat_file, "w", encoding="utf-8") as f:
+        f.write("ffconcat version 1.0\n")
+        for path in segments:
+            f.write(f"{concat_entry(path)}\n")
+
+    log(f"Encoding {len(segments)} segments ({chapter_list[-1][1]:.0f}s) once into: "
+        f"{', '.join(name for name, _, _ in rungs)}")
+    ok, stderr = run_ffmpeg(ladder_command(concat_file, rungs, keyframe_times(chapter_list), tmp_dir, threads))
+    os.remove(concat_file)
+    if not ok:
+        raise RuntimeError(ffmpeg_error(stderr))
+    combine_masters(tmp_dir)
+    write_chapters(chapter_list, os.path.join(tmp_dir, "chapters.vtt"))
+
+    # Publish the complete ladder at once; players never see a half-written one
+    if os.path.exists(out_dir):
+        old = f"{out_dir}.old"
+        shutil.rmtree(old, ignore_errors=True)
+        os.rename(out_dir, old)
+        os.rename(tmp_dir, out_dir)
+        shutil.rmtree(old)
+    else:
+        os.rename(tmp_dir, out_dir)
+    state.record(master, key)
+    state.save()
+    log(f"HLS ladder ready: {master} ({len(chapter_list)} chapters in chapters.vtt)")
+    return master
+
+
+# ========= MAIN =========
+def main(argv=None):
+    args = parse_args(argv)
+    log("=== KNM Rendition Ladder (HLS) ===")
+    try:
+        render_ladder(args.data, args.output, args.ladder, args.ffmpeg_threads, args.force)
+    except (RuntimeError, ValueError, FileNotFoundError) as e:
+        log(f"ERROR: {e}")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
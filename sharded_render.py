@@ -0,0 +1,424 @@
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+from build_state import stage_state
+from generate_video_segments_and_merge import (
+    log, data_paths, match_images_and_audios, segment_key, create_video_segment, create_still_segment,
+    encode_shared_audio, write_concat_list, default_jobs, DEFAULT_FFMPEG_THREADS,
+)
+
+# ========= CONFIGURATION =========
+MANIFEST_VERSION = 1
+DEFAULT_LEASE_SECONDS = float(os.getenv("SHARD_LEASE_SECONDS", "120"))  # a lease not renewed for this long is up for grabs
+DEFAULT_MAX_ATTEMPTS = int(os.getenv("SHARD_MAX_ATTEMPTS", "3"))
+DEFAULT_POLL = float(os.getenv("SHARD_POLL", "2"))
+
+
+def default_shard_dir(data):
+    return os.getenv("SHARD_DIR") or os.path.join(data, ".shards")
+
+
+def default_worker_id():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+
+# ========= SHARED DIRECTORY =========
+def write_json(path, data):
+    """Atomic write that is also safe between hosts: unique temp name, then rename."""
+    tmp = f"{path}.{socket.gethostname()}.{os.getpid()}.{threading.get_ident()}.tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, indent=1)
+    os.replace(tmp, path)
+
+
+def read_json(path):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+class ShardQueue:
+    """Work manifest, leases and completion records of one sharded render.
+
+    <shard_dir>/manifest.json lists the segments. A worker owns an item while
+    leases/<id>.lease exists and its mtime is younger than the lease time;
+    the lease is created with O_EXCL and renewed by touching it. An expired
+    lease is taken over by renaming it away, which only one worker can do;
+    if what was renamed turns out to be a newer lease, it is put back.
+    Finished items get done/<id>.json (matched by segment key), failed
+    attempts failed/<id>.json. Every host must see the shared directory and
+    the project files under the same paths.
+    """
+
+    def __init__(self, shard_dir):
+        self.shard_dir = shard_dir
+        self.manifest_path = os.path.join(shard_dir, "manifest.json")
+        self.leases, self.done, self.failed = (os.path.join(shard_dir, d) for d in ("leases", "done", "failed"))
+
+    def reset(self):
+        for folder in (self.leases, self.done, self.failed):
+            shutil.rmtree(folder, ignore_errors=True)
+            os.makedirs(folder)
+
+    def manifest(self):
+        manifest = read_json(self.manifest_path)
+        if manifest is None or manifest.get("version") != MANIFEST_VERSION:
+            raise FileNotFoundError(f"No sharded render planned in {self.shard_dir} (run 'plan' first)")
+        return manifest
+
+    # ----- records -----
+    def is_done(self, item):
+        record = read_json(os.path.join(self.done, f"{item['id']}.json"))
+        return record is not None and record.get("key") == item["key"]
+
+    def attempts(self, item):
+        record = read_json(os.path.join(self.failed, f"{item['id']}.json"))
+        return record["attempts"] if record and record.get("key") == item["key"] else 0
+
+    def complete(self, item, worker, seconds):
+        write_json(os.path.join(self.done, f"{item['id']}.json"), {
+            "id": item["id"], "output": item["output"], "key": item["key"], "worker": worker,
+            "seconds": round(seconds, 3), "finished": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        })
+
+    def fail(self, item, worker, error):
+        write_json(os.path.join(self.failed, f"{item['id']}.json"), {
+            "id": item["id"], "output": item["output"], "key": item["key"], "worker": worker,
+            "attempts": self.attempts(item) + 1, "error": error,
+        })
+
+    def progress(self, items, max_attempts):
+        """(done, permanently failed, remaining) item lists."""
+        done, failed, remaining = [], [], []
+        for item in items:
+            if self.is_done(item):
+                done.append(item)
+            elif self.attempts(item) >= max_attempts:
+                failed.append(item)
+            else:
+                remaining.append(item)
+        return done, failed, remaining
+
+    # ----- leases -----
+    def lease_path(self, item):
+        return os.path.join(self.leases, f"{item['id']}.lease")
+
+    def claim(self, item, worker, lease_seconds):
+        """True if worker now holds the item's lease."""
+        path = self.lease_path(item)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                try:
+                    seen = os.stat(path).st_mtime
+                except FileNotFoundError:
+                    continue  # released just now; try again
+                age = time.time() - seen
+                if age < lease_seconds:
+                    return False
+                holder = read_json(path) or {}
+                expired = f"{path}.expired.{worker}"
+                try:
+                    os.rename(path, expired)  # only one worker wins the takeover
+                except FileNotFoundError:
+                    return False
+                if os.stat(expired).st_mtime != seen or (read_json(expired) or {}) != holder:
+                    # Another worker took the expired lease over first and this rename moved its new one
+                    try:
+                        os.link(expired, path)
+                    except FileExistsError:
+                        pass
+                    os.remove(expired)
+                    return False
+                os.remove(expired)
+                log(f"Lease on item {item['id']} held by {holder.get('worker', '?')} expired after {age:.0f}s; retrying it")
+                continue
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump({"worker": worker, "host": socket.gethostname(), "pid": os.getpid(), "claimed": time.time()}, f)
+            return True
+        return False
+
+    def holds(self, item, worker):
+        return (read_json(self.lease_path(item)) or {}).get("worker") == worker
+
+    def renew(self, item, worker):
+        if self.holds(item, worker):
+            try:
+                os.utime(self.lease_path(item))
+            except FileNotFoundError:
+                pass
+
+    def release(self, item, worker):
+        if self.holds(item, worker):
+            try:
+                os.remove(self.lease_path(item))
+            except FileNotFoundError:
+                pass
+
+
+# ========= PLAN =========
+def plan(data, shard_dir, still=False, ffmpeg_threads=DEFAULT_FFMPEG_THREADS, loudness=True, force=None):
+    """Write the manifest of every segment; segments that are already up to date are recorded as done."""
+    paths = data_paths(data)
+    os.makedirs(paths.segments, exist_ok=True)
+    pairs = match_images_and_audios(data)
+    if not pairs:
+        raise RuntimeError("No valid image/audio pairs found. Check filenames.")
+
+    gains = {}
+    if loudness:
+        from loudness import clip_gains, default_cache_path
+        gains = clip_gains([aud for _, aud, _ in pairs], default_cache_path(data))
+    shared_audio = {}
+    if still:
+        # Encoded once here, so workers never race on the shared track
+        for aud in {aud for _, aud, out in pairs if out.endswith("_answer.mp4")}:
+            shared_audio[aud] = encode_shared_audio(aud, paths.segments, gains.get(aud, 0.0))
+
+    state = stage_state("segments", data, force)
+    items = []
+    for i, (img, aud, out) in enumerate(pairs):
+        gain = gains.get(aud, 0.0)
+        items.append({
+            "id": f"{i:05d}", "image": os.path.abspath(img), "audio": os.path.abspath(aud),
+            "output": os.path.abspath(out), "gain": gain,
+            "shared_audio": shared_audio.get(aud),
+            "key": segment_key(state, img, aud, still, gain),
+        })
+
+    queue = ShardQueue(shard_dir)
+    os.makedirs(shard_dir, exist_ok=True)
+    queue.reset()
+    fresh = 0
+    for item in items:
+        if state.fresh(item["output"], item["key"]):
+            queue.complete(item, "plan", 0.0)
+            fresh += 1
+    write_json(queue.manifest_path, {
+        "version": MANIFEST_VERSION, "data": os.path.abspath(data), "created": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "still": still, "ffmpeg_threads": ffmpeg_threads, "items": items,
+    })
+    log(f"Planned {len(items)} segments in {shard_dir}: {len(items) - fresh} to render, {fresh} up to date")
+    return items
+
+
+# ========= WORK =========
+def render_item(item, manifest, worker):
+    """Encode one segment into a worker-private file, then publish it with an atomic rename."""
+    root, ext = os.path.splitext(item["output"])
+    tmp = f"{root}.{worker}.part{ext}"
+    try:
+        if manifest["still"]:
+            shared = tuple(item["shared_audio"]) if item["shared_audio"] else None
+            create_still_segment(item["image"], item["audio"], tmp, manifest["ffmpeg_threads"], shared, item["gain"])
+        else:
+            create_video_segment(item["image"], item["audio"], tmp, manifest["ffmpeg_threads"], item["gain"])
+        os.replace(tmp, item["output"])
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+
+def work(shard_dir, worker=None, jobs=None, lease_seconds=DEFAULT_LEASE_SECONDS, max_attempts=DEFAULT_MAX_ATTEMPTS,
+         poll=DEFAULT_POLL):
+    """Claim and render items until every item is done or out of attempts; returns items rendered here."""
+    worker = worker or default_worker_id()
+    queue = ShardQueue(shard_dir)
+    manifest = queue.manifest()
+    items = manifest["items"]
+    jobs = jobs or default_jobs(manifest["ffmpeg_threads"])
+    held, held_lock, stop = {}, threading.Lock(), threading.Event()
+    rendered = []
+
+    def heartbeat():
+        while not stop.wait(lease_seconds / 3):
+            with held_lock:
+                current = list(held.values())
+            for item in current:
+                queue.renew(item, worker)
+
+    def next_item():
+        for item in items:
+            if not queue.is_done(item) and queue.attempts(item) < max_attempts and queue.claim(item, worker, lease_seconds):
+                if queue.is_done(item):  # finished by another worker between the check and the claim
+                    queue.release(item, worker)
+                    continue
+                return item
+        return None
+
+    def run():
+        while True:
+            item = next_item()
+            if item is None:
+                _, _, remaining = queue.progress(items, max_attempts)
+                if not remaining:
+                    return
+                time.sleep(poll)  # the rest is leased elsewhere; pick it up if a lease expires
+                continue
+            with held_lock:
+                held[item["id"]] = item
+            started = time.time()
+            try:
+                render_item(item, manifest, worker)
+                queue.complete(item, worker, time.time() - started)
+                rendered.append(item["id"])
+            except Exception as e:
+                log(f"Item {item['id']} ({item['output']}) failed: {e}")
+                queue.fail(item, worker, str(e))
+            finally:
+                with held_lock:
+                    held.pop(item["id"], None)
+                queue.release(item, worker)
+
+    log(f"Worker {worker}: {len(items)} items in {shard_dir}, {jobs} concurrent encode(s)")
+    threading.Thread(target=heartbeat, name="lease-heartbeat", daemon=True).start()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as pool:
+            for future in [pool.submit(run) for _ in range(max(1, jobs))]:
+                future.result()
+    finally:
+        stop.set()
+    log(f"Worker {worker} finished: rendered {len(rendered)} item(s)")
+    return rendered
+
+
+# ========= MERGE =========
+def merge(shard_dir, max_attempts=DEFAULT_MAX_ATTEMPTS, poll=DEFAULT_POLL, timeout=None, workers_alive=None):
+    """Wait for every item, then record the segments in the build state and run the ordered merge.
+
+    workers_alive, if given, reports whether any worker is still running; the
+    wait fails once none is and items are left.
+    """
+    from pipeline import run_merge
+
+    queue = ShardQueue(shard_dir)
+    manifest = queue.manifest()
+    items, data = manifest["items"], manifest["data"]
+    started, reported = time.time(), None
+    while True:
+        alive = workers_alive is None or workers_alive()  # before the check, so a last completion is not missed
+        done, failed, remaining = queue.progress(items, max_attempts)
+        if not remaining:
+            break
+        if not alive:
+            raise RuntimeError(f"All workers exited with {len(remaining)} of {len(items)} segments unfinished")
+        if timeout and time.time() - started > timeout:
+            raise TimeoutError(f"{len(remaining)} of {len(items)} segments still unfinished after {timeout:.0f}s")
+        if reported != len(done):
+            log(f"Waiting for segments: {len(done)} of {len(items)} done, {len(failed)} failed")
+            reported = len(done)
+        time.sleep(poll)
+
+    if failed:
+        for item in failed:
+            record = read_json(os.path.join(queue.failed, f"{item['id']}.json")) or {}
+            log(f"  {item['output']}: {record.get('error')}")
+        raise RuntimeError(f"{len(failed)} of {len(items)} segments failed {max_attempts} time(s)")
+
+    state = stage_state("segments", data)
+    for item in items:
+        state.record(item["output"], item["key"])
+    state.save()
+    write_concat_list([item["output"] for item in items], data_paths(data).segments)
+    log(f"All {len(items)} segments rendered; merging...")
+    run_merge(data)
+
+
+def run_local(data, shard_dir, workers, args):
+    """plan + `workers` worker processes on this machine + merge."""
+    plan(data, shard_dir, args.still, args.ffmpeg_threads, not args.no_loudness, args.force)
+    cmd = [sys.executable, os.path.abspath(__file__), "work", "--shard-dir", shard_dir,
+           "--lease-seconds", str(args.lease_seconds), "--max-attempts", str(args.max_attempts)]
+    if args.jobs:
+        cmd += ["--jobs", str(args.jobs)]
+    procs = [subprocess.Popen(cmd + ["--worker-id", f"{socket.gethostname()}-local{i}"]) for i in range(max(1, workers))]
+    try:
+        merge(shard_dir, args.max_attempts, args.poll, workers_alive=lambda: any(p.poll() is None for p in procs))
+    finally:
+        for proc in procs:
+            proc.wait()
+
+
+# ========= MAIN =========
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Render the segments of one video across many worker processes/hosts sharing a directory.")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def common(sub, data=True):
+        if data:
+            sub.add_argument("--data", default="/data", help="Base project folder (same path on every host)")
+        sub.add_argument("--shard-dir", default=None, help="Shared work directory (default: <data>/.shards; env SHARD_DIR)")
+        sub.add_argument("--max-attempts", type=int, default=DEFAULT_MAX_ATTEMPTS,
+                         help="Attempts per segment before it counts as failed (env SHARD_MAX_ATTEMPTS)")
+        sub.add_argument("--poll", type=float, default=DEFAULT_POLL, help="Seconds between checks of the shared directory")
+
+    def encoding(sub):
+        sub.add_argument("--ffmpeg-threads", type=int, default=DEFAULT_FFMPEG_THREADS,
+                         help="-threads passed to each ffmpeg encode (env FFMPEG_THREADS)")
+        sub.add_argument("--still", action="store_true", default=os.getenv("STILL_IMAGE") == "1",
+                         help="Still-image segment encoding (env STILL_IMAGE=1)")
+        sub.add_argument("--loudness", dest="no_loudness", action="store_false",
+                         default=os.getenv("LOUDNESS_NORMALIZE", "0") != "1",
+                         help="Normalize the clips to EBU R128 loudness (env LOUDNESS_NORMALIZE=1)")
+        sub.add_argument("--no-loudness", dest="no_loudness", action="store_true",
+                         help="Keep the clips' own levels, even with LOUDNESS_NORMALIZE=1")
+        sub.add_argument("--force", action="store_true", default=None,
+                         help="Re-render every segment, even if its inputs are unchanged (env FORCE_REBUILD=1)")
+
+    def worker_options(sub):
+        sub.add_argument("--jobs", type=int, default=int(os.getenv("SEGMENT_JOBS", "0")),
+                         help="Concurrent encodes in this worker (default: CPU count / ffmpeg threads)")
+        sub.add_argument("--lease-seconds", type=float, default=DEFAULT_LEASE_SECONDS,
+                         help="Lease expiry; a worker that stops renewing loses its items after this long (env SHARD_LEASE_SECONDS)")
+
+    sub = commands.add_parser("plan", help="Write the work manifest (run once, after audio and images)")
+    common(sub)
+    encoding(sub)
+    sub = commands.add_parser("work", help="Claim and render segments until none are left (run on every host)")
+    common(sub)
+    worker_options(sub)
+    sub.add_argument("--worker-id", default=None, help="Name in leases and records (default: <host>-<pid>)")
+    sub = commands.add_parser("merge", help="Wait for every segment, then run the ordered merge")
+    common(sub)
+    sub.add_argument("--timeout", type=float, default=None, help="Give up after this many seconds")
+    sub = commands.add_parser("local", help="plan + N local worker processes + merge")
+    common(sub)
+    encoding(sub)
+    worker_options(sub)
+    sub.add_argument("--workers", type=int, default=int(os.getenv("SHARD_WORKERS", "2")),
+                     help="Worker processes to start on this machine (env SHARD_WORKERS)")
+    return parser.parse_args(argv)
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    shard_dir = args.shard_dir or default_shard_dir(args.data)
+    log(f"=== KNM Sharded Render: {args.command} ===")
+    try:
+        if args.command == "plan":
+            plan(args.data, shard_dir, args.still, args.ffmpeg_threads, not args.no_loudness, args.force)
+        elif args.command == "work":
+            work(shard_dir, args.worker_id, args.jobs, args.lease_seconds, args.max_attempts, args.poll)
+        elif args.command == "merge":
+            merge(shard_dir, args.max_attempts, args.poll, args.timeout)
+        else:
+            run_local(args.data, shard_dir, args.workers, args)
+    except (RuntimeError, TimeoutError, FileNotFoundError, subprocess.CalledProcessError) as e:
+        log(f"ERROR: {e}")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
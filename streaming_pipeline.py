@@ -0,0 +1,321 @@
+import os
+import time
+import queue
+import argparse
+import threading
+from dataclasses import dataclass
+from concurrent.futures import ProcessPoolExecutor
+
+import generate_question_images as cards
+from build_state import digest, stage_state
+from input_parser import load_sections
+from tts_cache import TTSCache
+from tts_backends import get_backend
+from generate_audio_segments_multi_voice import add_tts_args, synthesize_section, voices_from_args
+from phrase_splice import splicer_from_args
+from generate_video_segments_and_merge import (
+    log, run_ffmpeg, ffmpeg_error, data_paths, intro_pair, pairs_for_images,
+    encode_stale_segments, encode_shared_audio, default_jobs, DEFAULT_FFMPEG_THREADS,
+)
+from timeline_render import concat_entry
+import metrics
+
+# ========= CONFIGURATION =========
+DONE = object()  # end-of-stream marker passed down the queues
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Stream sections through TTS -> cards -> segments -> section merge with bounded queues.")
+    parser.add_argument("--input", default="/data/input.txt", help="Input file with audio scripts/questions")
+    parser.add_argument("--data", default="/data", help="Base project folder (output_audio, output_images, segments, ...)")
+    parser.add_argument("--scenes", default=None, help="Scenes folder (default: <data>/scenes)")
+    parser.add_argument("--queue-size", type=int, default=int(os.getenv("STREAM_QUEUE_SIZE", "2")),
+                        help="Sections waiting between two stages before the upstream stage blocks")
+    parser.add_argument("--render-workers", type=int, default=int(os.getenv("IMAGE_WORKERS", os.cpu_count() or 1)),
+                        help="Card render processes")
+    parser.add_argument("--jobs", type=int, default=int(os.getenv("SEGMENT_JOBS", "0")),
+                        help="Sections encoded at once (default: CPU count / --ffmpeg-threads)")
+    parser.add_argument("--ffmpeg-threads", type=int, default=DEFAULT_FFMPEG_THREADS,
+                        help="-threads passed to each ffmpeg encode (env FFMPEG_THREADS)")
+    parser.add_argument("--still", action="store_true", default=os.getenv("STILL_IMAGE") == "1",
+                        help="Still-image segment encoding (env STILL_IMAGE=1)")
+    parser.add_argument("--loudness", dest="no_loudness", action="store_false",
+                        default=os.getenv("LOUDNESS_NORMALIZE", "0") != "1",
+                        help="Normalize the clips to EBU R128 loudness (env LOUDNESS_NORMALIZE=1)")
+    parser.add_argument("--no-loudness", dest="no_loudness", action="store_true",
+                        help="Keep the clips' own levels, even with LOUDNESS_NORMALIZE=1")
+    parser.add_argument("--frames", action="store_true", default=os.getenv("FRAME_PIPE") == "1",
+                        help="Pipe rendered cards to ffmpeg as raw RGB frames instead of PNG files (env FRAME_PIPE=1)")
+    parser.add_argument("--save-images", action="store_true", default=os.getenv("SAVE_IMAGES") == "1",
+                        help="With --frames, also write the PNGs for inspection (env SAVE_IMAGES=1)")
+    parser.add_argument("--force", action="store_true", default=None,
+                        help="Rebuild every artifact, even if its inputs are unchanged (env FORCE_REBUILD=1)")
+    parser.add_argument("--state-dir", default=None,
+                        help="Build state folder (default: <data>/.build; env BUILD_STATE_DIR)")
+    add_tts_args(parser)
+    return parser.parse_args(argv)
+
+
+# ========= WORK ITEMS =========
+@dataclass
+class WorkItem:
+    """One section (or the intro) on its way through the stages."""
+    index: int
+    label: str
+    section: object = None  # None for the intro, which has no TTS or card work here
+    pairs: list = None
+    frames: dict = None     # image path -> ((width, height), rgb24 view) in --frames mode (cards.SharedFrames)
+    output: str = None      # stream-copied section file
+    error: str = None
+
+
+def run_stage(name, func, workers, inbox, outbox):
+    """Start `workers` threads applying func to items from inbox and passing them on to outbox.
+
+    Items that failed upstream are passed through untouched, so the final
+    merge sees every section. DONE is forwarded once all workers have seen it.
+    """
+    remaining = [max(1, workers)]
+    lock = threading.Lock()
+
+    def worker():
+        while True:
+            item = inbox.get()
+            if item is DONE:
+                inbox.put(DONE)  # wake the sibling workers too
+                with lock:
+                    remaining[0] -= 1
+                    last = remaining[0] == 0
+                if last:
+                    outbox.put(DONE)
+                return
+            if item.error is None:
+                try:
+                    with metrics.timed("stream_stage", stage=name, item=item.label):
+                        func(item)
+                except Exception as e:
+                    item.error = f"{name}: {e}"
+                    log(f"{item.label} failed in {name}: {e}")
+            outbox.put(item)
+
+    threads = [threading.Thread(target=metrics.in_scope(worker), name=f"{name}-{i}", daemon=True)
+               for i in range(remaining[0])]
+    for t in threads:
+        t.start()
+    return threads
+
+
+# ========= PIPELINE =========
+class StreamingPipeline:
+    """Per-section stages sharing one TTS backend, render pool and build state.
+
+    render_pool, tts_cache and loudness can be handed in by a caller that runs
+    several pipelines (render_service.py), so their warm state outlives one run.
+    """
+
+    def __init__(self, args, render_pool=None, tts_cache=None, loudness=None):
+        self.args = args
+        self.paths = data_paths(args.data)
+        self.scenes = args.scenes or os.path.join(args.data, "scenes")
+        self.sections_dir = os.path.join(args.data, "sections")
+        for folder in (self.paths.audio, self.paths.images, self.paths.segments, self.paths.final, self.sections_dir):
+            os.makedirs(folder, exist_ok=True)
+
+        self.backend = get_backend(args.tts_backend, max(1, args.concurrency), args.rps)
+        self.voices = voices_from_args(args)
+        self.splicer = splicer_from_args(args)
+        self.cache = None if args.no_cache else (tts_cache or TTSCache(args.cache_dir, args.cache_max_mb))
+        self.states = {stage: stage_state(stage, args.data, args.force, args.state_dir)
+                       for stage in ("audio", "images", "segments", "sections")}
+        self.layout = cards.layout_signature(self.states["images"])
+        self.loudness = None
+        if not args.no_loudness:
+            from loudness import LoudnessCache, default_cache_path
+            self.loudness = loudness or LoudnessCache(default_cache_path(args.data))
+        self.shared_audio, self.shared_lock = {}, threading.Lock()
+        self.render_pool = render_pool
+        self.started = self.first_done = None
+
+    # ----- stages -----
+    def synthesize(self, item):
+        if item.section is None:
+            return
+        if not synthesize_section(item.section, self.backend, self.cache, self.states["audio"],
+                                  self.paths.audio, self.args.batched, self.voices, self.splicer):
+            raise RuntimeError("TTS request failed")
+
+    def render(self, item):
+        if item.section is None:
+            return
+        tasks = cards.build_tasks([item.section], self.paths.images, self.scenes)
+        if self.args.frames:
+            # Cards are cheap to redraw; segments are still skipped by their frame's digest
+            futures = [self.render_pool.submit(metrics.call_timed, cards.render_frames, task, self.args.save_images)
+                       for task in tasks]
+            item.frames = cards.collect_frames(tasks, futures)
+            item.pairs = pairs_for_images(list(item.frames), self.paths)
+            return
+        stale = cards.stale_tasks(tasks, self.states["images"], self.layout)
+        futures = [(task, key, self.render_pool.submit(metrics.call_timed, cards.run_task, task)) for task, key in stale]
+        for task, key, future in futures:
+            cards.record_render(task, future.result()[1])
+            for out in cards.task_outputs(task):
+                self.states["images"].record(out, key)
+        item.pairs = pairs_for_images([out for task in tasks for out in cards.task_outputs(task)], self.paths)
+
+    def encode(self, item):
+        gains = {}
+        if self.loudness:
+            from loudness import gain_for
+            gains = {aud: gain_for(self.loudness.measure(aud)) for _, aud, _ in item.pairs}
+
+        shared = {}
+        if self.args.still:
+            for _, aud, out in item.pairs:
+                if out.endswith("_answer.mp4"):
+                    shared[aud] = self.shared_track(aud, gains.get(aud, 0.0))
+
+        try:
+            segments, failures = encode_stale_segments(
+                item.pairs, self.states["segments"], 1, self.args.ffmpeg_threads, self.args.still, shared, gains,
+                item.frames)
+        finally:
+            if item.frames is not None:  # release the section's frames as soon as they are encoded
+                item.frames.release()
+                item.frames = None
+        if failures:
+            raise RuntimeError(f"{len(failures)} segment(s) failed: {failures[0][1]}")
+        item.pairs = [pair for pair in item.pairs if pair[2] in segments]
+
+    def shared_track(self, audio_path, gain_db):
+        """Answer sound encoded once per run, whichever section needs it first."""
+        with self.shared_lock:
+            key = (audio_path, gain_db)
+            if key not in self.shared_audio:
+                self.shared_audio[key] = encode_shared_audio(audio_path, self.paths.segments, gain_db)
+            return self.shared_audio[key]
+
+    def merge_section(self, item):
+        """Stream-copy the section's segments into one playable section file."""
+        segments = [out for _, _, out in item.pairs]
+        if not segments:
+            raise RuntimeError("no segments")
+        output = os.path.join(self.sections_dir, f"{item.index:03d}_{item.label.replace(' ', '_')}.mp4")
+        key = digest("section", [(seg, os.stat(seg).st_size, os.stat(seg).st_mtime_ns) for seg in segments])
+        if not self.states["sections"].fresh(output, key):
+            concat_copy(segments, output)
+            self.states["sections"].record(output, key)
+        item.output = output
+        if self.first_done is None:
+            self.first_done = time.time() - self.started
+            log(f"First section ready after {self.first_done:.1f}s: {output}")
+
+    # ----- orchestration -----
+    def items(self):
+        items = []
+        intro = intro_pair(self.paths)
+        if intro:
+            items.append(WorkItem(0, "intro", pairs=[intro]))
+        else:
+            log("Intro image or audio missing, skipping intro section.")
+        for section in load_sections(self.args.input):
+            items.append(WorkItem(len(items) + 1, f"script {section.script_id:02d}", section))
+        return items
+
+    def run(self):
+        args = self.args
+        self.started = time.time()
+        items = self.items()
+        encoders = args.jobs or default_jobs(args.ffmpeg_threads)
+        log(f"Streaming {len(items)} work items: {max(1, args.concurrency)} TTS, "
+            f"{args.render_workers} render, {encoders} encode worker(s), queue size {args.queue_size}")
+
+        size = max(1, args.queue_size)
+        to_tts, to_cards, to_encode, to_merge, done = (queue.Queue(size), queue.Queue(size), queue.Queue(size),
+                                                       queue.Queue(size), queue.Queue())
+        own_pool = self.render_pool is None
+        if own_pool:
+            self.render_pool = ProcessPoolExecutor(max_workers=max(1, args.render_workers), initializer=cards.get_renderer)
+        try:
+            threads = (
+                run_stage("tts", self.synthesize, args.concurrency, to_tts, to_cards)
+                + run_stage("cards", self.render, args.render_workers, to_cards, to_encode)
+                + run_stage("encode", self.encode, encoders, to_encode, to_merge)
+                + run_stage("merge", self.merge_section, 1, to_merge, done)
+            )
+
+            def produce():
+                for item in items:
+                    to_tts.put(item)  # blocks while TTS is queue_size sections ahead
+                to_tts.put(DONE)
+
+            threading.Thread(target=produce, name="producer", daemon=True).start()
+            finished = []
+            while (item := done.get()) is not DONE:
+                finished.append(item)
+                log(f"{item.label}: {'FAILED (' + item.error + ')' if item.error else 'done'}")
+            for t in threads:
+                t.join()
+        finally:
+            if own_pool:
+                self.render_pool.shutdown()
+                self.render_pool = None
+
+        for state in self.states.values():
+            state.save()
+        if self.loudness:
+            self.loudness.save()
+        if self.splicer is not None:
+            log(self.splicer.summary())
+        return sorted(finished, key=lambda item: item.index)
+
+
+def concat_copy(inputs, output, faststart=False):
+    """Join same-format MP4s in order without re-encoding."""
+    list_path = f"{output}.ffconcat"
+    with open(list_path, "w", encoding="utf-8") as f:
+        f.write("ffconcat version 1.0\n")
+        for path in inputs:
+            f.write(f"{concat_entry(path)}\n")
+    cmd = ["ffmpeg", "-y", "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy"]
+    if faststart:
+        cmd += ["-movflags", "+faststart"]
+    ok, stderr = run_ffmpeg(cmd + [output])
+    os.remove(list_path)
+    if not ok:
+        raise RuntimeError(ffmpeg_error(stderr))
+    return output
+
+
+def render_video(pipeline):
+    """Run the pipeline and join its sections into final_video.mp4; returns (final path or None, items)."""
+    finished = pipeline.run()
+    sections = [item.output for item in finished if item.output]
+    if not sections:
+        return None, finished
+    final = os.path.join(pipeline.paths.final, "final_video.mp4")
+    concat_copy(sections, final, faststart=True)
+    log(f"Final video created: {final} ({time.time() - pipeline.started:.1f}s total)")
+    return final, finished
+
+
+# ========= MAIN =========
+def main(argv=None):
+    args = parse_args(argv)
+    log("=== KNM Streaming Pipeline ===")
+    final, finished = render_video(StreamingPipeline(args))
+
+    failed = [item for item in finished if item.error]
+    if failed:
+        log(f"{len(failed)} of {len(finished)} sections failed:")
+        for item in failed:
+            log(f"  {item.label}: {item.error}")
+        exit(1)
+    if not final:
+        log("Nothing to render. Check input.txt.")
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
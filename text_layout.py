@@ -0,0 +1,91 @@
+import threading
+from functools import lru_cache
+
+from PIL import ImageFont
+
+# ========= CONFIGURATION =========
+MEMO_SIZE = 4096  # words and lines remembered per layout (render workers of a service live through many jobs)
+
+
+# ========= TEXT LAYOUT =========
+class TextLayout:
+    """Greedy line breaking for one (font, size) from memoized word advances.
+
+    Line widths are estimated by summing cached word and space advances. Only
+    when the estimate lands within `slack` pixels of max_width (where kerning
+    and side bearings could flip the decision) is the candidate line measured
+    for real, so results match measuring every growing line with textbbox.
+    Both memos keep the MEMO_SIZE most recently used entries.
+    """
+
+    def __init__(self, font):
+        self.font = font
+        self.slack = max(4, font.size)
+        self.advances = {}
+        self.boxes = {}
+        self.space = font.getlength(" ")
+
+    def advance(self, word):
+        return memo(self.advances, word, self.font.getlength)
+
+    def line_box(self, line):
+        """(width, height) of a line's ink box from the origin, like textbbox()[2:]."""
+        return memo(self.boxes, line, lambda text: self.font.getbbox(text)[2:])
+
+    def fits(self, line, estimate, max_width):
+        if estimate + self.slack <= max_width:
+            return True
+        if estimate - self.slack > max_width:
+            return False
+        return self.line_box(line)[0] <= max_width
+
+    def wrap(self, text, max_width):
+        lines, line, width = [], "", 0.0
+        for word in text.split():
+            if line:
+                candidate = f"{line} {word}"
+                estimate = width + self.space + self.advance(word)
+            else:
+                candidate, estimate = word, self.advance(word)
+            if self.fits(candidate, estimate, max_width):
+                line, width = candidate, estimate
+            else:
+                lines.append(line)
+                line, width = word, self.advance(word)
+        if line:
+            lines.append(line)
+        return lines
+
+
+def memo(cache, key, compute):
+    """LRU lookup in a plain dict (most recently used last), bounded by MEMO_SIZE."""
+    value = cache.pop(key, None)
+    if value is None:
+        value = compute(key)
+    cache[key] = value
+    while len(cache) > MEMO_SIZE:
+        try:
+            cache.pop(next(iter(cache)), None)
+        except (RuntimeError, StopIteration):  # resized by another thread; trim on the next miss
+            break
+    return value
+
+
+@lru_cache(maxsize=None)
+def load_font(path, size):
+    """TrueType font loaded once per process and shared by every stage that draws text."""
+    return ImageFont.truetype(path, size)
+
+
+_layouts = {}
+_lock = threading.Lock()
+
+
+def get_layout(font):
+    """Shared TextLayout per (font file, size)."""
+    key = (getattr(font, "path", id(font)), font.size)
+    layout = _layouts.get(key)
+    if layout is None:
+        with _lock:
+            layout = _layouts.setdefault(key, TextLayout(font))
+    return layout
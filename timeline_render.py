@@ -0,0 +1,188 @@
+import os
+import wave
+import argparse
+
+from audio_master import build_master
+from build_state import digest, stage_state
+from generate_video_segments_and_merge import (
+    log, run_ffmpeg, ffmpeg_error, data_paths, match_images_and_audios, media_duration,
+    VIDEO_SIZE, FRAME_RATE, VIDEO_CODEC_ARGS, AUDIO_CODEC_ARGS,
+)
+
+# ========= CONFIGURATION =========
+PCM_CODECS = {1: "pcm_u8", 2: "pcm_s16le", 3: "pcm_s24le", 4: "pcm_s32le"}
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Render the final KNM video in one ffmpeg pass (no per-clip segments).")
+    parser.add_argument("--data", default="/data", help="Base project folder containing audio/images.")
+    parser.add_argument("--output", default=None, help="Output file (default: <data>/final_video/final_video.mp4)")
+    parser.add_argument("--ffmpeg-threads", type=int, default=0, help="-threads for the encode (0 = ffmpeg decides)")
+    parser.add_argument("--native-audio", action="store_true", default=os.getenv("NATIVE_AUDIO") == "1",
+                        help="Assemble one PCM master track in Python (audio_master) instead of concatenating clips in ffmpeg")
+    parser.add_argument("--gap", type=float, default=float(os.getenv("MASTER_GAP", "0")),
+                        help="Silence after every clip in --native-audio mode, in seconds (env MASTER_GAP)")
+    parser.add_argument("--loudness", dest="no_loudness", action="store_false",
+                        default=os.getenv("LOUDNESS_NORMALIZE", "0") != "1",
+                        help="Normalize the clips to EBU R128 loudness (env LOUDNESS_NORMALIZE=1)")
+    parser.add_argument("--no-loudness", dest="no_loudness", action="store_true",
+                        help="Keep the clips' own levels, even with LOUDNESS_NORMALIZE=1")
+    parser.add_argument("--force", action="store_true", default=None,
+                        help="Render even if no image, audio or setting changed (env FORCE_REBUILD=1)")
+    return parser.parse_args(argv)
+
+
+# ========= HELPERS =========
+def concat_entry(path):
+    """ffconcat 'file' line with single quotes escaped."""
+    escaped = os.path.abspath(path).replace("'", "'\\''")
+    return f"file '{escaped}'"
+
+
+def wav_format(path):
+    """(channels, sample width, rate) from the header, or None if not a PCM WAV."""
+    try:
+        with wave.open(path, "rb") as w:
+            return w.getnchannels(), w.getsampwidth(), w.getframerate()
+    except (wave.Error, EOFError):
+        return None
+
+
+def conform_audio(src, fmt, work_dir):
+    """Convert a clip to the timeline's PCM format once (reused while newer than src)."""
+    channels, width, rate = fmt
+    name = os.path.splitext(os.path.basename(src))[0]
+    dst = os.path.join(work_dir, f"{name}_{rate}_{channels}ch.wav")
+    if not os.path.exists(dst) or os.path.getmtime(dst) < os.path.getmtime(src):
+        log(f"Conforming {src} -> {dst}")
+        ok, stderr = run_ffmpeg([
+            "ffmpeg", "-y", "-i", src, "-vn", "-ar", str(rate), "-ac", str(channels),
+            "-c:a", PCM_CODECS[width], dst,
+        ])
+        if not ok:
+            raise RuntimeError(ffmpeg_error(stderr))
+    return dst
+
+
+# ========= TIMELINE =========
+def build_timeline(pairs, work_dir):
+    """Ordered (image, audio, start, duration) entries; every clip shares one PCM format.
+
+    The timeline format is taken from the first WAV; clips in any other format
+    (e.g. answer.mp3) are decoded once into work_dir.
+    """
+    formats = {aud: wav_format(aud) for _, aud, _ in pairs}
+    reference = next((fmt for fmt in formats.values() if fmt), (1, 2, 24000))
+    timeline, start = [], 0.0
+    for img, aud, _ in pairs:
+        if formats[aud] != reference:
+            aud = conform_audio(aud, reference, work_dir)
+            formats[aud] = reference
+        duration = media_duration(aud)
+        timeline.append((img, aud, start, duration))
+        start += duration
+    return timeline
+
+
+def master_timeline(pairs, work_dir, gap=0.0, gains=None):
+    """Timeline over one native master track; stills stay up through the gap after their clip."""
+    master = os.path.join(work_dir, "master.wav")
+    offsets = build_master(pairs, master, os.path.join(work_dir, "master_offsets.json"), gap, gains=gains)
+    return [(o["image"], master, o["start"], o["duration"] + gap) for o in offsets], master
+
+
+def write_concat_scripts(timeline, work_dir):
+    """ffconcat scripts: stills with their display durations, and the audio clips in order."""
+    video_list = os.path.join(work_dir, "video.ffconcat")
+    audio_list = os.path.join(work_dir, "audio.ffconcat")
+    with open(video_list, "w", encoding="utf-8") as v, open(audio_list, "w", encoding="utf-8") as a:
+        v.write("ffconcat version 1.0\n")
+        a.write("ffconcat version 1.0\n")
+        for img, aud, _, duration in timeline:
+            v.write(f"{concat_entry(img)}\nduration {duration:.6f}\n")
+            a.write(f"{concat_entry(aud)}\n")
+        # The concat demuxer only honours the last still's duration if it is listed again
+        v.write(f"{concat_entry(timeline[-1][0])}\n")
+    return video_list, audio_list
+
+
+def render_timeline(timeline, output_path, work_dir, threads=0, audio_master=None):
+    """One ffmpeg run: stills switch at the timeline offsets over one continuous audio track.
+
+    With audio_master the prebuilt 44.1 kHz stereo master is the only audio
+    input; otherwise the clips are concatenated and resampled by ffmpeg.
+    """
+    video_list, audio_list = write_concat_scripts(timeline, work_dir)
+    width, height = VIDEO_SIZE
+    total = timeline[-1][2] + timeline[-1][3]
+    log(f"Rendering {len(timeline)} clips ({total:.1f}s) in a single pass -> {output_path}")
+    if audio_master:
+        audio_input, audio_filter = ["-i", audio_master], []
+    else:
+        audio_input = ["-f", "concat", "-safe", "0", "-i", audio_list]
+        audio_filter = ["-af", "aresample=44100,aformat=channel_layouts=stereo"]
+    cmd = [
+        "ffmpeg", "-y",
+        "-f", "concat", "-safe", "0", "-i", video_list,
+        *audio_input,
+        "-map", "0:v:0", "-map", "1:a:0",
+        "-vf", f"scale={width}:{height},setsar=1,fps={FRAME_RATE},format=yuv420p",
+        *audio_filter,
+        *VIDEO_CODEC_ARGS, *AUDIO_CODEC_ARGS,
+        "-t", f"{total:.6f}",
+        "-movflags", "+faststart",
+    ]
+    if threads:
+        cmd += ["-threads", str(threads)]
+    ok, stderr = run_ffmpeg(cmd + [output_path])
+    if not ok:
+        raise RuntimeError(ffmpeg_error(stderr))
+    return output_path
+
+
+# ========= MAIN =========
+def main(argv=None):
+    args = parse_args(argv)
+    paths = data_paths(args.data)
+    work_dir = os.path.join(args.data, "timeline")
+    os.makedirs(work_dir, exist_ok=True)
+    os.makedirs(paths.final, exist_ok=True)
+    log("=== KNM Timeline Renderer (single ffmpeg pass) ===")
+
+    pairs = match_images_and_audios(args.data)
+    if not pairs:
+        log("No valid image/audio pairs found. Check filenames.")
+        exit(1)
+
+    output = args.output or os.path.join(paths.final, "final_video.mp4")
+    gains = None
+    if not args.no_loudness:
+        from loudness import clip_gains, default_cache_path
+        gains = clip_gains([aud for _, aud, _ in pairs], default_cache_path(args.data))
+        if not args.native_audio:
+            # Per-clip gain needs the clips as samples; the ffmpeg concat path cannot apply it
+            log("Loudness normalization uses the native master track; enabling --native-audio")
+            args.native_audio = True
+
+    # The output is one artifact: any changed clip or setting re-renders it
+    state = stage_state("timeline", args.data, args.force)
+    key = digest("timeline", [(state.file_digest(img), state.file_digest(aud)) for img, aud, _ in pairs],
+                 gains, args.native_audio, args.gap, VIDEO_SIZE, FRAME_RATE, VIDEO_CODEC_ARGS, AUDIO_CODEC_ARGS)
+    if state.fresh(output, key):
+        state.save()
+        log(f"Final video up to date: {output}")
+        return
+
+    if args.native_audio:
+        timeline, master = master_timeline(pairs, work_dir, args.gap, gains)
+        render_timeline(timeline, output, work_dir, args.ffmpeg_threads, audio_master=master)
+    else:
+        timeline = build_timeline(pairs, work_dir)
+        render_timeline(timeline, output, work_dir, args.ffmpeg_threads)
+    state.record(output, key)
+    state.save()
+    log(f"Final video created: {output}")
+
+
+if __name__ == "__main__":
+    main()
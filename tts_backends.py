@@ -0,0 +1,351 @@
+import os
+import re
+import math
+import wave
+import zlib
+import array
+import threading
+from abc import ABC, abstractmethod
+from functools import lru_cache
+from xml.sax.saxutils import escape, unescape
+
+import metrics
+from tts_cache import cache_key, spliced_key
+from tts_pool import SynthesizerPool, TokenBucket
+from wav_utils import split_wav
+
+# ========= CONFIGURATION =========
+DEFAULT_BACKEND = os.getenv("TTS_BACKEND", "azure")
+BACKEND_CHOICES = ("azure", "local", "draft")
+
+TAG_RE = re.compile(r"<[^>]+>")
+SSML_TOKEN_RE = re.compile(r"<voice name='([^']+)'>|<bookmark mark='([^']+)'\s*/>|<[^>]+>|([^<]+)")
+
+SAMPLE_RATE = 24000            # matches Azure's Riff24Khz16BitMonoPcm
+LOCAL_SECONDS_PER_CHAR = 0.065 # roughly neural-voice speaking pace
+LOCAL_MIN_SECONDS = 0.5
+
+
+# ========= LOG =========
+def log(msg): print(f"[DEBUG] {msg}")
+
+
+# ========= SSML =========
+def spoken_chars(ssml):
+    """Characters of spoken text in an SSML document (what the TTS service bills)."""
+    return len(" ".join(unescape(TAG_RE.sub(" ", ssml)).split()))
+
+
+def build_ssml(text, voice_name, rate="0%", lang=None):
+    """SSML document for one utterance; lang defaults to the voice's locale. text is escaped as XML."""
+    lang = lang or "-".join(voice_name.split("-")[:2])
+    return f"""
+    <speak version='1.0' xml:lang='{lang}'>
+        <voice name='{voice_name}'>
+            <prosody rate='{rate}'>{escape(text)}</prosody>
+        </voice>
+    </speak>
+    """
+
+
+def build_section_ssml(parts, rate="0%", lang=None):
+    """One SSML document for a whole section.
+
+    parts is an ordered list of (mark, voice_name, text); every part except
+    the first is preceded by <bookmark mark='...'/> so the audio can be split
+    back into one file per part. Texts are escaped as XML.
+    """
+    lang = lang or "-".join(parts[0][1].split("-")[:2])
+    body = []
+    for i, (mark, voice_name, text) in enumerate(parts):
+        bookmark = f"<bookmark mark='{mark}'/>" if i else ""
+        body.append(f"<voice name='{voice_name}'>{bookmark}<prosody rate='{rate}'>{escape(text)}</prosody></voice>")
+    return f"<speak version='1.0' xml:lang='{lang}'>{''.join(body)}</speak>"
+
+
+# ========= BACKENDS =========
+class TTSBackend(ABC):
+    """Common interface: render one SSML document to a WAV file.
+
+    Subclasses implement _synthesize() and _synthesize_marked(); synthesize_to_file() adds the shared
+    cache lookup and the unlink-before-write rule for hard-linked outputs.
+    """
+
+    name = "base"
+    output_format = "riff-24khz-16bit-mono-pcm"
+    remote = False
+
+    @abstractmethod
+    def _synthesize(self, ssml, voice_name, output_path):
+        """Write the WAV for ssml to output_path; returns True on success."""
+
+    @abstractmethod
+    def _synthesize_marked(self, ssml, voice_name, output_path):
+        """Like _synthesize, but returns {mark: offset_seconds} (None on failure)."""
+
+    def is_stand_in(self, output_path):
+        """True if the audio last written to output_path only stands in for the real voice."""
+        return False
+
+    def synthesize_to_file(self, ssml, voice_name, output_path, cache=None):
+        os.makedirs(os.path.dirname(output_path) or ".", exist_ok=True)
+        key = cache_key(ssml, self.output_format)
+        if cache is not None and cache.fetch(key, output_path):
+            print(f"Cached ({voice_name}): {output_path}")
+            metrics.record("tts_cached", output=output_path, voice=voice_name, chars=spoken_chars(ssml))
+            return True
+
+        # Never write through a hard link into the cache
+        if os.path.lexists(output_path):
+            os.remove(output_path)
+
+        print(f"Generating with {voice_name}: {output_path}")
+        with metrics.timed("tts", backend=self.name, output=output_path, voice=voice_name,
+                           chars=spoken_chars(ssml)) as event:
+            event["ok"] = bool(self._synthesize(ssml, voice_name, output_path))
+        if not event["ok"]:
+            return False
+        print(f"Audio saved: {output_path}")
+        if cache is not None:
+            cache.store(key, output_path)
+        return True
+
+    def synthesize_marked_to_files(self, ssml, voice_name, marks, output_paths, cache=None):
+        """Synthesize a bookmarked document once and split it into output_paths.
+
+        marks[i] is the bookmark where output_paths[i + 1] begins. Pieces are
+        cached individually, but only a complete set counts as a hit.
+        """
+        keys = [cache_key(f"{ssml}#{i}", self.output_format) for i in range(len(output_paths))]
+        if cache is not None:
+            if all(cache.has(k) for k in keys) and all(cache.fetch(k, p) for k, p in zip(keys, output_paths)):
+                print(f"Cached section ({len(output_paths)} files): {output_paths[0]}")
+                metrics.record("tts_cached", output=output_paths[0], voice=voice_name, chars=spoken_chars(ssml),
+                               files=len(output_paths))
+                return True
+            cache.note_miss(len(keys))
+
+        section_path = f"{output_paths[0]}.section.wav"
+        print(f"Generating section ({len(output_paths)} files): {output_paths[0]}")
+        with metrics.timed("tts", backend=self.name, output=output_paths[0], voice=voice_name,
+                           chars=spoken_chars(ssml), files=len(output_paths)) as event:
+            reached = self._synthesize_marked(ssml, voice_name, section_path)
+            event["ok"] = reached is not None
+        if reached is None:
+            return False
+        missing = [m for m in marks if m not in reached]
+        if missing:
+            print(f"Error generating {output_paths[0]}: bookmarks not reached: {', '.join(missing)}")
+            os.remove(section_path)
+            return False
+
+        split_wav(section_path, [reached[m] for m in marks], output_paths)
+        os.remove(section_path)
+        for key, path in zip(keys, output_paths):
+            print(f"Audio saved: {path}")
+            if cache is not None:
+                cache.store(key, path)
+        return True
+
+
+class AzureBackend(TTSBackend):
+    """Azure Cognitive Services Speech, with pooled synthesizers per voice."""
+
+    name = "azure"
+    remote = True
+
+    def __init__(self, concurrency=1, rps=None):
+        import azure.cognitiveservices.speech as speechsdk  # only when Azure is actually used
+
+        self.speechsdk = speechsdk
+        self.key = os.getenv("AZURE_SPEECH_KEY")
+        self.region = os.getenv("AZURE_SPEECH_REGION")
+        if not self.key or not self.region:
+            raise EnvironmentError("Please set AZURE_SPEECH_KEY and AZURE_SPEECH_REGION environment variables.")
+        self.pool = SynthesizerPool(self.create_synthesizer, max(1, concurrency))
+        self.limiter = TokenBucket(rps) if rps else None
+
+    def create_synthesizer(self, voice_name):
+        """Synthesizer without an audio sink; audio comes back in result.audio_data."""
+        sdk = self.speechsdk
+        speech_config = sdk.SpeechConfig(subscription=self.key, region=self.region)
+        speech_config.speech_synthesis_voice_name = voice_name
+        speech_config.set_speech_synthesis_output_format(sdk.SpeechSynthesisOutputFormat.Riff24Khz16BitMonoPcm)
+        return sdk.SpeechSynthesizer(speech_config=speech_config, audio_config=None)
+
+    def _speak(self, ssml, voice_name, output_path, on_bookmark=None):
+        if self.limiter is not None:
+            self.limiter.acquire()
+        with self.pool.acquire(voice_name) as synthesizer:
+            if on_bookmark is not None:
+                synthesizer.bookmark_reached.connect(on_bookmark)
+            try:
+                result = synthesizer.speak_ssml_async(ssml).get()
+            finally:
+                if on_bookmark is not None:
+                    synthesizer.bookmark_reached.disconnect_all()
+        if result.reason != self.speechsdk.ResultReason.SynthesizingAudioCompleted:
+            print(f"Error generating {output_path}: {result.reason}")
+            return False
+        with open(output_path, "wb") as f:
+            f.write(result.audio_data)
+        return True
+
+    def _synthesize(self, ssml, voice_name, output_path):
+        return self._speak(ssml, voice_name, output_path)
+
+    def _synthesize_marked(self, ssml, voice_name, output_path):
+        reached = {}
+        # audio_offset is in 100-nanosecond ticks
+        on_bookmark = lambda evt: reached.__setitem__(evt.text, evt.audio_offset / 10_000_000)
+        if not self._speak(ssml, voice_name, output_path, on_bookmark):
+            return None
+        return reached
+
+
+class LocalBackend(TTSBackend):
+    """Deterministic offline stand-in: a quiet sine tone whose length scales with the text.
+
+    The tone frequency is derived from the voice name so different voices stay
+    distinguishable by ear; identical input always produces identical bytes.
+    """
+
+    name = "local"
+    output_format = "local-sine-riff-24khz-16bit-mono-pcm"
+
+    def duration_for(self, text):
+        return max(LOCAL_MIN_SECONDS, len(text) * LOCAL_SECONDS_PER_CHAR)
+
+    def freq_for(self, voice_name):
+        return 180 + zlib.crc32(voice_name.encode("utf-8")) % 240
+
+    def _synthesize(self, ssml, voice_name, output_path):
+        return self._synthesize_marked(ssml, voice_name, output_path) is not None
+
+    def _synthesize_marked(self, ssml, voice_name, output_path):
+        """One tone per voice run; bookmarks land at the cumulative duration."""
+        runs, reached, voice, split = [], {}, voice_name, True
+        for tag_voice, mark, text in SSML_TOKEN_RE.findall(ssml):
+            if tag_voice:
+                voice = tag_voice
+            elif mark:
+                reached[mark] = sum(int(self.duration_for(t) * SAMPLE_RATE) for _, t in runs) / SAMPLE_RATE
+                split = True
+            elif text.strip():
+                text = " ".join(unescape(text).split())
+                if runs and not split and runs[-1][0] == voice:
+                    runs[-1] = (voice, f"{runs[-1][1]} {text}")
+                else:
+                    runs.append((voice, text))
+                split = False
+        samples = array.array("h")
+        for run_voice, text in runs:
+            samples.extend(tone_samples(self.duration_for(text), self.freq_for(run_voice)))
+        write_pcm(output_path, samples)
+        return reached
+
+
+class DraftBackend(LocalBackend):
+    """Previews: audio Azure already synthesized comes from the cache, everything else is the local tone.
+
+    The cache is only read (under Azure's key), so tones never end up in it;
+    a question prompt that was spliced from phrase fragments is found under
+    its spliced key.
+    Outputs that got a tone are remembered as stand-ins, so the build state
+    does not take them for the real audio once Azure has synthesized it.
+    """
+
+    name = "draft"
+    cached_format = TTSBackend.output_format
+
+    def __init__(self):
+        self.tones = set()
+        self.tones_lock = threading.Lock()
+
+    def mark_tones(self, output_paths, tone):
+        with self.tones_lock:
+            for path in output_paths:
+                (self.tones.add if tone else self.tones.discard)(os.path.abspath(path))
+
+    def is_stand_in(self, output_path):
+        with self.tones_lock:
+            return os.path.abspath(output_path) in self.tones
+
+    def synthesize_to_file(self, ssml, voice_name, output_path, cache=None):
+        for key in (cache_key(ssml, self.cached_format), spliced_key(ssml, self.cached_format)):
+            if cache is not None and cache.has(key) and cache.fetch(key, output_path):
+                print(f"Cached ({voice_name}): {output_path}")
+                metrics.record("tts_cached", output=output_path, voice=voice_name, chars=spoken_chars(ssml))
+                self.mark_tones([output_path], False)
+                return True
+        self.mark_tones([output_path], True)
+        return super().synthesize_to_file(ssml, voice_name, output_path)
+
+    def synthesize_marked_to_files(self, ssml, voice_name, marks, output_paths, cache=None):
+        keys = [cache_key(f"{ssml}#{i}", self.cached_format) for i in range(len(output_paths))]
+        if cache is not None and all(cache.has(k) for k in keys) and all(
+                cache.fetch(k, p) for k, p in zip(keys, output_paths)):
+            print(f"Cached section ({len(output_paths)} files): {output_paths[0]}")
+            self.mark_tones(output_paths, False)
+            return True
+        self.mark_tones(output_paths, True)
+        return super().synthesize_marked_to_files(ssml, voice_name, marks, output_paths)
+
+
+# ========= WAV HELPERS =========
+@lru_cache(maxsize=64)
+def tone_second(freq, amplitude, sample_rate):
+    """One second of 16-bit sine; an integer freq makes it loop seamlessly."""
+    step = 2 * math.pi * freq / sample_rate
+    peak = amplitude * 32767
+    return array.array("h", (int(peak * math.sin(i * step)) for i in range(sample_rate))).tobytes()
+
+
+def tone_samples(seconds, freq, amplitude=0.1, sample_rate=SAMPLE_RATE):
+    """16-bit mono sine tone (fades in/out to avoid clicks)."""
+    n = int(seconds * sample_rate)
+    fade = min(n // 2, int(0.01 * sample_rate))
+    samples = array.array("h")
+    samples.frombytes(tone_second(int(freq), amplitude, sample_rate) * (n // sample_rate + 1))
+    del samples[n:]
+    for i in range(fade):
+        samples[i] = samples[i] * i // fade
+        samples[n - 1 - i] = samples[n - 1 - i] * i // fade
+    return samples
+
+
+def write_pcm(path, samples, sample_rate=SAMPLE_RATE):
+    with wave.open(path, "wb") as w:
+        w.setnchannels(1)
+        w.setsampwidth(2)
+        w.setframerate(sample_rate)
+        w.writeframes(samples.tobytes())
+
+
+# ========= FACTORY =========
+def add_backend_args(parser):
+    """Register the shared --tts-backend flag (defaults to $TTS_BACKEND)."""
+    parser.add_argument("--tts-backend", choices=BACKEND_CHOICES, default=DEFAULT_BACKEND,
+                        help="TTS engine: 'azure', the offline 'local' stand-in, or 'draft' "
+                             "(cached Azure audio, local stand-in otherwise) (env TTS_BACKEND)")
+
+
+_backends = {}
+_backends_lock = threading.Lock()
+
+
+def get_backend(name=None, concurrency=1, rps=None):
+    """Backend instance, shared by stages (and service jobs) that run in the same process with the same settings."""
+    name = name or DEFAULT_BACKEND
+    key = (name, concurrency, rps)
+    with _backends_lock:
+        if key not in _backends:
+            if name == "azure":
+                _backends[key] = AzureBackend(concurrency=concurrency, rps=rps)
+            elif name == "local":
+                _backends[key] = LocalBackend()
+            elif name == "draft":
+                _backends[key] = DraftBackend()
+            else:
+                raise ValueError(f"Unknown TTS backend: {name} (expected one of {', '.join(BACKEND_CHOICES)})")
+        return _backends[key]
@@ -0,0 +1,131 @@
+import os
+import shutil
+import hashlib
+import threading
+
+# ========= CONFIGURATION =========
+DEFAULT_CACHE_DIR = os.getenv("TTS_CACHE_DIR", "/data/.tts_cache")
+DEFAULT_MAX_MB = int(os.getenv("TTS_CACHE_MAX_MB", "2048"))
+
+
+# ========= LOG =========
+def log(msg): print(f"[DEBUG] {msg}")
+
+
+# ========= KEY HELPERS =========
+def normalize_ssml(ssml):
+    """Collapse whitespace so indentation changes don't bust the cache."""
+    return " ".join(ssml.split())
+
+
+def cache_key(ssml, output_format):
+    """Content address for one synthesized utterance (text + voice + rate + format)."""
+    payload = f"{output_format}\n{normalize_ssml(ssml)}"
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def spliced_key(ssml, output_format):
+    """Content address of a prompt spliced from phrase fragments; never served as the whole prompt."""
+    return cache_key(f"{ssml}#spliced", output_format)
+
+
+def replace_file(src, dest):
+    """Hard-link src to dest (copy across filesystems), replacing dest.
+
+    dest is always unlinked first so a later in-place write to dest can
+    never truncate the shared inode of a cache entry.
+    """
+    os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+    if os.path.lexists(dest):
+        os.remove(dest)
+    try:
+        os.link(src, dest)
+    except OSError:
+        shutil.copyfile(src, dest)
+
+
+# ========= CACHE =========
+class TTSCache:
+    """On-disk, content-addressed WAV cache with a size cap and LRU eviction.
+
+    Recency is tracked through the entry's mtime, which is bumped on every hit.
+    Safe to share between synthesis threads.
+    """
+
+    def __init__(self, cache_dir=DEFAULT_CACHE_DIR, max_mb=DEFAULT_MAX_MB):
+        self.cache_dir = cache_dir
+        self.max_bytes = int(max_mb) * 1024 * 1024
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size_bytes = sum(size for _, size, _ in self.entries())
+
+    def path_for(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.wav")
+
+    def has(self, key):
+        return os.path.exists(self.path_for(key))
+
+    def note_miss(self, count=1):
+        with self.lock:
+            self.misses += count
+
+    def fetch(self, key, dest):
+        """Materialize a cached entry at dest. Returns True on a hit."""
+        src = self.path_for(key)
+        try:
+            os.utime(src, None)
+            replace_file(src, dest)
+        except FileNotFoundError:  # missing, or evicted by another thread
+            with self.lock:
+                self.misses += 1
+            return False
+        with self.lock:
+            self.hits += 1
+        return True
+
+    def store(self, key, src):
+        """Copy a freshly synthesized WAV into the cache and enforce the size cap."""
+        if not os.path.exists(src) or os.path.getsize(src) == 0:
+            return
+        entry = self.path_for(key)
+        os.makedirs(os.path.dirname(entry), exist_ok=True)
+        if os.path.exists(entry):
+            with self.lock:
+                self.size_bytes -= os.path.getsize(entry)
+        tmp = f"{entry}.{os.getpid()}.{threading.get_ident()}.tmp"
+        shutil.copyfile(src, tmp)
+        with self.lock:
+            os.replace(tmp, entry)
+            self.size_bytes += os.path.getsize(entry)
+            if self.size_bytes > self.max_bytes:
+                self.evict()
+
+    def entries(self):
+        for root, _, files in os.walk(self.cache_dir):
+            for name in files:
+                if name.endswith(".wav"):
+                    path = os.path.join(root, name)
+                    try:
+                        st = os.stat(path)
+                    except FileNotFoundError:
+                        continue
+                    yield path, st.st_size, st.st_mtime
+
+    def evict(self):
+        """Drop least-recently-used entries until the cache fits under max_bytes."""
+        entries = sorted(self.entries(), key=lambda e: e[2])
+        total = sum(size for _, size, _ in entries)
+        for path, size, _ in entries:
+            if total <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total -= size
+        self.size_bytes = total
+
+    def summary(self):
+        return f"TTS cache: {self.hits} hits, {self.misses} misses ({self.cache_dir})"
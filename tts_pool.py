@@ -0,0 +1,68 @@
+import time
+import queue
+import threading
+from contextlib import contextmanager
+
+
+# ========= RATE LIMITING =========
+class TokenBucket:
+    """Thread-safe token bucket: `rate` requests per second, bursts up to `capacity`."""
+
+    def __init__(self, rate, capacity=None):
+        self.rate = float(rate)
+        self.capacity = float(capacity if capacity is not None else max(1.0, self.rate))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until one token is available, then take it."""
+        if self.rate <= 0:
+            return
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+# ========= SYNTHESIZER POOL =========
+class SynthesizerPool:
+    """Keeps reusable synthesizers per voice, created lazily up to `size` each.
+
+    `factory(voice)` builds a new synthesizer; the pool never creates more than
+    `size` per voice, so callers block once that many are in flight.
+    """
+
+    def __init__(self, factory, size):
+        self.factory = factory
+        self.size = size
+        self.idle = {}
+        self.created = {}
+        self.lock = threading.Lock()
+
+    @contextmanager
+    def acquire(self, voice):
+        with self.lock:
+            idle = self.idle.setdefault(voice, queue.Queue())
+            create = idle.empty() and self.created.get(voice, 0) < self.size
+            if create:
+                self.created[voice] = self.created.get(voice, 0) + 1
+        if create:
+            try:
+                synthesizer = self.factory(voice)
+            except Exception:
+                with self.lock:
+                    self.created[voice] -= 1
+                raise
+        else:
+            synthesizer = idle.get()
+        try:
+            yield synthesizer
+        finally:
+            idle.put(synthesizer)
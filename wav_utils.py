@@ -0,0 +1,35 @@
+import os
+import wave
+
+
+# ========= WAV HELPERS =========
+def wav_duration(path):
+    """Duration in seconds, read from the WAV header only."""
+    with wave.open(path, "rb") as w:
+        return w.getnframes() / float(w.getframerate())
+
+
+def split_wav(src, offsets, dest_paths):
+    """Cut src at the given offsets (seconds) into len(dest_paths) PCM files.
+
+    offsets[i] is where dest_paths[i + 1] starts; the first piece starts at 0
+    and the last one runs to the end of the file.
+    """
+    if len(offsets) != len(dest_paths) - 1:
+        raise ValueError(f"{len(dest_paths)} outputs need {len(dest_paths) - 1} offsets, got {len(offsets)}")
+
+    with wave.open(src, "rb") as w:
+        params = w.getparams()
+        frames = w.readframes(params.nframes)
+
+    frame_size = params.sampwidth * params.nchannels
+    cuts = [0] + [min(params.nframes, max(0, round(o * params.framerate))) for o in offsets] + [params.nframes]
+    for dest, start, end in zip(dest_paths, cuts, cuts[1:]):
+        os.makedirs(os.path.dirname(dest) or ".", exist_ok=True)
+        if os.path.lexists(dest):
+            os.remove(dest)
+        with wave.open(dest, "wb") as out:
+            out.setnchannels(params.nchannels)
+            out.setsampwidth(params.sampwidth)
+            out.setframerate(params.framerate)
+            out.writeframes(frames[start * frame_size:max(start, end) * frame_size])